@@ -0,0 +1,16 @@
+"""Benchmarks of the spatial backends.
+
+Run every backend over a matrix of table sizes, sky densities, radii and
+query types, and write the timings and EXPLAIN buffer counts to JSON:
+
+    python -m benchmarks --sizes 10000,100000 --output bench.json
+
+Compare a run against a saved baseline, exiting with status 1 if any case
+got slower than the tolerance allows:
+
+    python -m benchmarks --baseline bench.json --tolerance 0.2
+
+The database is the one in skyportal_spatial/tests/config.yaml unless
+`--url` is given. Tables are named `bench_<backend>` and are dropped when
+the run finishes. See `python -m benchmarks --help` for all options.
+"""
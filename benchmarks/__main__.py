@@ -0,0 +1,6 @@
+import sys
+
+from .suite import main
+
+
+sys.exit(main())
@@ -0,0 +1,414 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import sqlalchemy as sa
+import yaml
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker, aliased
+
+import skyportal_spatial
+from skyportal_spatial import (Q3CSpatialBackend, PostGISSpatialBackend,
+                               PostGIS3DSpatialBackend,
+                               UnindexedSpatialBackend, HealpixSpatialBackend,
+                               explain)
+
+
+CONFIG = os.path.join(os.path.dirname(skyportal_spatial.__file__), 'tests',
+                      'config.yaml')
+
+# mixin and class attributes of each benchmarked backend
+BACKENDS = {
+    'q3c': (Q3CSpatialBackend, {}),
+    'postgis': (PostGISSpatialBackend, {}),
+    'postgis3d': (PostGIS3DSpatialBackend, {}),
+    'none': (UnindexedSpatialBackend, {}),
+    'none_uv': (UnindexedSpatialBackend, {'UNIT_VECTORS': True,
+                                          'BTREE_INDEX': True}),
+    'none_zones': (UnindexedSpatialBackend, {'ZONE_HEIGHT': 0.5}),
+    'healpix': (HealpixSpatialBackend, {}),
+}
+
+QUERIES = ['ingest', 'cone', 'multi_cone', 'join', 'knn']
+DENSITIES = ['uniform', 'clustered']
+
+# queries whose cost does not depend on the search radius
+RADIUS_FREE = {'ingest', 'knn'}
+
+# clustered catalogs put most objects in one patch of sky, so that cones
+# and joins there see far more rows than the same radius would on average
+CLUSTER_CENTER = (150., 2.)
+CLUSTER_RADIUS = 5.  # degrees
+CLUSTER_FRACTION = 0.9
+
+DEFAULT_SIZES = [10000, 100000]
+DEFAULT_RADII = [1., 10., 60., 3600.]  # arcsec
+DEFAULT_REPEAT = 5
+DEFAULT_PROBES = 20
+DEFAULT_CONES = 100
+DEFAULT_JOIN_ROWS = 1000
+DEFAULT_K = 10
+DEFAULT_SEED = 8675309
+DEFAULT_TOLERANCE = 0.2
+
+# warm timings that differ from the baseline by less than this many seconds
+# are never flagged, however large the ratio
+MIN_REGRESSION_DELTA = 1e-3
+
+
+def database_url(path=CONFIG):
+    """Build a database URL from the test configuration file."""
+    with open(path) as f:
+        c = yaml.load(f, Loader=yaml.FullLoader)['database']
+    return 'postgresql://{}:{}@{}:{}/{}'.format(
+        c.get('username'), c.get('password') or '', c.get('host') or '',
+        c.get('port') or '', c.get('database')
+    )
+
+
+def make_model(name):
+    """Return a fresh mapped class, on its own metadata, for a backend."""
+    mixin, attrs = BACKENDS[name]
+    Base = declarative_base()
+    namespace = dict(attrs, __tablename__=f'bench_{name}',
+                     id=sa.Column(sa.Integer, primary_key=True))
+    return type(f'Bench_{name}', (mixin, Base), namespace)
+
+
+def sky_points(n, density, rng):
+    """Draw `n` positions, uniform over the sphere or mostly within the
+    cluster, in degrees."""
+
+    if density == 'uniform':
+        ra = rng.uniform(0, 360, n)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+        return ra, dec
+    elif density != 'clustered':
+        raise ValueError(f'Unknown density "{density}".')
+
+    m = int(n * CLUSTER_FRACTION)
+    ra, dec = sky_points(n - m, 'uniform', rng)
+
+    # uniform within a cap around the pole, then rotated to the center
+    cost = rng.uniform(np.cos(np.radians(CLUSTER_RADIUS)), 1, m)
+    phi = rng.uniform(0, 2 * np.pi, m)
+    sint = np.sqrt(1 - cost ** 2)
+    local = np.stack([sint * np.cos(phi), sint * np.sin(phi), cost], -1)
+    a, d = np.radians(CLUSTER_CENTER)
+    rotation = np.array([
+        [np.sin(d) * np.cos(a), -np.sin(a), np.cos(d) * np.cos(a)],
+        [np.sin(d) * np.sin(a), np.cos(a), np.cos(d) * np.sin(a)],
+        [-np.cos(d), 0., np.sin(d)],
+    ])
+    xyz = local @ rotation.T
+    cra = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+    cdec = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1, 1)))
+    return np.concatenate([cra, ra]), np.concatenate([cdec, dec])
+
+
+def plan_summary(session, query):
+    """Return the timings, row counts and buffer counts of the plan of
+    `query`, and which indexes it scanned."""
+
+    report = explain(session, query)
+    return {
+        'planning_ms': report.planning_ms,
+        'execution_ms': report.execution_ms,
+        'rows_scanned': report.rows_scanned,
+        'rows_returned': report.rows_returned,
+        'shared_hit_blocks': report.shared_hit_blocks,
+        'shared_read_blocks': report.shared_read_blocks,
+        'spatial_indexes': sorted(report.spatial_indexes),
+        'seq_scans': sorted(report.seq_scans),
+        'plan': report.plan,
+    }
+
+
+def make_cases(session, model, probes, radius, options):
+    """Return, per query type, a function that runs the query and returns
+    the number of rows, and a function that returns a representative
+    query to explain."""
+
+    ra, dec = probes
+
+    def positions():
+        return [model(ra=r, dec=d) for r, d in
+                zip(ra[:options.probes], dec[:options.probes])]
+
+    def cone():
+        return sum(len(session.query(model).filter(
+            model.radially_within(p, radius)).all()) for p in positions())
+
+    def cone_query():
+        p = positions()[0]
+        return session.query(model).filter(model.radially_within(p, radius))
+
+    def multi_cone_query():
+        n = options.cones
+        return model.radially_within_any(session, ra[:n], dec[:n], radius)
+
+    def join_query():
+        o1, o2 = aliased(model), aliased(model)
+        return session.query(o1.id, o2.id).join(
+            o2, o2.radially_within(o1, radius)
+        ).filter(o1.id <= options.join_rows)
+
+    def knn():
+        return sum(len(model.nearest(session, p, k=options.k).all())
+                   for p in positions())
+
+    def knn_query():
+        return model.nearest(session, positions()[0], k=options.k)
+
+    return {
+        'cone': (cone, cone_query),
+        'multi_cone': (lambda: len(multi_cone_query().all()),
+                       multi_cone_query),
+        'join': (lambda: len(join_query().all()), join_query),
+        'knn': (knn, knn_query),
+    }
+
+
+def time_case(engine, Session, run, repeat):
+    """Time `run` once on a fresh connection (cold) and `repeat` more times
+    (warm). A fresh connection starts without cached plans or catalog
+    entries, but shares the server's buffer cache; compare the shared read
+    and hit blocks of the plan to see how much came from disk."""
+
+    engine.dispose()
+    session = Session()
+    try:
+        start = time.perf_counter()
+        rows = run(session)
+        cold = time.perf_counter() - start
+        warm = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(session)
+            warm.append(time.perf_counter() - start)
+    finally:
+        session.close()
+    return rows, cold, warm
+
+
+def benchmark_table(engine, Session, name, size, density, options, rng):
+    """Load a table for one backend, size and density and run the query
+    matrix against it. Yields one result per case."""
+
+    model = make_model(name)
+    table = model.__table__
+    base = {'backend': name, 'size': size, 'density': density}
+
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    try:
+        ra, dec = sky_points(size, density, rng)
+        session = Session()
+        start = time.perf_counter()
+        model.bulk_load(session, ra, dec,
+                        extra_columns={'id': np.arange(1, size + 1)})
+        session.commit()
+        ingest = time.perf_counter() - start
+        session.close()
+        with engine.connect() as connection:
+            connection.execute(sa.text(f'ANALYZE {table.name}'))
+
+        if 'ingest' in options.queries:
+            yield dict(base, query='ingest', radius=None, rows=size,
+                       cold_s=ingest, warm_s=None, warm_min_s=None,
+                       explain=None)
+
+        probes = sky_points(max(options.probes, options.cones), density, rng)
+        for query in options.queries:
+            if query == 'ingest':
+                continue
+            radii = [None] if query in RADIUS_FREE else options.radii
+            for radius in radii:
+                def cases(session):
+                    return make_cases(session, model, probes, radius,
+                                      options)
+
+                def run(session):
+                    return cases(session)[query][0]()
+
+                rows, cold, warm = time_case(engine, Session, run,
+                                             options.repeat)
+                session = Session()
+                try:
+                    plan = plan_summary(session, cases(session)[query][1]())
+                    session.rollback()
+                finally:
+                    session.close()
+                yield dict(base, query=query, radius=radius, rows=rows,
+                           cold_s=cold, warm_s=statistics.median(warm),
+                           warm_min_s=min(warm), explain=plan)
+    finally:
+        if not options.keep_tables:
+            table.drop(engine, checkfirst=True)
+
+
+def metadata(engine, options):
+    """Describe the environment of a run, so results can be reproduced."""
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    with engine.connect() as connection:
+        server = connection.execute(sa.text('SELECT version()')).scalar()
+        extensions = dict(connection.execute(sa.text(
+            'SELECT extname, extversion FROM pg_extension'
+        )).fetchall())
+
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlalchemy': sa.__version__,
+        'numpy': np.__version__,
+        'server': server,
+        'extensions': extensions,
+        'options': {k: v for k, v in vars(options).items()
+                    if k not in ('url', 'baseline', 'output')},
+    }
+
+
+def result_key(result):
+    return '{backend}/{size}/{density}/{query}/{radius}'.format(**result)
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE,
+            min_delta=MIN_REGRESSION_DELTA):
+    """Compare results against those of a baseline run.
+
+    Returns
+    -------
+
+    regressions: list of dict
+       The cases whose warm time (or cold time, for ingest) grew by more
+       than a fraction `tolerance` and more than `min_delta` seconds.
+    """
+
+    previous = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None or 'error' in result or 'error' in old:
+            continue
+        field = 'cold_s' if result['warm_s'] is None else 'warm_s'
+        new_t, old_t = result[field], old[field]
+        if new_t > old_t * (1 + tolerance) and new_t - old_t > min_delta:
+            regressions.append({'case': result_key(result), 'field': field,
+                                'baseline_s': old_t, 'current_s': new_t,
+                                'ratio': new_t / old_t})
+    return regressions
+
+
+def parse_args(argv=None):
+    def floats(s):
+        return [float(v) for v in s.split(',')]
+
+    def ints(s):
+        return [int(v) for v in s.split(',')]
+
+    def names(choices):
+        def parse(s):
+            values = s.split(',')
+            unknown = set(values) - set(choices)
+            if unknown:
+                raise argparse.ArgumentTypeError(
+                    f'unknown values {sorted(unknown)}, choose from '
+                    f'{list(choices)}'
+                )
+            return values
+        return parse
+
+    p = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark the skyportal_spatial backends.'
+    )
+    p.add_argument('--url', help='database URL (default: the test config)')
+    p.add_argument('--backends', type=names(BACKENDS), default=list(BACKENDS))
+    p.add_argument('--sizes', type=ints, default=DEFAULT_SIZES)
+    p.add_argument('--radii', type=floats, default=DEFAULT_RADII,
+                   help='search radii in arcsec')
+    p.add_argument('--densities', type=names(DENSITIES), default=DENSITIES)
+    p.add_argument('--queries', type=names(QUERIES), default=QUERIES)
+    p.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                   help='warm runs per case')
+    p.add_argument('--probes', type=int, default=DEFAULT_PROBES,
+                   help='positions per cone and knn case')
+    p.add_argument('--cones', type=int, default=DEFAULT_CONES,
+                   help='cones per multi-cone query')
+    p.add_argument('--join-rows', type=int, default=DEFAULT_JOIN_ROWS,
+                   help='rows on the outer side of the join')
+    p.add_argument('--k', type=int, default=DEFAULT_K,
+                   help='neighbours per knn query')
+    p.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    p.add_argument('--output', default='bench_results.json')
+    p.add_argument('--baseline', help='results of a previous run to compare '
+                                      'against')
+    p.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                   help='fractional slowdown flagged as a regression')
+    p.add_argument('--keep-tables', action='store_true')
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    engine = sa.create_engine(options.url or database_url(),
+                              client_encoding='utf8')
+    Session = sessionmaker(bind=engine)
+
+    results = []
+    for name in options.backends:
+        for size in options.sizes:
+            for density in options.densities:
+                # the same catalog and probes for every backend
+                rng = np.random.RandomState(options.seed)
+                try:
+                    for result in benchmark_table(engine, Session, name,
+                                                  size, density, options,
+                                                  rng):
+                        print(f'{result_key(result)}: {result["rows"]} rows, '
+                              f'cold {result["cold_s"]:.3e} s, warm '
+                              f'{result["warm_s"] or float("nan"):.3e} s')
+                        results.append(result)
+                except sa.exc.DBAPIError as e:
+                    # e.g. the extension the backend needs is missing
+                    print(f'{name}/{size}/{density}: failed: {e.orig}',
+                          file=sys.stderr)
+                    results.append({'backend': name, 'size': size,
+                                    'density': density, 'query': None,
+                                    'radius': None, 'error': str(e.orig)})
+
+    output = {'metadata': metadata(engine, options), 'results': results}
+    with open(options.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    print(f'wrote {len(results)} results to {options.output}')
+
+    if baseline is None:
+        return 0
+    regressions = compare(results, baseline, options.tolerance)
+    for r in regressions:
+        print(f'REGRESSION {r["case"]}: {r["baseline_s"]:.3e} s -> '
+              f'{r["current_s"]:.3e} s ({r["ratio"]:.2f}x)')
+    return 1 if regressions else 0
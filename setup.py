@@ -2,12 +2,13 @@ from setuptools import setup
 
 setup(
     name='skyportal_spatial', version='0.1.0',
-    install_requires=['sqlalchemy>=1.2.8',
+    install_requires=['sqlalchemy>=1.3.11',
                       'pytest>=3.3.0',
                       'numpy>=1.12.0',
                       'astropy>=4.0.0',
                       'pyyaml>=5.0.0',
                       'psycopg2>=2.5.3',
                       'scipy>=1.0.0'],
+    extras_require={'asyncio': ['sqlalchemy>=1.4', 'asyncpg']},
     packages=['skyportal_spatial']
 )
@@ -1,3 +1,14 @@
 from .none import UnindexedSpatialBackend
 from .q3c import Q3CSpatialBackend
 from .postgis import PostGISSpatialBackend
+from .postgis3d import PostGIS3DSpatialBackend
+from .healpix import HealpixSpatialBackend
+from .match import crossmatch, best_match
+from .plans import explain, IndexNotUsedError
+from .stream import stream_within
+from .parallel import parallel_crossmatch
+from .migrate import (migrate_backend, finish_migration,
+                      create_indexes_concurrently)
+from .cache import ConeCache
+from .mirror import SpatialMirror
+from . import instrument, aio
@@ -0,0 +1,253 @@
+"""Spatial queries for SQLAlchemy's asyncio extension.
+
+The backends build the same clauses for `AsyncSession` as for `Session`;
+these helpers execute the common searches on an `AsyncSession` and return
+their results as numpy record arrays, so that a service can await many
+independent searches concurrently:
+
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.orm import sessionmaker
+
+    engine = create_async_engine('postgresql+asyncpg://...', pool_size=10)
+    Session = sessionmaker(engine, class_=AsyncSession)
+
+    async with Session() as session:
+        sources = await cone_search(session, Object, ra, dec, 5.)
+    results = await cone_search_many(Session, Object, ras, decs, 5.,
+                                     max_concurrency=10)
+
+An `AsyncSession` runs one statement at a time, so the helpers that fan
+out take a session factory and open a session per query. The queries are
+handed out to `max_concurrency` workers, each running one at a time, so
+a burst of searches neither exhausts the connection pool nor queues
+behind its timeout, and a query is only built once a worker is free.
+"""
+
+import asyncio
+
+import numpy as np
+
+from .bulk import check_coordinates
+from .match import separation_arcsec
+from .stream import id_column
+
+
+# the record types of the results of `cone_search` and `crossmatch_many`
+CONE_DTYPE = np.dtype([('id', 'i8'), ('ra', 'f8'), ('dec', 'f8'),
+                       ('separation', 'f8')])
+MATCH_DTYPE = np.dtype([('center_index', 'i8'), ('id', 'i8'),
+                        ('separation', 'f8')])
+
+DEFAULT_MAX_CONCURRENCY = 10
+
+# cones per statement of `crossmatch_many`
+DEFAULT_CONES_PER_QUERY = 1000
+
+
+def _check_concurrency(max_concurrency):
+    if max_concurrency < 1:
+        raise ValueError('`max_concurrency` must be positive.')
+
+
+async def _run_bounded(session_factory, searches, count, max_concurrency):
+    """Run `count` searches, each called as `search(session)` on a new
+    session, with at most `max_concurrency` in flight, and return their
+    results in order. The iterable `searches` is consumed by the workers as
+    they become free, so it can be a generator."""
+
+    results = [None] * count
+    pending = enumerate(searches)
+
+    async def worker():
+        for i, search in pending:
+            async with session_factory() as session:
+                results[i] = await search(session)
+
+    await asyncio.gather(*[worker()
+                           for _ in range(min(max_concurrency, count))])
+    return results
+
+
+async def cone_search(session, cls, ra, dec, angular_sep_arcsec, *criteria):
+    """Find the objects within `angular_sep_arcsec` of a position.
+
+    Parameters
+    ----------
+
+    session: sqlalchemy.ext.asyncio.AsyncSession
+       The session to query with.
+
+    cls: mapped class using one of the spatial backends
+       The table to search, which must have a single primary key column.
+
+    ra, dec: float
+       The icrs coordinates of the center in degrees.
+
+    angular_sep_arcsec: float
+       The radius of the search in arcseconds.
+
+    *criteria: sqlalchemy clause elements
+       Extra filters on `cls`.
+
+    Returns
+    -------
+
+    objects: numpy.ndarray
+       A record array with fields `id` (the primary key), `ra`, `dec` and
+       `separation` (from the center, in arcseconds), closest first.
+    """
+
+    center = cls(ra=ra, dec=dec)
+    separation = cls.distance(center)
+    result = await session.execute(
+        session.sync_session.query(
+            id_column(cls), cls.ra, cls.dec, separation
+        ).filter(
+            cls.radially_within(center, angular_sep_arcsec), *criteria
+        ).order_by(separation).statement
+    )
+    return np.array([tuple(row) for row in result.all()], dtype=CONE_DTYPE)
+
+
+async def cone_search_many(session_factory, cls, ra, dec, angular_sep_arcsec,
+                           *criteria, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Run a `cone_search` around each of many positions concurrently, each
+    on its own session.
+
+    Parameters
+    ----------
+
+    session_factory: callable
+       Returns a new `AsyncSession`, e.g. a `sessionmaker` with
+       `class_=AsyncSession`. Its engine's pool should hold at least
+       `max_concurrency` connections.
+
+    cls: mapped class using one of the spatial backends
+       The table to search.
+
+    ra, dec: array-like
+       The icrs coordinates of the centers in degrees.
+
+    angular_sep_arcsec: float or array-like
+       The radius, in arcseconds, of every cone or of each cone.
+
+    *criteria: sqlalchemy clause elements
+       Extra filters on `cls`, applied to every cone.
+
+    max_concurrency: int
+       The largest number of searches in flight at once.
+
+    Returns
+    -------
+
+    results: list of numpy.ndarray
+       The `cone_search` result of each center, in the order of `ra` and
+       `dec`.
+    """
+
+    _check_concurrency(max_concurrency)
+    ra, dec = check_coordinates(ra, dec)
+    radius = np.asarray(angular_sep_arcsec, dtype=float)
+    try:
+        radius = np.broadcast_to(radius, ra.shape)
+    except ValueError:
+        raise ValueError('`angular_sep_arcsec` must be a scalar or have the '
+                         'same length as `ra` and `dec`.')
+
+    def search(r, d, sep):
+        return lambda session: cone_search(session, cls, r, d, sep,
+                                           *criteria)
+
+    searches = (search(float(r), float(d), float(sep))
+                for r, d, sep in zip(ra, dec, radius))
+    return await _run_bounded(session_factory, searches, len(ra),
+                              max_concurrency)
+
+
+async def crossmatch_many(session_factory, cls, ra, dec, angular_sep_arcsec,
+                          max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                          cones_per_query=DEFAULT_CONES_PER_QUERY):
+    """Match many positions against a table, such as the sources of an
+    alert packet against a catalog.
+
+    The cones are split into batches of `cones_per_query`, each searched in
+    a single statement with the backend's `radially_within_any`, and the
+    batches are run concurrently, each on its own session.
+
+    Parameters
+    ----------
+
+    session_factory: callable
+       Returns a new `AsyncSession`. Its engine's pool should hold at least
+       `max_concurrency` connections.
+
+    cls: mapped class using one of the spatial backends
+       The table to match against, which must have a single primary key
+       column.
+
+    ra, dec: array-like
+       The icrs coordinates of the positions in degrees.
+
+    angular_sep_arcsec: float or array-like
+       The radius, in arcseconds, of every cone or of each cone.
+
+    max_concurrency: int
+       The largest number of statements in flight at once.
+
+    cones_per_query: int
+       The number of cones searched by each statement.
+
+    Returns
+    -------
+
+    matches: numpy.ndarray
+       A record array with fields `center_index` (the position of the cone
+       in `ra` and `dec`), `id` (the primary key of the matching object)
+       and `separation` (in arcseconds), sorted by `center_index` then
+       `id`.
+    """
+
+    _check_concurrency(max_concurrency)
+    if cones_per_query < 1:
+        raise ValueError('`cones_per_query` must be positive.')
+    ra, dec = check_coordinates(ra, dec)
+    radius = np.asarray(angular_sep_arcsec, dtype=float)
+    try:
+        radius = np.broadcast_to(radius, ra.shape)
+    except ValueError:
+        raise ValueError('`angular_sep_arcsec` must be a scalar or have the '
+                         'same length as `ra` and `dec`.')
+
+    def search(start):
+        stop = start + cones_per_query
+
+        async def run(session):
+            query = cls.radially_within_any(
+                session.sync_session, ra[start:stop], dec[start:stop],
+                radius[start:stop]
+            )
+            index = query.column_descriptions[0]['expr']
+            result = await session.execute(query.with_entities(
+                index, id_column(cls), cls.ra, cls.dec
+            ).statement)
+            rows = result.all()
+            matches = np.zeros(len(rows), dtype=MATCH_DTYPE)
+            if rows:
+                i, ids, mra, mdec = map(np.asarray, zip(*rows))
+                matches['center_index'] = i + start
+                matches['id'] = ids
+                matches['separation'] = separation_arcsec(
+                    ra[i + start], dec[i + start], mra.astype(float),
+                    mdec.astype(float)
+                )
+            return matches
+
+        return run
+
+    starts = range(0, len(ra), cones_per_query)
+    batches = await _run_bounded(session_factory, map(search, starts),
+                                 len(starts), max_concurrency)
+
+    matches = (np.concatenate(batches) if batches
+               else np.zeros(0, dtype=MATCH_DTYPE))
+    return matches[np.lexsort((matches['id'], matches['center_index']))]
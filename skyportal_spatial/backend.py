@@ -0,0 +1,243 @@
+import sqlalchemy as sa
+from astropy.coordinates import SkyCoord
+from sqlalchemy.ext.hybrid import hybrid_method
+
+from .bulk import copy_arrays, check_coordinates, DEFAULT_CHUNK_SIZE
+from .pixels import spatial_order
+from .moc import moc_cones, cells_clause, iter_within_moc_cones, \
+    DEFAULT_MOC_BATCH
+from .util import coordinate_arrays, nearest_query, cluster_table
+
+
+class SpatialBackendMixin(object):
+    """Methods that the spatial backends share, built on the `distance`,
+    `radially_within` and `radially_within_any` that each implements with
+    its own index. A backend overrides them where its index can do better.
+    """
+
+    # called with (target, other), returns an expression that orders
+    # nearest neighbour candidates by distance with the index, if the
+    # backend's index can do that
+    _nearest_order = None
+
+    @classmethod
+    def coordinates(cls, objects):
+        """Return the coordinates of many objects as numpy arrays.
+
+        Parameters
+        ----------
+
+        objects: sqlalchemy.orm.Query or iterable of instances
+           The objects. A query is run selecting only their ra and dec, so
+           no objects are loaded into the session.
+
+        Returns
+        -------
+
+        ra, dec: numpy.ndarray
+           The icrs coordinates of the objects in degrees.
+        """
+        return coordinate_arrays(cls, objects)
+
+    @classmethod
+    def skycoords(cls, objects):
+        """Return the coordinates of many objects as a single array-valued
+        astropy.coordinates.SkyCoord, which is much faster than building
+        one per object with `skycoord`.
+
+        Parameters
+        ----------
+
+        objects: sqlalchemy.orm.Query or iterable of instances
+           The objects. A query is run selecting only their ra and dec, so
+           no objects are loaded into the session.
+        """
+        ra, dec = coordinate_arrays(cls, objects)
+        return SkyCoord(ra, dec, unit='deg')
+
+    @classmethod
+    def _cluster_order(cls):
+        """Return the name of the index to cluster the table on, or None and
+        an SQL expression to cluster it on through a temporary index."""
+        raise NotImplementedError
+
+    @classmethod
+    def cluster_spatially(cls, session):
+        """Physically reorder the table by sky position with CLUSTER, along
+        the space filling curve of the backend's index (or of a temporary
+        one), so that the rows a cone search returns share heap pages. The
+        table is locked exclusively while it is rewritten, and rows written
+        later are not kept in order, so run this as periodic maintenance.
+        The statements run in the session's transaction; commit it to
+        persist the new order.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to cluster the table with.
+        """
+
+        index, key = cls._cluster_order()
+        cluster_table(session, cls.__table__, index=index, key=key)
+
+    @classmethod
+    def _copy_columns(cls, ra, dec):
+        """Encode the coordinates for `bulk_load`, as a mapping from column
+        name to an array of the binary COPY dtype of the column. Generated
+        columns are left for postgres to fill in."""
+        return {'ra': ra.astype('>f8'), 'dec': dec.astype('>f8')}
+
+    @classmethod
+    def bulk_load(cls, session, ra, dec, extra_columns=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE, sort=False):
+        """Insert many objects at once by streaming their coordinates, in
+        the columns the backend stores them in, into the table with
+        PostgreSQL binary COPY. This bypasses the ORM, so it is much faster
+        than `session.add_all` for large catalogs. The rows are written on
+        the session's current connection and become part of its
+        transaction; commit the session to persist them.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to load the objects with.
+
+        ra, dec: array-like
+           The icrs right ascensions and declinations of the objects in
+           degrees.
+
+        extra_columns: dict, optional
+           Mapping from the names of other (integer, floating point or
+           boolean) columns of the table to arrays of values, one per object.
+           Explicit values of a serial or identity column, such as the
+           primary key, advance its sequence past the largest of them.
+
+        chunk_size: int
+           Number of rows to encode at a time.
+
+        sort: bool
+           If True, write the rows in the order of their HEALPix indices
+           rather than in the order given, so that objects close on the sky
+           are stored close together and cone searches read fewer pages.
+
+        Returns
+        -------
+
+        nrows: int
+           The number of rows inserted.
+        """
+
+        ra, dec = check_coordinates(ra, dec)
+        order = spatial_order(ra, dec) if sort else None
+        return copy_arrays(session, cls.__table__, cls._copy_columns(ra, dec),
+                           extra_columns=extra_columns, chunk_size=chunk_size,
+                           order=order)
+
+    @hybrid_method
+    def within_moc(self, moc):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a multi-order coverage map.
+
+        Each cell of the MOC is searched as the cone that circumscribes it,
+        with `radially_within`, so that the index serves the query, and the
+        rows found are cut exactly on the HEALPix pixel that contains them,
+        computed in SQL. The clause grows with the number of cells; use
+        `iter_within_moc` for large maps.
+
+        Parameters
+        ----------
+
+        moc: dict or mocpy.MOC
+           A mapping from order to the nested indices of the cells of that
+           order, or an object with a `to_depth29_ranges` attribute, such as
+           a `mocpy.MOC`.
+        """
+
+        orders, ipix, ra, dec, radius = moc_cones(moc)
+        if len(ipix) == 0:
+            return sa.false()
+        cls = sa.inspect(self).mapper.class_
+        cones = [self.radially_within(cls(ra=r, dec=d), sep)
+                 for r, d, sep in zip(ra, dec, radius)]
+        return sa.and_(sa.or_(*cones),
+                       cells_clause(self.ra, self.dec, orders, ipix))
+
+    @classmethod
+    def iter_within_moc(cls, session, moc, batch_size=DEFAULT_MOC_BATCH,
+                        yield_per=1000):
+        """Stream the objects inside a multi-order coverage map, for maps
+        too large to send as a single clause. Each cell of the MOC is
+        searched as the cone that circumscribes it, in batches with
+        `radially_within_any` so that every cone is an index scan, and the
+        rows returned are cut exactly on their HEALPix index in python.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to query with.
+
+        moc: dict or mocpy.MOC
+           The coverage map, see `within_moc`.
+
+        batch_size: int
+           The number of MOC cells searched per statement.
+
+        yield_per: int
+           The number of rows fetched at a time.
+
+        Returns
+        -------
+
+        objects: generator
+           The objects inside the MOC, each once.
+        """
+        return iter_within_moc_cones(session, cls, moc, batch_size,
+                                     yield_per)
+
+    @classmethod
+    def nearest(cls, session, other, k=1, max_radius=None):
+        """Return a query for the `k` objects nearest to `other`, closest
+        first.
+
+        The PostGIS backends order the candidates with a distance operator
+        that their index serves as a k-nearest-neighbour scan, both for a
+        single position and inside the LATERAL join. The Q3C, HEALPix and
+        unindexed backends cannot order by distance with their index: around
+        an instance, without `max_radius`, the search radius is found by
+        doubling a small cone (each an index scan) until it holds `k`
+        objects, but a join without `max_radius` sorts the whole table by
+        distance for every row of `other`, so always pass `max_radius` to
+        join them.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to build the query with.
+
+        other: instance or subclass of the spatial backend
+           The position to search around. If a class (or alias), the query
+           finds the nearest objects to every row of `other` with a LATERAL
+           join; when joining a table to itself, each object is its own
+           nearest neighbour.
+
+        k: int
+           The number of neighbours to return per position.
+
+        max_radius: float, optional
+           Only consider objects within this many arcseconds.
+
+        Returns
+        -------
+
+        query: sqlalchemy.orm.Query
+           If `other` is an instance, a query of `(object, distance)` rows.
+           If it is a class, a query of `(other_object, object, distance)`
+           rows, with up to `k` rows per row of `other`. Distances are in
+           arcseconds.
+        """
+        return nearest_query(session, cls, other, k, cls._nearest_order,
+                             max_radius)
@@ -0,0 +1,208 @@
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as psql
+
+
+# binary COPY framing, see the file formats section of the COPY docs
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8  # signature, flags, ext
+PGCOPY_TRAILER = b'\xff\xff'
+
+DEFAULT_CHUNK_SIZE = 100000
+
+# little-endian EWKB point with an SRID, as accepted by geography_recv
+EWKB_POINT_DTYPE = np.dtype([('order', 'u1'), ('type', '<u4'),
+                             ('srid', '<u4'), ('x', '<f8'), ('y', '<f8')])
+EWKB_POINT_SRID_TYPE = 0x20000001
+WGS84_SRID = 4326
+
+
+def copy_dtype(coltype):
+    """Return the big-endian NumPy dtype that matches the PostgreSQL binary
+    COPY representation of the SQLAlchemy column type `coltype`."""
+
+    if isinstance(coltype, sa.BigInteger):
+        return np.dtype('>i8')
+    elif isinstance(coltype, sa.SmallInteger):
+        return np.dtype('>i2')
+    elif isinstance(coltype, sa.Integer):
+        return np.dtype('>i4')
+    elif isinstance(coltype, psql.REAL):
+        return np.dtype('>f4')
+    elif isinstance(coltype, sa.Float):
+        return np.dtype('>f8')
+    elif isinstance(coltype, sa.Boolean):
+        return np.dtype('?')
+    raise TypeError(f'Columns of type {coltype!r} cannot be bulk loaded; '
+                    f'only integer, floating point and boolean columns are '
+                    f'supported.')
+
+
+def encode_column(column, values):
+    """Encode the array-like `values` of the table column `column` with its
+    binary COPY dtype, making sure integers fit in it rather than letting
+    them wrap around."""
+
+    dtype = copy_dtype(column.type)
+    values = np.atleast_1d(np.asarray(values))
+    if dtype.kind == 'i' and len(values):
+        info = np.iinfo(dtype)
+        if values.min() < info.min or values.max() > info.max:
+            raise ValueError(f'Values of column "{column.name}" must be '
+                             f'between {info.min} and {info.max}.')
+    return values.astype(dtype)
+
+
+def ewkb_points(lon, lat):
+    """Encode arrays of longitudes and latitudes (degrees) as an array of
+    EWKB points with SRID 4326."""
+
+    points = np.empty(len(lon), dtype=EWKB_POINT_DTYPE)
+    points['order'] = 1
+    points['type'] = EWKB_POINT_SRID_TYPE
+    points['srid'] = WGS84_SRID
+    points['x'] = lon
+    points['y'] = lat
+    return points
+
+
+def check_coordinates(ra, dec):
+    """Coerce `ra` and `dec` to float arrays and make sure they are finite,
+    in range and of the same length."""
+
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+    if ra.shape != dec.shape or ra.ndim != 1:
+        raise ValueError('`ra` and `dec` must be one dimensional arrays of '
+                         'the same length.')
+    if not (np.isfinite(ra).all() and np.isfinite(dec).all()):
+        raise ValueError('`ra` and `dec` must be finite.')
+    if (np.abs(dec) > 90).any():
+        raise ValueError('`dec` must be between -90 and 90 degrees.')
+    return ra, dec
+
+
+class _ChunkReader(object):
+    """File-like object that lazily concatenates the byte strings produced by
+    an iterable, so that COPY can stream them without materializing the whole
+    payload in memory."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+        self._pos = 0
+
+    def read(self, size=-1):
+        while self._pos >= len(self._buf):
+            try:
+                self._buf = next(self._chunks)
+            except StopIteration:
+                return b''
+            self._pos = 0
+        end = len(self._buf) if size is None or size < 0 else self._pos + size
+        out = self._buf[self._pos:end]
+        self._pos += len(out)
+        return out
+
+
+def _encode(columns, chunk_size):
+    names = list(columns)
+    nrows = len(columns[names[0]]) if names else 0
+
+    fields = [('nfields', '>i2')]
+    for i, name in enumerate(names):
+        fields.append((f'len{i}', '>i4'))
+        fields.append((f'val{i}', columns[name].dtype))
+    dtype = np.dtype(fields)
+
+    yield PGCOPY_HEADER
+    for start in range(0, nrows, chunk_size):
+        stop = min(start + chunk_size, nrows)
+        rec = np.empty(stop - start, dtype=dtype)
+        rec['nfields'] = len(names)
+        for i, name in enumerate(names):
+            rec[f'len{i}'] = columns[name].dtype.itemsize
+            rec[f'val{i}'] = columns[name][start:stop]
+        yield rec.tobytes()
+    yield PGCOPY_TRAILER
+
+
+def copy_arrays(session, table, columns, extra_columns=None,
+                chunk_size=DEFAULT_CHUNK_SIZE, order=None):
+    """Stream arrays into `table` using PostgreSQL binary COPY on the
+    connection `session` is currently using, so the load is part of the
+    session's transaction.
+
+    Parameters
+    ----------
+
+    session: sqlalchemy.orm.Session
+       The session whose connection should run the COPY.
+
+    table: sqlalchemy.Table
+       The table to load into.
+
+    columns: dict
+       Mapping from column name to an array that is already encoded with its
+       binary COPY dtype (see `copy_dtype`).
+
+    extra_columns: dict, optional
+       Mapping from column name to array-like. These are encoded according
+       to the type of the corresponding column of `table`. The sequences of
+       serial or identity columns among them are advanced past the largest
+       value loaded.
+
+    chunk_size: int
+       Number of rows to encode at a time.
+
+    order: array-like, optional
+       A permutation of the rows to write them in, e.g. to sort them by
+       sky position.
+
+    Returns
+    -------
+
+    nrows: int
+       The number of rows loaded.
+    """
+
+    columns = dict(columns)
+    for name, values in (extra_columns or {}).items():
+        if name not in table.c:
+            raise ValueError(f'Table "{table.name}" has no column "{name}".')
+        columns[name] = encode_column(table.c[name], values)
+
+    lengths = set(len(v) for v in columns.values())
+    if len(lengths) > 1:
+        raise ValueError('All columns must have the same length.')
+    nrows = lengths.pop() if lengths else 0
+    if nrows == 0:
+        return 0
+    if order is not None:
+        columns = {name: values[order] for name, values in columns.items()}
+
+    connection = session.connection()
+    preparer = connection.dialect.identifier_preparer
+    collist = ', '.join(preparer.quote(name) for name in columns)
+    sql = (f'COPY {preparer.format_table(table)} ({collist}) '
+           f'FROM STDIN WITH (FORMAT binary)')
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(sql, _ChunkReader(_encode(columns, chunk_size)),
+                           size=1 << 20)
+    finally:
+        cursor.close()
+
+    # explicit values do not advance the sequence of a serial column, so
+    # later inserts would collide with them
+    for name in extra_columns or {}:
+        if columns[name].dtype.kind != 'i':
+            continue
+        connection.execute(sa.text(
+            'SELECT setval(seq, :value) FROM (SELECT CAST('
+            'pg_get_serial_sequence(:table, :column) AS regclass) AS seq) s '
+            'WHERE seq IS NOT NULL '
+            'AND coalesce(pg_sequence_last_value(seq), 0) < :value'
+        ), table=preparer.format_table(table), column=name,
+            value=int(columns[name].max()))
+    return nrows
@@ -0,0 +1,368 @@
+"""An opt-in, in-process cache of cone search results.
+
+Identical cone searches, such as a source page reloaded or the same field
+opened by many users, are answered from memory instead of postgres:
+
+    from skyportal_spatial.cache import ConeCache
+
+    cache = ConeCache(max_bytes=64 * 2**20, precision_arcsec=1.)
+    objects = cache.radially_within(session, Object, position, 5.)
+    cache.stats()['hits']
+
+Each search is keyed on the table, its center snapped to a grid of
+`precision_arcsec`, its radius and any extra filters. A miss reads the
+cone around the snapped center, widened by the precision, so that the
+cached rows contain the exact result of every search that shares the key,
+which is then selected in python. Entries are evicted least recently used
+first to stay within a byte budget. Whenever the ORM inserts, updates or
+deletes a row that lies inside an entry, the entry is dropped when the
+session flushes, and again when it commits, since another session may have
+cached the rows it read in between; for the same reason, a miss is not
+stored if its table was written while it was read. `Query.update` and
+`Query.delete` drop every entry of their table in the same way.
+
+Writes that bypass the session altogether, such as the backends'
+`bulk_load`, raw SQL or other processes, are not seen by the cache; call
+`ConeCache.invalidate(cls)` after them.
+"""
+
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .match import separation_arcsec
+
+
+DEGREES_PER_ARCSEC = 1 / 3600.
+
+DEFAULT_CACHE_BYTES = 64 * 2**20
+DEFAULT_PRECISION_ARCSEC = 1.
+
+
+def _nbytes(values):
+    """Estimate the memory held by the column values of one row."""
+    return sys.getsizeof(values) + sum(sys.getsizeof(v)
+                                       for v in values.values())
+
+
+class _Entry(object):
+
+    def __init__(self, table, ra, dec, radius, rows, coordinates):
+        self.table = table
+        self.ra = ra
+        self.dec = dec
+        self.radius = radius
+        self.rows = rows
+        self.coordinates = coordinates
+        self.nbytes = (sum(_nbytes(r) for r in rows) + sys.getsizeof(rows) +
+                       sum(c.nbytes for c in coordinates))
+
+    def contains(self, ra, dec):
+        return np.any(separation_arcsec(self.ra, self.dec, ra, dec) <=
+                      self.radius)
+
+
+def _instance(cls, values):
+    """Return a detached instance of `cls` with the given column values,
+    which it holds as if loaded from the database."""
+    obj = cls.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(obj, key, value)
+    return obj
+
+
+def _positions(obj, session):
+    """Return the positions of `obj` before and after the flush, in which
+    it is new, dirty or deleted; None stands for a position that is not
+    known."""
+
+    state = sa.inspect(obj)
+    before, after = {}, {}
+    for prop in state.mapper.column_attrs:
+        history = state.attrs[prop.key].history
+        if history.added or history.unchanged:
+            after[prop.key] = (history.added or history.unchanged)[0]
+        if history.deleted or history.unchanged:
+            before[prop.key] = (history.deleted or history.unchanged)[0]
+
+    # read the coordinates through the class, whatever columns its backend
+    # stores them in
+    positions = []
+    for values in [after] if obj in session.new else [after, before]:
+        try:
+            view = _instance(type(obj), values)
+            position = (view.ra, view.dec)
+        except Exception:
+            position = (None, None)
+        positions.append(None if None in position else position)
+    return positions
+
+
+class ConeCache(object):
+    """A least recently used cache of `radially_within` results, invalidated
+    by the writes of the sessions it listens to.
+
+    Parameters
+    ----------
+
+    max_bytes: int
+       The approximate memory budget of the cached rows, in bytes.
+
+    precision_arcsec: float
+       The spacing, in arcseconds, of the grid search centers are snapped
+       to. Searches whose centers snap to the same point share an entry,
+       which holds a cone wider by this amount.
+
+    target: sqlalchemy.orm.Session, sessionmaker or the Session class
+       The sessions whose writes invalidate the cache. By default, every
+       session. Writes that do not go through a session, including
+       `bulk_load`, must be followed by a call to `invalidate`.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES,
+                 precision_arcsec=DEFAULT_PRECISION_ARCSEC,
+                 target=sa.orm.Session):
+
+        if max_bytes < 0:
+            raise ValueError('`max_bytes` must not be negative.')
+        if precision_arcsec <= 0:
+            raise ValueError('`precision_arcsec` must be positive.')
+
+        self.max_bytes = max_bytes
+        self.precision_arcsec = precision_arcsec
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._counts = dict.fromkeys(
+            ('hits', 'misses', 'evictions', 'invalidations'), 0
+        )
+
+        # the positions, by table, that each session has written in its
+        # current transaction; its reads are not cached, and the entries
+        # around the positions are dropped again when it commits
+        self._written = weakref.WeakKeyDictionary()
+
+        # counts of the invalidations of each table, and of every table
+        # under None; a miss whose table was invalidated while it queried
+        # is not stored, as it may hold rows that were just overwritten
+        self._generations = {}
+
+        self._target = target
+        self._listeners = [
+            ('after_flush', self._after_flush),
+            ('after_bulk_update', self._after_bulk),
+            ('after_bulk_delete', self._after_bulk),
+            ('after_commit', self._after_commit),
+            ('after_rollback', self._after_rollback),
+        ]
+        for name, listener in self._listeners:
+            sa.event.listen(target, name, listener)
+
+    def close(self):
+        """Stop listening to the sessions and drop every entry."""
+        if self._target is None:
+            return
+        for name, listener in self._listeners:
+            sa.event.remove(self._target, name, listener)
+        self._target = None
+        self.invalidate()
+
+    def _key(self, session, cls, ra, dec, angular_sep_arcsec, criteria):
+        step = self.precision_arcsec * DEGREES_PER_ARCSEC
+        cell_ra = int(np.round(ra / step)) % int(np.round(360. / step))
+        cell_dec = int(np.round(dec / step))
+
+        dialect = session.get_bind().dialect
+        filters = []
+        for criterion in criteria:
+            compiled = criterion.compile(dialect=dialect)
+            filters.append((str(compiled), tuple(sorted(
+                (k, repr(v)) for k, v in compiled.params.items()
+            ))))
+
+        key = (cls.__table__.name, cell_ra, cell_dec,
+               float(angular_sep_arcsec), tuple(filters))
+        return key, cell_ra * step, cell_dec * step
+
+    def _load(self, session, cls, rows):
+        """Return instances of `cls` in `session` for cached rows."""
+        objects = []
+        for values in rows:
+            obj = _instance(cls, values)
+            sa.orm.make_transient_to_detached(obj)
+            objects.append(session.merge(obj, load=False))
+        return objects
+
+    def radially_within(self, session, cls, other, angular_sep_arcsec,
+                        *criteria):
+        """Return the objects of `cls` within `angular_sep_arcsec` of
+        `other`, from the cache if the same search was made before.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session or scoped_session
+           The session to query with, and to which the returned objects
+           belong.
+
+        cls: mapped class using one of the spatial backends
+           The table to search. The column attributes of its objects are
+           cached, and the objects are rebuilt from them.
+
+        other: object with `ra` and `dec` attributes
+           The center of the search, in degrees.
+
+        angular_sep_arcsec: float
+           The radius of the search, in arcseconds.
+
+        *criteria: sqlalchemy clause elements
+           Extra filters on `cls`, which are part of the cache key.
+
+        Returns
+        -------
+
+        objects: list of `cls`
+           The matching objects, in no particular order.
+        """
+
+        if isinstance(session, sa.orm.scoped_session):
+            # the writes are recorded against the session itself
+            session = session()
+
+        ra, dec = float(other.ra), float(other.dec)
+        key, center_ra, center_dec = self._key(
+            session, cls, ra, dec, angular_sep_arcsec, criteria
+        )
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counts['hits'] += 1
+            else:
+                self._counts['misses'] += 1
+                generation = self._generation(cls.__table__.name)
+
+        if entry is None:
+            radius = angular_sep_arcsec + self.precision_arcsec
+            center = cls(ra=center_ra, dec=center_dec)
+            objects = session.query(cls).filter(
+                cls.radially_within(center, radius), *criteria
+            ).all()
+            keys = [prop.key for prop in cls.__mapper__.column_attrs]
+            rows = [{k: getattr(obj, k) for k in keys} for obj in objects]
+            coordinates = (np.array([o.ra for o in objects], dtype=float),
+                           np.array([o.dec for o in objects], dtype=float))
+            entry = _Entry(cls.__table__.name, center_ra, center_dec,
+                           radius, rows, coordinates)
+            if session not in self._written:
+                self._store(key, entry, generation)
+        else:
+            objects = None
+
+        ras, decs = entry.coordinates
+        within = separation_arcsec(ra, dec, ras, decs) <= angular_sep_arcsec
+        if objects is None:
+            return self._load(session, cls, [r for r, w in
+                                             zip(entry.rows, within) if w])
+        return [obj for obj, w in zip(objects, within) if w]
+
+    def _generation(self, table):
+        return self._generations.get(None, 0), self._generations.get(table, 0)
+
+    def _bump(self, table):
+        self._generations[table] = self._generations.get(table, 0) + 1
+
+    def _store(self, key, entry, generation):
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if self._generation(entry.table) != generation:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._nbytes -= previous.nbytes
+            self._entries[key] = entry
+            self._nbytes += entry.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self._counts['evictions'] += 1
+
+    def invalidate(self, cls=None):
+        """Drop the entries of `cls`, or every entry if `cls` is None."""
+        table = None if cls is None else cls.__table__.name
+        with self._lock:
+            self._bump(table)
+            for key, entry in list(self._entries.items()):
+                if table is None or entry.table == table:
+                    self._drop(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._nbytes -= entry.nbytes
+        self._counts['invalidations'] += 1
+
+    def _invalidate_written(self, written):
+        """Drop the entries containing any of the positions `written`, a
+        mapping from table name to positions, where None stands for
+        anywhere in the table."""
+        with self._lock:
+            for table in written:
+                self._bump(table)
+            for key, entry in list(self._entries.items()):
+                positions = written.get(entry.table, ())
+                if None in positions or any(entry.contains(*p)
+                                            for p in positions):
+                    self._drop(key)
+
+    def _record(self, session, written):
+        pending = self._written.setdefault(session, {})
+        for table, positions in written.items():
+            pending.setdefault(table, []).extend(positions)
+        self._invalidate_written(written)
+
+    def _after_flush(self, session, flush_context):
+        written = {}
+        for obj in (list(session.new) + list(session.dirty) +
+                    list(session.deleted)):
+            table = getattr(obj, '__table__', None)
+            if table is None:
+                continue
+            # the row may have moved; it affects the cones around both its
+            # old and its new position
+            written.setdefault(table.name, []).extend(
+                _positions(obj, session)
+            )
+        if written:
+            self._record(session, written)
+
+    def _after_bulk(self, context):
+        # the rows a bulk update or delete touches are not known
+        self._record(context.session,
+                     {context.mapper.local_table.name: [None]})
+
+    def _after_commit(self, session):
+        # other sessions may have cached the committed rows of the tables
+        # written since the flush
+        written = self._written.pop(session, None)
+        if written:
+            self._invalidate_written(written)
+
+    def _after_rollback(self, session):
+        self._written.pop(session, None)
+
+    def stats(self):
+        """Return the number of `hits`, `misses`, `evictions` and
+        `invalidations` so far, and the current number of `entries` and
+        their estimated size in `bytes`."""
+        with self._lock:
+            stats = dict(self._counts)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._nbytes
+            return stats
@@ -0,0 +1,389 @@
+import numpy as np
+import sqlalchemy as sa
+from astropy.coordinates import SkyCoord
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.ext.hybrid import hybrid_method
+from sqlalchemy.orm import validates
+from sqlalchemy.dialects import postgresql as psql
+
+from .bulk import check_coordinates
+from .util import array_param, is_instance
+from .regions import Polygon, Box, Ellipse
+from .instrument import instrumented
+from .propermotion import ProperMotionMixin
+from .backend import SpatialBackendMixin
+from .pixels import ang2pix, cone_ranges, DEG_TO_RAD, RADIANS_PER_ARCSEC
+from .moc import moc_ranges, DEFAULT_MOC_BATCH
+
+
+DEGREES_PER_ARCSEC = 1 / 3600.
+
+# widen join prefilter boxes slightly so rounding never drops a match
+PREFILTER_PADDING = 1 + 1e-9
+
+
+def _haversine(self, other):
+    """Great circle distance in arcsec between two objects, classes or
+    selectables with ra and dec, using the haversine formula, which unlike
+    the arccosine of a dot product is accurate at small separations."""
+
+    sdec = sa.func.sin((self.dec - other.dec) * (DEG_TO_RAD / 2))
+    sra = sa.func.sin((self.ra - other.ra) * (DEG_TO_RAD / 2))
+    a = sa.func.power(sdec, 2) + sa.func.cos(self.dec * DEG_TO_RAD) * \
+        sa.func.cos(other.dec * DEG_TO_RAD) * sa.func.power(sra, 2)
+    roundoff_safe = sa.func.least(sa.func.sqrt(a), 1)
+    return 2 * sa.func.asin(roundoff_safe) / RADIANS_PER_ARCSEC
+
+
+def _join_box(table, other, angular_sep_arcsec):
+    """Return a clause restricting the rows of `table` to the RA, dec box
+    around each row of the joined table `other`, which the (dec, ra) index
+    of `table` can serve. RA windows that cross 0/360 are split in two, and
+    around the poles the window spans every RA."""
+
+    r = angular_sep_arcsec * DEGREES_PER_ARCSEC * PREFILTER_PADDING
+    band = table.dec.between(other.dec - r, other.dec + r)
+
+    # the maximum RA offset of a point on the cone
+    halfwidth = sa.case(
+        [(sa.func.abs(other.dec) + r >= 90, 180.)],
+        else_=sa.func.degrees(sa.func.asin(
+            float(np.sin(np.radians(r))) /
+            sa.func.cos(sa.func.radians(other.dec))
+        )) * PREFILTER_PADDING
+    )
+    lo, hi = other.ra - halfwidth, other.ra + halfwidth
+    window = sa.or_(table.ra.between(lo, hi), table.ra >= lo + 360,
+                    table.ra <= hi - 360)
+    return sa.and_(band, window)
+
+
+def _cone_ranges_clause(table, ra, dec, angular_sep_arcsec):
+    """Return a clause selecting the rows of `table` in the HEALPix index
+    ranges that cover a cone, which the index on hpx serves."""
+    lo, hi = cone_ranges(ra, dec, angular_sep_arcsec)
+    return sa.or_(*[table.hpx.between(int(l), int(h))
+                    for l, h in zip(lo, hi)])
+
+
+def _within_region(table, region):
+    """Return a clause selecting the rows of `table` inside `region`, by
+    scanning the HEALPix ranges of the cap around it."""
+    cap = region.cap
+    return sa.and_(_cone_ranges_clause(table, cap.ra, cap.dec, cap.radius),
+                   region.clause(table.ra, table.dec))
+
+
+class HealpixSpatialBackend(SpatialBackendMixin, ProperMotionMixin):
+    """A mixin indicating to the database that an object has sky coordinates.
+    Classes that mix this class get a b-tree index on the nested HEALPix
+    index of ra and dec at order 29, computed in python whenever ra or dec
+    are set. No postgres extension is needed. Radial queries against a
+    position are expanded into ranges of HEALPix indices that are scanned
+    with the index and then cut exactly on the great circle distance.
+
+    Columns:
+        ra: the icrs right ascension of the object in degrees
+        dec: the icrs declination of the object in degrees
+        hpx: the nested HEALPix index of ra and dec at order 29
+    Indexes:
+        b-tree index on hpx
+        b-tree index on (dec, ra), for joins
+    Properties: skycoord: astropy.coordinates.SkyCoord representation of the
+    object's coordinate
+    """
+
+    # database-mapped
+    ra = sa.Column(psql.DOUBLE_PRECISION)
+    dec = sa.Column(psql.DOUBLE_PRECISION)
+    hpx = sa.Column(sa.BigInteger)
+
+    @validates('ra', 'dec')
+    def _update_hpx(self, key, value):
+        ra = value if key == 'ra' else self.ra
+        dec = value if key == 'dec' else self.dec
+        if ra is None or dec is None:
+            self.hpx = None
+        else:
+            self.hpx = int(ang2pix(ra, dec))
+        return value
+
+    @property
+    def skycoord(self):
+        return SkyCoord(self.ra, self.dec, unit='deg')
+
+    @declared_attr
+    def __table_args__(cls):
+        tn = cls.__tablename__
+        return (sa.Index(f'{tn}_hpx_idx', cls.hpx),
+                sa.Index(f'{tn}_dec_ra_idx', cls.dec, cls.ra))
+
+    @classmethod
+    def _cluster_order(cls):
+        """Cluster on the HEALPix index, along the nested HEALPix curve."""
+        return f'{cls.__tablename__}_hpx_idx', None
+
+    @classmethod
+    def _copy_columns(cls, ra, dec):
+        """Encode the coordinates for `bulk_load`, with their HEALPix
+        indices computed with NumPy."""
+        return {'ra': ra.astype('>f8'), 'dec': dec.astype('>f8'),
+                'hpx': ang2pix(ra, dec).astype('>i8')}
+
+    @hybrid_method
+    @instrumented('healpix', 'distance')
+    def distance(self, other):
+        """Return an SQLalchemy clause element that can be used to calculate
+        the angular separation between `self` and `other` in arcsec.
+
+        Parameters
+        ----------
+
+        other: subclass of HealpixSpatialBackend or instance of HealpixSpatialBackend
+           The class or object to query against. If a class, will generate
+           a clause element that can be used to join two tables, otherwise
+           will generate a clause element that can be used to filter a
+           single table.
+        """
+
+        return _haversine(self, other)
+
+    @hybrid_method
+    @instrumented('healpix', 'radially_within')
+    def radially_within(self, other, angular_sep_arcsec):
+        """Return an SQLalchemy clause element that can be used as a join or
+        filter condition for a radial query.
+
+        If `other` is an instance, the cone around it is expanded into
+        ranges of HEALPix indices that are scanned with the index. If it is
+        a class, the join is restricted to the box in RA and dec around each
+        row of `other`, scanned with the (dec, ra) index, and then cut on the
+        exact distance.
+
+        Parameters
+        ----------
+
+        other: subclass of HealpixSpatialBackend or instance of HealpixSpatialBackend
+           The class or object to query against. If a class, will generate
+           a clause element that can be used to join two tables, otherwise
+           will generate a clause element that can be used to filter a
+           single table.
+
+        angular_sep_arcsec:
+           The radius, in arcseconds, to use for the radial query. The
+           query will return true if two objects are within this angular
+           distance of one another.
+        """
+
+        clause = self.distance(other) <= angular_sep_arcsec
+
+        if isinstance(other, HealpixSpatialBackend):
+            table, position = self, other
+        elif isinstance(self, HealpixSpatialBackend):
+            table, position = other, self
+        else:
+            return sa.and_(_join_box(self, other, angular_sep_arcsec),
+                           clause)
+
+        # between two instances there is no index to scan
+        if position.ra is None or position.dec is None or \
+                is_instance(table):
+            return clause
+        ranges = _cone_ranges_clause(table, position.ra, position.dec,
+                                     angular_sep_arcsec)
+        return sa.and_(ranges, clause)
+
+    @hybrid_method
+    @instrumented('healpix', 'within_polygon')
+    def within_polygon(self, vertices):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a polygon. The HEALPix ranges covering the
+        cone around the polygon are scanned with the index, and the rows
+        found are cut with a crossing number test.
+
+        Parameters
+        ----------
+
+        vertices: array-like
+           A sequence of (ra, dec) pairs in degrees. The edges are great
+           circle arcs and the polygon must fit within a hemisphere.
+        """
+        return _within_region(self, Polygon(vertices))
+
+    @hybrid_method
+    @instrumented('healpix', 'within_box')
+    def within_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a box bounded by lines of constant RA and
+        dec. The HEALPix ranges covering the cone around the box are
+        scanned with the index, and the rows found are cut on the box.
+
+        Parameters
+        ----------
+
+        ra_min, ra_max: float
+           The right ascension limits in degrees. If `ra_min` is greater
+           than `ra_max` the box wraps through RA = 0.
+
+        dec_min, dec_max: float
+           The declination limits in degrees.
+        """
+        return _within_region(self, Box(ra_min, ra_max, dec_min, dec_max))
+
+    @hybrid_method
+    @instrumented('healpix', 'within_ellipse')
+    def within_ellipse(self, center, a, b, pa):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside an ellipse. The HEALPix ranges covering
+        the circle of the major axis are scanned with the index, and the
+        rows found are cut on the ellipse.
+
+        Parameters
+        ----------
+
+        center: instance of HealpixSpatialBackend or (ra, dec) pair
+           The center of the ellipse, in degrees.
+
+        a, b: float
+           The semi-major and semi-minor axes in arcseconds.
+
+        pa: float
+           The position angle of the major axis in degrees, east of north.
+        """
+        return _within_region(self, Ellipse(center, a, b, pa))
+
+    @hybrid_method
+    @instrumented('healpix', 'within_moc')
+    def within_moc(self, moc):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a multi-order coverage map. The MOC is
+        compiled into the fewest ranges of HEALPix indices, which are
+        scanned with the index; no further cut is needed.
+
+        Parameters
+        ----------
+
+        moc: dict or mocpy.MOC
+           A mapping from order to the nested indices of the cells of that
+           order, or an object with a `to_depth29_ranges` attribute, such as
+           a `mocpy.MOC`.
+        """
+
+        lo, hi = moc_ranges(moc)
+        if len(lo) == 0:
+            return sa.false()
+        return sa.or_(*[self.hpx.between(int(l), int(h))
+                        for l, h in zip(lo, hi)])
+
+    @classmethod
+    def iter_within_moc(cls, session, moc, batch_size=DEFAULT_MOC_BATCH,
+                        yield_per=1000):
+        """Stream the objects inside a multi-order coverage map, for maps
+        too large to send as a single clause. The ranges of HEALPix indices
+        of the MOC are sent in batches, as arrays, and joined against the
+        index; rows are fetched `yield_per` at a time.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to query with.
+
+        moc: dict or mocpy.MOC
+           The coverage map, see `within_moc`.
+
+        batch_size: int
+           The number of ranges of HEALPix indices searched per statement.
+
+        yield_per: int
+           The number of rows fetched at a time.
+
+        Returns
+        -------
+
+        objects: generator
+           The objects inside the MOC, each once, in HEALPix order within
+           each batch.
+        """
+
+        lo, hi = moc_ranges(moc)
+        for start in range(0, len(lo), batch_size):
+            stop = start + batch_size
+            ranges = sa.select([
+                sa.func.unnest(array_param(lo[start:stop], sa.BigInteger),
+                               type_=sa.BigInteger).label('lo'),
+                sa.func.unnest(array_param(hi[start:stop], sa.BigInteger),
+                               type_=sa.BigInteger).label('hi'),
+            ]).alias('ranges')
+            q = session.query(cls).select_from(ranges).join(
+                cls, cls.hpx.between(ranges.c.lo, ranges.c.hi)
+            )
+            yield from q.yield_per(yield_per)
+
+    @classmethod
+    def radially_within_any(cls, session, ra, dec, angular_sep_arcsec):
+        """Return a query for all objects that lie within any of a set of
+        cones, in a single round trip. Each cone is expanded into ranges of
+        HEALPix indices in python; the ranges are sent to postgres as arrays
+        and joined against the index, then cut on the exact distance.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to build the query with.
+
+        ra, dec: array-like
+           The icrs coordinates of the cone centers in degrees.
+
+        angular_sep_arcsec: float or array-like
+           The radius, in arcseconds, of every cone or of each cone.
+
+        Returns
+        -------
+
+        query: sqlalchemy.orm.Query
+           A query yielding `(center_index, object)` pairs, where
+           `center_index` is the position of the matching cone in `ra` and
+           `dec`. An object within several cones is returned once per cone.
+        """
+
+        ra, dec = check_coordinates(ra, dec)
+        radius = np.asarray(angular_sep_arcsec, dtype=float)
+        try:
+            radius = np.broadcast_to(radius, ra.shape)
+        except ValueError:
+            raise ValueError('`angular_sep_arcsec` must be a scalar or have '
+                             'the same length as `ra` and `dec`.')
+
+        index, lo, hi = [], [], []
+        for i, (r, d, sep) in enumerate(zip(ra, dec, radius)):
+            l, h = cone_ranges(r, d, sep)
+            index.append(np.full(len(l), i))
+            lo.append(l)
+            hi.append(h)
+        index = np.concatenate(index) if index else np.zeros(0, dtype=int)
+        lo = np.concatenate(lo) if lo else np.zeros(0, dtype=np.int64)
+        hi = np.concatenate(hi) if hi else np.zeros(0, dtype=np.int64)
+
+        dbl = psql.DOUBLE_PRECISION
+        ranges = sa.select([
+            sa.func.unnest(array_param(index, sa.Integer),
+                           type_=sa.Integer).label('center_index'),
+            sa.func.unnest(array_param(ra[index], dbl),
+                           type_=dbl).label('ra'),
+            sa.func.unnest(array_param(dec[index], dbl),
+                           type_=dbl).label('dec'),
+            sa.func.unnest(array_param(radius[index], dbl),
+                           type_=dbl).label('radius'),
+            sa.func.unnest(array_param(lo, sa.BigInteger),
+                           type_=sa.BigInteger).label('lo'),
+            sa.func.unnest(array_param(hi, sa.BigInteger),
+                           type_=sa.BigInteger).label('hi'),
+        ]).alias('ranges')
+
+        clause = sa.and_(cls.hpx.between(ranges.c.lo, ranges.c.hi),
+                         _haversine(cls, ranges.c) <= ranges.c.radius)
+        return session.query(ranges.c.center_index, cls).select_from(
+            ranges
+        ).join(cls, clause)
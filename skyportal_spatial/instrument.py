@@ -0,0 +1,227 @@
+"""Opt-in timing of the statements that use spatial clauses.
+
+While instrumentation is enabled, the clauses built by the backends'
+`distance`, `radially_within` and region methods are tagged with their
+backend and operation when the statement is compiled, and the cursor
+execution events aggregate latency, row counts and bytes sent for each
+tagged statement:
+
+    from skyportal_spatial import instrument
+
+    instrument.enable()
+    ...
+    instrument.stats()['q3c']['radially_within']['count']
+
+While disabled, which is the default, no event listeners are registered and
+the clauses are built exactly as without instrumentation.
+"""
+
+import bisect
+import functools
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import ClauseElement, ColumnElement, _clone
+
+try:
+    from sqlalchemy.sql.visitors import InternalTraversal
+except ImportError:  # sqlalchemy < 1.4 has no statement cache
+    InternalTraversal = None
+
+
+# upper bounds of the latency histogram buckets in milliseconds; the last
+# bucket counts everything slower
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1., 2.5, 5., 10., 25., 50., 100.,
+                      250., 500., 1000., 2500., 5000., 10000.)
+
+_lock = threading.Lock()
+_stats = {}
+_target = None
+
+
+class SpatialOperation(ColumnElement):
+    """A spatial clause tagged with the backend and operation that built
+    it. It compiles to the wrapped clause, and records the tag on the
+    compiled statement."""
+
+    __visit_name__ = 'spatial_operation'
+
+    if InternalTraversal is not None:
+        _traverse_internals = [
+            ('element', InternalTraversal.dp_clauseelement),
+            ('backend', InternalTraversal.dp_string),
+            ('operation', InternalTraversal.dp_string),
+        ]
+
+    def __init__(self, element, backend, operation):
+        self.element = element
+        self.backend = backend
+        self.operation = operation
+        self.type = element.type
+
+    def self_group(self, against=None):
+        grouped = self.element.self_group(against=against)
+        if grouped is self.element:
+            return self
+        return SpatialOperation(grouped, self.backend, self.operation)
+
+    def get_children(self, **kwargs):
+        return self.element,
+
+    def _copy_internals(self, clone=_clone, **kw):
+        self.element = clone(self.element, **kw)
+
+    @property
+    def _from_objects(self):
+        return self.element._from_objects
+
+
+@compiles(SpatialOperation)
+def _compile_spatial_operation(element, compiler, **kw):
+    tags = compiler.__dict__.setdefault('_spatial_operations', set())
+    tags.add((element.backend, element.operation))
+    return compiler.process(element.element, **kw)
+
+
+def instrumented(backend, operation):
+    """Decorate a method that builds a spatial clause so that, while
+    instrumentation is enabled, the clause is tagged with `backend` and
+    `operation`."""
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            clause = method(self, *args, **kwargs)
+            if _target is not None and isinstance(clause, ClauseElement):
+                return SpatialOperation(clause, backend, operation)
+            return clause
+        return wrapper
+    return decorate
+
+
+class OperationStats(object):
+    """The statements executed for one operation of one backend."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.
+        self.max_ms = 0.
+        self.rows = 0
+        self.bytes_sent = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms, rows, bytes_sent):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows += rows
+        self.bytes_sent += bytes_sent
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def as_dict(self):
+        bounds = LATENCY_BUCKETS_MS + (float('inf'),)
+        return {
+            'count': self.count,
+            'total_ms': self.total_ms,
+            'mean_ms': self.total_ms / self.count if self.count else 0.,
+            'max_ms': self.max_ms,
+            'rows': self.rows,
+            'bytes_sent': self.bytes_sent,
+            'histogram': list(zip(bounds, self.buckets)),
+        }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    tags = getattr(getattr(context, 'compiled', None), '_spatial_operations',
+                   None)
+    if tags:
+        context._spatial_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = getattr(context, '_spatial_started', None)
+    if started is None:
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000.
+
+    # server side cursors have not fetched anything yet
+    rows = max(cursor.rowcount, 0)
+    # psycopg2 keeps the statement it sent, with the parameters bound
+    sent = getattr(cursor, 'query', None)
+    bytes_sent = len(sent) if sent is not None else len(statement)
+
+    with _lock:
+        for backend, operation in context.compiled._spatial_operations:
+            op = _stats.setdefault(backend, {}).setdefault(
+                operation, OperationStats()
+            )
+            op.add(elapsed_ms, rows, bytes_sent)
+
+
+def enable(target=sa.engine.Engine):
+    """Start tagging spatial clauses and timing the statements that use
+    them.
+
+    Parameters
+    ----------
+
+    target: sqlalchemy.engine.Engine or the Engine class
+       The engine whose statements to time. By default, every engine.
+    """
+
+    global _target
+    if _target is not None:
+        disable()
+    sa.event.listen(target, 'before_cursor_execute', _before_cursor_execute)
+    sa.event.listen(target, 'after_cursor_execute', _after_cursor_execute)
+    _target = target
+
+
+def disable():
+    """Stop tagging spatial clauses and remove the event listeners. The
+    statistics collected so far are kept."""
+
+    global _target
+    if _target is None:
+        return
+    sa.event.remove(_target, 'before_cursor_execute', _before_cursor_execute)
+    sa.event.remove(_target, 'after_cursor_execute', _after_cursor_execute)
+    _target = None
+
+
+def is_enabled():
+    return _target is not None
+
+
+def reset():
+    """Discard the statistics collected so far."""
+    with _lock:
+        _stats.clear()
+
+
+def stats():
+    """Return a snapshot of the statistics collected while enabled.
+
+    A statement that uses several spatial operations, such as a join on
+    `radially_within` ordered by `distance`, is counted under each of them.
+
+    Returns
+    -------
+
+    stats: dict
+       Nested mapping from backend to operation to a dict with the number
+       of statements (`count`), their total, mean and maximum latency in
+       milliseconds, the number of rows they returned, the number of bytes
+       sent to the database, and a latency `histogram` of (upper bound in
+       milliseconds, count) pairs.
+    """
+
+    with _lock:
+        return {
+            backend: {name: op.as_dict() for name, op in operations.items()}
+            for backend, operations in _stats.items()
+        }
@@ -0,0 +1,181 @@
+import numpy as np
+import sqlalchemy as sa
+from astropy.coordinates import SkyCoord
+from scipy.spatial import cKDTree
+
+from .stream import pairs_statement, id_column
+
+
+DEG_TO_RAD = np.pi / 180.
+RADIANS_PER_ARCSEC = DEG_TO_RAD / 3600.
+
+
+def unit_vectors(ra, dec):
+    """Return an (N, 3) array of cartesian unit vectors for icrs coordinates
+    `ra` and `dec` given in degrees."""
+
+    ra = np.asarray(ra, dtype=float) * DEG_TO_RAD
+    dec = np.asarray(dec, dtype=float) * DEG_TO_RAD
+    cosdec = np.cos(dec)
+    return np.stack([cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)],
+                    axis=-1)
+
+
+def chord_length(angular_sep_arcsec):
+    """Convert an angular separation in arcsec to the straight-line distance
+    between two unit vectors."""
+    return 2 * np.sin(np.asarray(angular_sep_arcsec) * RADIANS_PER_ARCSEC / 2)
+
+
+def chord_to_arcsec(chord):
+    """Convert the straight-line distance between two unit vectors to an
+    angular separation in arcsec. Unlike the arccos of a dot product, this
+    is accurate at small separations."""
+    chord = np.clip(np.asarray(chord, dtype=float), 0, 2)
+    return 2 * np.arcsin(chord / 2) / RADIANS_PER_ARCSEC
+
+
+def separation_arcsec(ra1, dec1, ra2, dec2):
+    """Return the angular separation, in arcseconds, of points given in
+    degrees, using the haversine formula."""
+
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    hav = (np.sin((dec2 - dec1) / 2) ** 2 +
+           np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(hav, 0., 1.)))) * 3600.
+
+
+def coordinates(objs):
+    """Return arrays of ra and dec in degrees for `objs`, which can be a
+    sequence of spatial backend instances, a SkyCoord, or a tuple of ra and
+    dec arrays. Missing coordinates come back as NaN."""
+
+    if isinstance(objs, SkyCoord):
+        icrs = objs.icrs
+        return (np.atleast_1d(icrs.ra.deg).astype(float),
+                np.atleast_1d(icrs.dec.deg).astype(float))
+    if isinstance(objs, tuple) and len(objs) == 2 and \
+            not hasattr(objs[0], 'ra'):
+        ra, dec = (np.atleast_1d(np.asarray(v, dtype=float)) for v in objs)
+        if ra.shape != dec.shape:
+            raise ValueError('`ra` and `dec` must have the same length.')
+        return ra, dec
+    ra = np.array([np.nan if o.ra is None else o.ra for o in objs],
+                  dtype=float)
+    dec = np.array([np.nan if o.dec is None else o.dec for o in objs],
+                   dtype=float)
+    return ra, dec
+
+
+def crossmatch(objs_a, objs_b, radius_arcsec):
+    """Find all pairs of positions in two in-memory collections that are
+    within `radius_arcsec` of each other, using a KD-tree over unit vectors
+    rather than a round trip through the database.
+
+    The pairs returned are the same as those of a
+    `A.radially_within(B, radius_arcsec)` join over the same objects.
+
+    Parameters
+    ----------
+
+    objs_a, objs_b: sequence of spatial backend instances, SkyCoord, or
+       tuple of (ra, dec) arrays in degrees. Objects without coordinates
+       never match.
+
+    radius_arcsec: float
+       The matching radius in arcseconds.
+
+    Returns
+    -------
+
+    idx_a, idx_b: numpy.ndarray
+       Indices into `objs_a` and `objs_b` of each matching pair, sorted by
+       `idx_a` then `idx_b`.
+
+    sep: numpy.ndarray
+       The angular separation of each pair in arcseconds.
+    """
+
+    ra_a, dec_a = coordinates(objs_a)
+    ra_b, dec_b = coordinates(objs_b)
+
+    valid_a = np.flatnonzero(np.isfinite(ra_a) & np.isfinite(dec_a))
+    valid_b = np.flatnonzero(np.isfinite(ra_b) & np.isfinite(dec_b))
+    xyz_a = unit_vectors(ra_a[valid_a], dec_a[valid_a])
+    xyz_b = unit_vectors(ra_b[valid_b], dec_b[valid_b])
+
+    empty = np.zeros(0, dtype=int)
+    if len(xyz_a) == 0 or len(xyz_b) == 0:
+        return empty, empty, np.zeros(0)
+
+    # pad the tree search slightly and make the exact cut on the separation
+    # so that pairs right at the radius agree with the SQL backends
+    chord = chord_length(radius_arcsec) * (1 + 1e-8)
+    neighbors = cKDTree(xyz_a).query_ball_tree(cKDTree(xyz_b), chord)
+
+    counts = np.fromiter((len(n) for n in neighbors), dtype=int,
+                         count=len(neighbors))
+    ia = np.repeat(np.arange(len(neighbors)), counts)
+    ib = np.fromiter((j for n in neighbors for j in n), dtype=int,
+                     count=counts.sum())
+
+    sep = chord_to_arcsec(np.linalg.norm(xyz_a[ia] - xyz_b[ib], axis=-1))
+    keep = sep <= radius_arcsec
+    ia, ib, sep = valid_a[ia[keep]], valid_b[ib[keep]], sep[keep]
+
+    order = np.lexsort((ib, ia))
+    return ia[order], ib[order], sep[order]
+
+
+def best_match(session, a, b, angular_sep_arcsec, symmetric=False):
+    """Return a query for the closest counterpart in `b` of each object in
+    `a` within `angular_sep_arcsec`, rather than every pair of a
+    `radially_within` join.
+
+    The pairs of the join, which uses the backend's index, are reduced in
+    postgres with `DISTINCT ON` ordered by distance, so at most one row per
+    object of `a` is sent back. Ties are broken by the primary key of `b`.
+
+    Parameters
+    ----------
+
+    session: sqlalchemy.orm.Session
+       The session to build the query with.
+
+    a, b: mapped classes or aliases using the same spatial backend
+       The sources and the candidate counterparts.
+
+    angular_sep_arcsec: float
+       The radius, in arcseconds, within which to look for counterparts.
+
+    symmetric: bool
+       If True, only keep pairs in which each object is also the closest
+       counterpart of the other, so that each object of `b` appears at
+       most once as well.
+
+    Returns
+    -------
+
+    query: sqlalchemy.orm.Query
+       A query of `(a_object, b_object, separation)` rows, with the
+       separation in arcseconds.
+    """
+
+    statement, a, b = pairs_statement(a, b, angular_sep_arcsec)
+    pairs = statement.cte('pairs')
+
+    def closest(source, counterpart):
+        return sa.select([pairs]).distinct(source).order_by(
+            source, pairs.c.separation, counterpart
+        )
+
+    best = closest(pairs.c.id_a, pairs.c.id_b).alias('best')
+    if symmetric:
+        reverse = closest(pairs.c.id_b, pairs.c.id_a).alias('backward')
+        best = sa.select([best]).select_from(best.join(reverse, sa.and_(
+            best.c.id_a == reverse.c.id_a, best.c.id_b == reverse.c.id_b
+        ))).alias('mutual')
+
+    return session.query(a, b, best.c.separation).select_from(best).join(
+        a, id_column(a) == best.c.id_a
+    ).join(b, id_column(b) == best.c.id_b)
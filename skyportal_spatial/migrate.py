@@ -0,0 +1,296 @@
+"""Switch a populated table between spatial backends without long locks.
+
+The migration is done in two parts, around a deploy of the application
+that switches its mapped class to the new backend:
+
+    migrate_backend(engine, OldObject, NewObject)
+    # deploy the application using NewObject
+    finish_migration(engine, OldObject, NewObject)
+
+`migrate_backend` adds the columns of the new backend, keeps them in sync
+with a trigger while filling them in batches, and builds the new indexes
+with `CREATE INDEX CONCURRENTLY`. `finish_migration` drops the trigger and
+the indexes and columns that only the old backend used. Every step either
+holds a lock only briefly or is one of many short transactions, so the
+table stays readable and writable throughout.
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.sql.util import ClauseAdapter
+
+from .postgis import point_geography
+from .stream import id_column
+
+
+DEFAULT_MIGRATION_BATCH = 50000
+
+
+def _check_tables(source, target):
+    if (source.__table__.name, source.__table__.schema) != \
+            (target.__table__.name, target.__table__.schema):
+        raise ValueError('`source` and `target` must be mapped to the same '
+                         'table.')
+
+
+def _added_columns(source, target):
+    """Return the columns of `target` that `source` does not have."""
+    existing = set(source.__table__.c.keys())
+    added = [c for c in target.__table__.c if c.key not in existing]
+    for column in added:
+        if column.computed is not None:
+            raise ValueError(f'Cannot add the generated column {column.key} '
+                             'online, since postgres rewrites the table to '
+                             'compute it.')
+    return added
+
+
+def _removed_columns(source, target):
+    """Return the columns of `source` that `target` does not have."""
+    kept = set(target.__table__.c.keys())
+    return [c for c in source.__table__.c if c.key not in kept]
+
+
+def _column_values(source, columns):
+    """Return the SQL expressions, in terms of the columns of `source`, for
+    the values of `columns` of the target backend."""
+
+    values = {}
+    for column in columns:
+        if column.key in ('ra', 'dec'):
+            values[column.key] = getattr(source,
+                                         column.key).__clause_element__()
+        elif column.key == 'radec':
+            values[column.key] = point_geography(source.ra, source.dec)
+        else:
+            raise ValueError(f'Cannot compute the column {column.key} in '
+                             'postgres.')
+    return values
+
+
+def _sql(element, dialect):
+    return str(element.compile(dialect=dialect,
+                               compile_kwargs={'literal_binds': True}))
+
+
+def _trigger_names(table):
+    name = f'{table.name}_spatial_migration'
+    return name, f'{name}_trigger'
+
+
+def _qualified(preparer, table, name):
+    """Quote the name of an index or function in the schema of `table`."""
+    if table.schema is None:
+        return preparer.quote(name)
+    return f'{preparer.quote_schema(table.schema)}.{preparer.quote(name)}'
+
+
+def _autocommit(engine):
+    return engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+
+def create_indexes_concurrently(engine, cls):
+    """Create the indexes of `cls` that do not exist yet with
+    `CREATE INDEX CONCURRENTLY`, which does not block writes to the table.
+    An invalid index left by an interrupted concurrent build is dropped and
+    built again.
+
+    Parameters
+    ----------
+
+    engine: sqlalchemy.engine.Engine
+       The engine to create the indexes with. Each is built outside a
+       transaction.
+
+    cls: mapped class
+       The class whose indexes to create.
+    """
+
+    dialect = engine.dialect
+    preparer = dialect.identifier_preparer
+    table = cls.__table__
+    with _autocommit(engine) as connection:
+        for index in table.indexes:
+            valid = connection.execute(sa.text(
+                'SELECT i.indisvalid FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indexrelid '
+                'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                'WHERE c.relname = :name '
+                'AND n.nspname = coalesce(:schema, current_schema())'
+            ), name=index.name, schema=table.schema).scalar()
+            if valid:
+                continue
+            if valid is not None:
+                connection.execute(
+                    'DROP INDEX CONCURRENTLY IF EXISTS '
+                    f'{_qualified(preparer, table, index.name)}'
+                )
+
+            options = index.dialect_options['postgresql']
+            concurrently = options['concurrently']
+            options['concurrently'] = True
+            try:
+                ddl = str(CreateIndex(index).compile(dialect=dialect))
+            finally:
+                options['concurrently'] = concurrently
+            connection.execute(ddl)
+
+
+def migrate_backend(engine, source, target,
+                    batch_size=DEFAULT_MIGRATION_BATCH):
+    """Prepare a populated table for a switch from one spatial backend to
+    another, while the application keeps using `source`.
+
+    The columns of `target` that the table lacks are added without
+    defaults, which does not rewrite the table. A trigger computes them
+    from the columns of `source` for every row written from then on, and
+    the existing rows are filled in batches of primary keys, each in its
+    own transaction. Then the indexes of `target` are built concurrently.
+    Run `finish_migration` once the application uses `target`.
+
+    Supports switching between UnindexedSpatialBackend (without generated
+    columns), Q3CSpatialBackend and PostGISSpatialBackend, and from
+    HealpixSpatialBackend to any of those; HEALPix indices can only be
+    computed in python.
+
+    Parameters
+    ----------
+
+    engine: sqlalchemy.engine.Engine
+       The engine to migrate the table with.
+
+    source, target: mapped classes
+       The old and new classes, mapped to the same table, which must have
+       a single integer primary key column.
+
+    batch_size: int
+       The number of primary key values per backfill transaction.
+
+    Returns
+    -------
+
+    nrows: int
+       The number of rows backfilled.
+    """
+
+    _check_tables(source, target)
+    if batch_size < 1:
+        raise ValueError('`batch_size` must be positive.')
+
+    table = source.__table__
+    added = _added_columns(source, target)
+    values = _column_values(source, added)
+    dialect = engine.dialect
+    preparer = dialect.identifier_preparer
+    name = preparer.format_table(table)
+    quote = preparer.quote
+
+    if added:
+        function, trigger = _trigger_names(table)
+        function = _qualified(preparer, table, function)
+        trigger = quote(trigger)
+
+        # recompute the new columns only when a row is inserted or the
+        # columns of `source` change, so that once the application writes
+        # the new columns itself they are not overwritten
+        new = table.alias('new')
+        assignments = ''.join(
+            f'NEW.{quote(key)} := COALESCE('
+            f'{_sql(ClauseAdapter(new).traverse(value), dialect)}, '
+            f'NEW.{quote(key)}); '
+            for key, value in values.items()
+        )
+        changed = ' OR '.join(
+            f'NEW.{quote(c.name)} IS DISTINCT FROM OLD.{quote(c.name)}'
+            for c in _removed_columns(source, target)
+        )
+        body = (f"IF TG_OP = 'UPDATE' AND NOT ({changed}) THEN RETURN NEW; "
+                f"END IF; {assignments}RETURN NEW;")
+        with engine.begin() as connection:
+            for column in added:
+                spec = CreateColumn(column).compile(dialect=dialect)
+                connection.execute(f'ALTER TABLE {name} '
+                                   f'ADD COLUMN IF NOT EXISTS {spec}')
+            connection.execute(
+                f'CREATE OR REPLACE FUNCTION {function}() RETURNS trigger '
+                f'AS $$ BEGIN {body} END; $$ '
+                'LANGUAGE plpgsql'
+            )
+            connection.execute(f'DROP TRIGGER IF EXISTS {trigger} ON {name}')
+            connection.execute(
+                f'CREATE TRIGGER {trigger} BEFORE INSERT OR UPDATE '
+                f'ON {name} FOR EACH ROW EXECUTE PROCEDURE {function}()'
+            )
+
+    nrows = 0
+    if added:
+        key = id_column(source)
+        with engine.connect() as connection:
+            lo, hi = connection.execute(
+                sa.select([sa.func.min(key), sa.func.max(key)])
+            ).first()
+        if lo is not None:
+            # the new columns are not mapped on `source`, so write the
+            # statement out rather than build it from the table
+            update = sa.text(
+                f'UPDATE {name} SET ' + ', '.join(
+                    f'{quote(k)} = {_sql(v, dialect)}'
+                    for k, v in values.items()
+                ) + f' WHERE {quote(key.name)} BETWEEN :start AND :stop'
+            )
+            for start in range(lo, hi + 1, batch_size):
+                with engine.begin() as connection:
+                    nrows += connection.execute(
+                        update, start=start, stop=start + batch_size - 1
+                    ).rowcount
+
+    create_indexes_concurrently(engine, target)
+    return nrows
+
+
+def finish_migration(engine, source, target):
+    """Finish a migration started with `migrate_backend`, once the
+    application writes through `target`: drop the trigger that synced the
+    new columns, the indexes of `source` that `target` does not have with
+    `DROP INDEX CONCURRENTLY`, and the columns that only `source` used.
+    Dropping a column only changes the catalog, so it locks the table
+    briefly.
+
+    Parameters
+    ----------
+
+    engine: sqlalchemy.engine.Engine
+       The engine to migrate the table with.
+
+    source, target: mapped classes
+       The old and new classes, mapped to the same table.
+    """
+
+    _check_tables(source, target)
+    table = source.__table__
+    preparer = engine.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    function, trigger = _trigger_names(table)
+
+    with engine.begin() as connection:
+        connection.execute(f'DROP TRIGGER IF EXISTS '
+                           f'{preparer.quote(trigger)} ON {name}')
+        connection.execute(f'DROP FUNCTION IF EXISTS '
+                           f'{_qualified(preparer, table, function)}()')
+
+    kept = set(index.name for index in target.__table__.indexes)
+    with _autocommit(engine) as connection:
+        for index in table.indexes:
+            if index.name not in kept:
+                connection.execute(
+                    'DROP INDEX CONCURRENTLY IF EXISTS '
+                    f'{_qualified(preparer, table, index.name)}'
+                )
+
+    dropped = _removed_columns(source, target)
+    if dropped:
+        with engine.begin() as connection:
+            connection.execute(f'ALTER TABLE {name} ' + ', '.join(
+                f'DROP COLUMN IF EXISTS {preparer.quote(c.name)}'
+                for c in dropped
+            ))
@@ -0,0 +1,258 @@
+"""An in-process copy of a small, hot spatial table.
+
+Reference catalogs such as standard stars or bright star masks are small
+enough to hold in memory but are searched far more often than they
+change. A `SpatialMirror` loads the positions of such a table once into
+numpy arrays and a KD-tree over their unit vectors, answers
+`radially_within`, `distance` and `nearest` without a round trip to
+postgres, and catches up with later writes by reading only the rows whose
+key is past the largest one it has seen:
+
+    mirror = SpatialMirror(Star, session, max_bytes=256 * 2**20)
+    ids = mirror.radially_within((ra, dec), 10.)
+    ...
+    mirror.refresh(session)
+
+Use the primary key as the key of an append-only table, or an updated-at
+column that every write sets to mark updated rows as well. Keys are not
+committed in order: a transaction that took a smaller key (from a
+sequence, or `now()` at its start) may commit after a refresh has read
+past it, and its rows would never be read. Pass `overlap` to read the
+rows within that distance below the watermark again at every refresh,
+as long as the longest writing transaction; rows already mirrored are
+simply replaced. Deleted rows are only dropped by `reload`.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .match import unit_vectors, chord_length, chord_to_arcsec
+from .regions import center_coordinates
+from .stream import id_column
+
+
+# widen tree searches slightly and make the exact cut on the separation, so
+# that objects right at the radius agree with the SQL backends
+TREE_PADDING = 1 + 1e-8
+
+
+class SpatialMirror(object):
+    """The positions of the objects of a spatial table, held in memory.
+
+    Parameters
+    ----------
+
+    cls: mapped class using one of the spatial backends
+       The table to mirror, which must have a single primary key column.
+
+    session: sqlalchemy.orm.Session
+       The session to load the table with.
+
+    key: mapped attribute, optional
+       A column that increases with every insert, or every write, used by
+       `refresh` to read only the rows written since the last load. By
+       default, the primary key.
+
+    max_bytes: int, optional
+       The most memory the arrays and the tree may hold. Loads that would
+       exceed it raise a ValueError and leave the mirror as it was.
+
+    overlap: optional
+       How far below the largest key seen `refresh` reads again, in the
+       units of the key (a number, or a datetime.timedelta for a
+       timestamp), to catch rows whose transactions committed late. By
+       default only rows past it are read.
+
+    Attributes
+    ----------
+
+    ids, ra, dec: numpy.ndarray
+       The primary keys and icrs coordinates, in degrees, of the mirrored
+       objects, sorted by primary key. Objects without coordinates are not
+       mirrored.
+    """
+
+    def __init__(self, cls, session, key=None, max_bytes=None,
+                 overlap=None):
+        self.cls = cls
+        self.key = id_column(cls) if key is None else key
+        self.max_bytes = max_bytes
+        self.overlap = overlap
+        self._set(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+        self.watermark = None
+        self.reload(session)
+
+    def _set(self, ids, ra, dec):
+        xyz = unit_vectors(ra, dec).reshape(-1, 3)
+        nbytes = self._footprint(ids, ra, dec, xyz)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            raise ValueError(f'Mirroring {len(ids)} objects needs about '
+                             f'{nbytes} bytes, more than `max_bytes` '
+                             f'({self.max_bytes}).')
+        self.ids, self.ra, self.dec, self._xyz = ids, ra, dec, xyz
+        self._tree = cKDTree(xyz) if len(ids) else None
+
+    @staticmethod
+    def _footprint(ids, ra, dec, xyz):
+        # the tree holds a copy of the vectors and an index per object, and
+        # about one node per leaf of 16
+        tree = xyz.nbytes + ids.nbytes + len(ids) // 8 * 64
+        return ids.nbytes + ra.nbytes + dec.nbytes + xyz.nbytes + tree
+
+    @property
+    def nbytes(self):
+        """The estimated memory, in bytes, held by the arrays and the
+        tree."""
+        return self._footprint(self.ids, self.ra, self.dec, self._xyz)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _read(self, session, since):
+        query = session.query(id_column(self.cls), self.key, self.cls.ra,
+                              self.cls.dec)
+        if since is not None and self.overlap is not None:
+            query = query.filter(self.key >= since - self.overlap)
+        elif since is not None:
+            query = query.filter(self.key > since)
+        rows = query.all()
+        if not rows:
+            return None
+        ids, keys, ra, dec = zip(*rows)
+        ra = np.array([np.nan if r is None else r for r in ra], dtype=float)
+        dec = np.array([np.nan if d is None else d for d in dec],
+                       dtype=float)
+        return np.array(ids, dtype=np.int64), ra, dec, max(keys)
+
+    def _update(self, ids, ra, dec):
+        """Merge rows into the mirror, replacing the objects they share a
+        primary key with, and dropping objects without coordinates."""
+        ids = np.concatenate([self.ids, ids])
+        ra = np.concatenate([self.ra, ra])
+        dec = np.concatenate([self.dec, dec])
+
+        # np.unique keeps the first occurrence, so search the rows backwards
+        # for the latest version of each object
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = len(ids) - 1 - last
+        keep = keep[np.isfinite(ra[keep]) & np.isfinite(dec[keep])]
+        self._set(ids[keep], ra[keep], dec[keep])
+
+    def reload(self, session):
+        """Read the whole table again."""
+        read = self._read(session, None)
+        if read is None:
+            self._set(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+            self.watermark = None
+            return
+        ids, ra, dec, watermark = read
+        self._set(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+        self._update(ids, ra, dec)
+        self.watermark = watermark
+
+    def refresh(self, session):
+        """Read the rows whose key is past the largest one seen so far, or
+        within `overlap` of it, and rebuild the tree if there are any.
+
+        Returns
+        -------
+
+        nrows: int
+           The number of rows read, including those read again.
+        """
+
+        read = self._read(session, self.watermark)
+        if read is None:
+            return 0
+        ids, ra, dec, watermark = read
+        self._update(ids, ra, dec)
+        if self.watermark is None or watermark > self.watermark:
+            self.watermark = watermark
+        return len(ids)
+
+    def distance(self, other):
+        """Return the angular separation, in arcsec, of every mirrored
+        object from `other`, in the order of `ids`.
+
+        Parameters
+        ----------
+
+        other: instance of a spatial backend or (ra, dec) pair
+           The position to measure from, in degrees.
+        """
+
+        center = unit_vectors(*center_coordinates(other))
+        return chord_to_arcsec(np.linalg.norm(self._xyz - center, axis=-1))
+
+    def radially_within(self, other, angular_sep_arcsec):
+        """Return the primary keys of the mirrored objects within
+        `angular_sep_arcsec` of `other`, sorted, as the SQL backends'
+        `radially_within` would select them.
+
+        Parameters
+        ----------
+
+        other: instance of a spatial backend or (ra, dec) pair
+           The center of the search, in degrees.
+
+        angular_sep_arcsec: float
+           The radius of the search in arcseconds.
+        """
+
+        if self._tree is None:
+            return np.zeros(0, dtype=np.int64)
+        center = unit_vectors(*center_coordinates(other))
+        found = np.array(self._tree.query_ball_point(
+            center, chord_length(angular_sep_arcsec) * TREE_PADDING
+        ), dtype=int)
+        sep = chord_to_arcsec(np.linalg.norm(self._xyz[found] - center,
+                                             axis=-1))
+        return np.sort(self.ids[found[sep <= angular_sep_arcsec]])
+
+    def nearest(self, other, k=1, max_radius=None):
+        """Return the `k` mirrored objects nearest to `other`, closest
+        first.
+
+        Parameters
+        ----------
+
+        other: instance of a spatial backend or (ra, dec) pair
+           The position to search around, in degrees.
+
+        k: int
+           The number of neighbours to return.
+
+        max_radius: float, optional
+           Only consider objects within this many arcseconds.
+
+        Returns
+        -------
+
+        ids: numpy.ndarray
+           The primary keys of up to `k` objects.
+
+        distances: numpy.ndarray
+           Their separations from `other` in arcseconds.
+        """
+
+        if k < 1:
+            raise ValueError('`k` must be positive.')
+        if self._tree is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        center = unit_vectors(*center_coordinates(other))
+        bound = np.inf if max_radius is None else \
+            chord_length(max_radius) * TREE_PADDING
+        chord, found = self._tree.query(center, k=min(k, len(self)),
+                                        distance_upper_bound=bound)
+        chord, found = np.atleast_1d(chord), np.atleast_1d(found)
+        hit = np.isfinite(chord)
+        sep = chord_to_arcsec(chord[hit])
+        found = found[hit]
+        if max_radius is not None:
+            found, sep = found[sep <= max_radius], sep[sep <= max_radius]
+        return self.ids[found], sep
+
+    def __repr__(self):
+        return (f'<SpatialMirror of {self.cls.__name__}: {len(self)} '
+                f'objects, {self.nbytes} bytes>')
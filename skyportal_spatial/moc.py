@@ -0,0 +1,255 @@
+import numpy as np
+import sqlalchemy as sa
+
+from .pixels import (ang2pix, pix2vec, pix2face, face_pixels, max_pixrad,
+                     merge_ranges, MAX_ORDER, RADIANS_PER_ARCSEC)
+from .util import array_param
+
+
+# Multi-order coverage maps (MOCs, IVOA recommendation), which describe a
+# region of the sky as a set of nested HEALPix cells of different orders
+
+
+# number of MOC ranges or cells searched per statement when streaming
+DEFAULT_MOC_BATCH = 10000
+
+
+def moc_ranges(moc):
+    """Return the inclusive ranges of nested HEALPix indices at MAX_ORDER
+    covered by a MOC.
+
+    Parameters
+    ----------
+
+    moc: dict or mocpy.MOC
+       A mapping from order to the nested indices of the cells of that
+       order, as in the JSON serialization of MOCs (the orders may be
+       strings), or an object with a `to_depth29_ranges` attribute, such as
+       a `mocpy.MOC`.
+
+    Returns
+    -------
+
+    lo, hi: numpy.ndarray
+       The first and last index of each range, sorted and merged.
+    """
+
+    if hasattr(moc, 'to_depth29_ranges'):
+        ranges = moc.to_depth29_ranges
+        if callable(ranges):
+            ranges = ranges()
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        # mocpy ranges are half open
+        return merge_ranges(ranges[:, 0], ranges[:, 1] - 1)
+
+    try:
+        items = list(moc.items())
+    except AttributeError:
+        raise TypeError('`moc` must be a mapping from order to HEALPix '
+                        'indices or have a `to_depth29_ranges` attribute.')
+
+    lo, hi = [], []
+    for order, ipix in items:
+        order = int(order)
+        ipix = np.atleast_1d(np.asarray(ipix, dtype=np.int64))
+        if not 0 <= order <= MAX_ORDER:
+            raise ValueError(f'MOC orders must be between 0 and '
+                             f'{MAX_ORDER}, not {order}.')
+        if ((ipix < 0) | (ipix >= 12 << (2 * order))).any():
+            raise ValueError(f'Invalid HEALPix index in MOC order {order}.')
+        shift = 2 * (MAX_ORDER - order)
+        lo.append(ipix << shift)
+        hi.append(((ipix + 1) << shift) - 1)
+    if not lo:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return merge_ranges(np.concatenate(lo), np.concatenate(hi))
+
+
+def moc_cells(lo, hi):
+    """Decompose inclusive ranges of nested HEALPix indices at MAX_ORDER
+    into the fewest cells, each as coarse as possible.
+
+    Returns
+    -------
+
+    orders, ipix: numpy.ndarray
+       The order and nested index of each cell, sorted by the first index
+       at MAX_ORDER that they cover.
+    """
+
+    lo = np.asarray(lo, dtype=np.int64)
+    end = np.asarray(hi, dtype=np.int64) + 1
+    orders, cells, first = [], [], []
+    parent_a = parent_b = None
+    for order in range(MAX_ORDER + 1):
+        shift = 2 * (MAX_ORDER - order)
+        # the cells of this order that lie entirely within each range
+        a = -(-lo >> shift)
+        b = (end >> shift) - 1
+        if parent_a is None:
+            starts, stops = [a], [b]
+        else:
+            # minus those already covered by a cell of the previous order
+            empty = parent_a > parent_b
+            starts = [a, np.where(empty, a, 4 * parent_b + 4)]
+            stops = [np.where(empty, b, 4 * parent_a - 1),
+                     np.where(empty, a - 1, b)]
+        for start, stop in zip(starts, stops):
+            counts = np.maximum(stop - start + 1, 0)
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            ipix = np.repeat(start, counts) + offsets
+            orders.append(np.full(len(ipix), order))
+            cells.append(ipix)
+            first.append(ipix << shift)
+        parent_a, parent_b = a, b
+
+    orders, cells, first = (np.concatenate(v) for v in (orders, cells,
+                                                         first))
+    ordering = np.argsort(first, kind='mergesort')
+    return orders[ordering], cells[ordering]
+
+
+def moc_contains(moc, ra, dec):
+    """Return a boolean array telling which of the positions `ra`, `dec`
+    (degrees) lie within `moc` (see `moc_ranges`)."""
+
+    lo, hi = moc_ranges(moc)
+    ipix = ang2pix(ra, dec)
+    i = np.searchsorted(lo, ipix, side='right') - 1
+    return (i >= 0) & (ipix <= hi[np.maximum(i, 0)])
+
+
+def moc_cones(moc):
+    """Decompose a MOC into cells and return the cone that circumscribes
+    each, so that backends without a HEALPix index can search the cells
+    with their own radial queries.
+
+    Returns
+    -------
+
+    orders, ipix: numpy.ndarray
+       The order and nested index of each cell, as from `moc_cells`.
+
+    ra, dec, radius: numpy.ndarray
+       The center of each cell in degrees and the radius of its cone in
+       arcseconds.
+    """
+
+    orders, ipix = moc_cells(*moc_ranges(moc))
+    ra = np.zeros(len(ipix))
+    dec = np.zeros(len(ipix))
+    radius = np.zeros(len(ipix))
+    for order in np.unique(orders):
+        sel = orders == order
+        xyz = pix2vec(ipix[sel], order)
+        ra[sel] = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+        dec[sel] = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1, 1)))
+        radius[sel] = max_pixrad(order) / RADIANS_PER_ARCSEC * (1 + 1e-9)
+    return orders, ipix, ra, dec, radius
+
+
+def cells_clause(ra, dec, orders, ipix):
+    """Return a clause that is true where the positions `ra`, `dec` (SQL
+    expressions in degrees) lie within one of the HEALPix cells `orders`,
+    `ipix`.
+
+    The pixel of each row at the finest order of the cells is computed in
+    SQL with `face_pixels`, once per row in a correlated subquery, and
+    matched against the cells, which are sent as arrays. This is an exact
+    cut that no index serves, so combine it with a clause that does.
+    """
+
+    orders = np.asarray(orders, dtype=np.int64)
+    ipix = np.asarray(ipix, dtype=np.int64)
+    if len(ipix) == 0:
+        return sa.false()
+
+    order = int(orders.max())
+    face = np.zeros(len(ipix), dtype=np.int64)
+    ix = np.zeros(len(ipix), dtype=np.int64)
+    iy = np.zeros(len(ipix), dtype=np.int64)
+    for o in np.unique(orders):
+        sel = orders == o
+        face[sel], ix[sel], iy[sel] = pix2face(ipix[sel], o)
+    # each cell is a box of pixel coordinates at the finest order
+    shift = order - orders
+
+    big = sa.BigInteger
+    cells = sa.select([
+        sa.func.unnest(array_param(face, big), type_=big).label('face'),
+        sa.func.unnest(array_param(ix << shift, big),
+                       type_=big).label('ix_lo'),
+        sa.func.unnest(array_param(((ix + 1) << shift) - 1, big),
+                       type_=big).label('ix_hi'),
+        sa.func.unnest(array_param(iy << shift, big),
+                       type_=big).label('iy_lo'),
+        sa.func.unnest(array_param(((iy + 1) << shift) - 1, big),
+                       type_=big).label('iy_hi'),
+    ]).alias('cells')
+
+    pface, pix, piy = face_pixels(ra, dec, order)
+    point = sa.select([pface.label('face'), pix.label('ix'),
+                       piy.label('iy')]).correlate_except(None).alias('point')
+
+    match = sa.and_(point.c.face == cells.c.face,
+                    point.c.ix.between(cells.c.ix_lo, cells.c.ix_hi),
+                    point.c.iy.between(cells.c.iy_lo, cells.c.iy_hi))
+    return sa.exists().select_from(point.join(cells, match))
+
+
+def iter_within_moc_cones(session, cls, moc, batch_size=DEFAULT_MOC_BATCH,
+                          yield_per=1000):
+    """Stream the objects of a spatial backend class `cls` that lie within
+    `moc`, for backends without a HEALPix index.
+
+    The MOC is decomposed into cells and each cell into the cone that
+    circumscribes it. Batches of cones are searched with
+    `cls.radially_within_any`, so each is an index scan, and the rows
+    returned are cut exactly on their HEALPix index, computed in python.
+    An object is only yielded for the cone of the cell that contains it,
+    so it is yielded once even where cones overlap.
+
+    Parameters
+    ----------
+
+    session: sqlalchemy.orm.Session
+       The session to query with.
+
+    cls: mapped class
+       The class to search.
+
+    moc: dict or mocpy.MOC
+       The coverage map, see `moc_ranges`.
+
+    batch_size: int
+       The number of MOC cells searched per statement.
+
+    yield_per: int
+       The number of rows fetched at a time.
+    """
+
+    orders, ipix, ra, dec, radius = moc_cones(moc)
+    first = ipix << (2 * (MAX_ORDER - orders))
+    last = ((ipix + 1) << (2 * (MAX_ORDER - orders))) - 1
+
+    def owned(batch, offset):
+        index = np.array([i for i, _ in batch]) + offset
+        objs = [o for _, o in batch]
+        h = ang2pix([o.ra for o in objs], [o.dec for o in objs])
+        keep = (h >= first[index]) & (h <= last[index])
+        return [o for o, k in zip(objs, keep) if k]
+
+    for start in range(0, len(ipix), batch_size):
+        stop = start + batch_size
+        q = cls.radially_within_any(session, ra[start:stop],
+                                    dec[start:stop], radius[start:stop])
+        batch = []
+        for row in q.yield_per(yield_per):
+            batch.append(row)
+            if len(batch) == yield_per:
+                yield from owned(batch, start)
+                batch = []
+        if batch:
+            yield from owned(batch, start)
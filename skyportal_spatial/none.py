@@ -5,33 +5,257 @@ from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_method
 from sqlalchemy.dialects import postgresql as psql
 
+from .util import cone_centers, is_instance
+from .match import unit_vectors, chord_length
+from .regions import Polygon, Box, Ellipse
+from .instrument import instrumented
+from .pixels import nested_pixel
+from .propermotion import ProperMotionMixin
+from .backend import SpatialBackendMixin
+
 
 DEG_TO_RAD = np.pi / 180.
 RADIANS_PER_ARCSEC = DEG_TO_RAD / 3600.
+DEGREES_PER_ARCSEC = 1 / 3600.
+
+# widen prefilter boxes slightly so rounding never drops a match
+PREFILTER_PADDING = 1 + 1e-9
+
+# HEALPix order of the temporary index that tables without zones are
+# clustered on; its pixels are about 3.4 arcmin across
+CLUSTER_ORDER = 10
+
+
+def _has_unit_vector(obj):
+    if isinstance(obj, UnindexedSpatialBackend):
+        return True
+    flag = getattr(obj, 'UNIT_VECTORS', None)
+    if flag is not None:
+        return flag
+    return hasattr(obj, 'cx')
+
+
+def _unit_vector_mode(self, other):
+    """Whether both sides of a distance calculation have stored unit vectors,
+    either as columns or because they are instances."""
+    if isinstance(self, UnindexedSpatialBackend) and \
+            isinstance(other, UnindexedSpatialBackend):
+        return False
+    return _has_unit_vector(self) and _has_unit_vector(other)
+
+
+def _unit_vector(obj):
+    """Return the unit vector of a class or selectable with unit vector
+    columns, or of an instance as python floats."""
+    if isinstance(obj, UnindexedSpatialBackend):
+        return tuple(float(c) for c in unit_vectors(obj.ra, obj.dec))
+    return obj.cx, obj.cy, obj.cz
+
+
+def _chord_squared(a, b):
+    (ax, ay, az), (bx, by, bz) = _unit_vector(a), _unit_vector(b)
+    return (ax - bx) * (ax - bx) + (ay - by) * (ay - by) + \
+        (az - bz) * (az - bz)
+
+
+def _dec_band(table, dec, angular_sep_arcsec):
+    """Restrict the declination of `table` to within the radius of `dec`."""
+    r = angular_sep_arcsec * DEGREES_PER_ARCSEC * PREFILTER_PADDING
+    return table.dec.between(dec - r, dec + r)
+
+
+def _zone_height(obj):
+    """The zone height of a class or alias with a zone column, else None."""
+    if isinstance(obj, UnindexedSpatialBackend):
+        return None
+    return getattr(obj, 'ZONE_HEIGHT', None)
+
+
+def _zone_mode(self, other):
+    """Whether a join can compare the zones of both sides, which requires
+    that they are tables with zone columns of the same height."""
+    height = _zone_height(self)
+    return height is not None and height == _zone_height(other)
+
+
+def _zone_window(self, other, angular_sep_arcsec):
+    """Return a clause restricting the rows of `self` to the zones within
+    the radius of each row of `other`, and to an RA window around it, so
+    that a join can range scan the (zone, ra) index of `self` once per row
+    of `other` and per zone. Windows that wrap through RA = 0 are searched
+    as two more ranges."""
+
+    height = self.ZONE_HEIGHT
+    r = angular_sep_arcsec * DEGREES_PER_ARCSEC * PREFILTER_PADDING
+    nzones = int(np.ceil(r / height))
+    zones = self.zone.in_([other.zone + k if k else other.zone
+                           for k in range(-nzones, nzones + 1)])
 
+    # the maximum RA offset of a point on the cone around each row of
+    # `other`, or the whole circle if the cone reaches a pole
+    halfwidth = sa.case(
+        [(sa.func.abs(other.dec) + r >= 90, 180.)],
+        else_=sa.func.degrees(sa.func.asin(
+            np.sin(np.radians(r)) / sa.func.cos(sa.func.radians(other.dec))
+        )) * PREFILTER_PADDING
+    )
+    lo, hi = other.ra - halfwidth, other.ra + halfwidth
+    return sa.or_(*[
+        sa.and_(zones, self.ra.between(lo + shift, hi + shift)) if shift
+        else sa.and_(zones, self.ra.between(lo, hi))
+        for shift in (0, -360, 360)
+    ])
 
-class UnindexedSpatialBackend(object):
+
+def _bounding_box(table, position, angular_sep_arcsec):
+    """Return a sargable clause selecting the rows of `table` inside the RA,
+    dec box that bounds the cone around the instance `position`. RA windows
+    that cross 0/360 are split in two, and cones containing a pole are only
+    restricted in dec."""
+
+    ra, dec = position.ra, position.dec
+    if ra is None or dec is None:
+        return None
+
+    r = angular_sep_arcsec * DEGREES_PER_ARCSEC * PREFILTER_PADDING
+    band = table.dec.between(dec - r, dec + r)
+    height = _zone_height(table)
+    if height is not None:
+        # lets the (zone, ra) index serve the box
+        band = sa.and_(table.zone.between(
+            int(np.floor((dec - r + 90) / height)),
+            int(np.floor((dec + r + 90) / height))
+        ), band)
+    if abs(dec) + r >= 90 or r >= 90:
+        return band
+
+    # the maximum RA offset of a point on the cone
+    halfwidth = np.degrees(np.arcsin(
+        np.sin(np.radians(r)) / np.cos(np.radians(dec))
+    )) * PREFILTER_PADDING
+    lo, hi = float(ra - halfwidth), float(ra + halfwidth)
+    if hi - lo >= 360:
+        return band
+    elif lo < 0:
+        window = sa.or_(table.ra >= lo + 360, table.ra <= hi)
+    elif hi > 360:
+        window = sa.or_(table.ra >= lo, table.ra <= hi - 360)
+    else:
+        window = table.ra.between(lo, hi)
+    return sa.and_(band, window)
+
+
+def _within_region(table, region):
+    """Return a clause selecting the rows of `table` inside `region`,
+    prefiltered with the bounding box of the cap around the region."""
+    xyz = (table.cx, table.cy, table.cz) if table.UNIT_VECTORS else None
+    cap = region.cap
+    return sa.and_(_bounding_box(table, cap, cap.radius),
+                   region.clause(table.ra, table.dec, xyz))
+
+
+class UnindexedSpatialBackend(SpatialBackendMixin, ProperMotionMixin):
     """A mixin indicating to the database that an object has sky coordinates.
     Classes that mix this class get no index on RA and DEC. Instead, a direct
     great circle distance formula is used in postgres for radial queries.
+
+    Radial queries against a single position are prefiltered with a box in
+    dec and RA that an index on (dec, ra) can serve; set `BTREE_INDEX = True`
+    on the mapped class to create one.
+
+    Set `UNIT_VECTORS = True` on the mapped class to also store the
+    cartesian unit vector of each object in generated columns (requires
+    PostgreSQL 12). Radial queries then compare chord lengths against a
+    precomputed constant instead of evaluating trigonometric functions for
+    every pair of rows.
+
+    Set `ZONE_HEIGHT` (in degrees) on the mapped class to divide the sky
+    into declination zones of that height, stored in a generated `zone`
+    column with a b-tree index on (zone, ra) (requires PostgreSQL 12). Joins
+    between two such tables with the same zone height then only compare
+    the rows of adjacent zones within an RA window of each other before
+    the exact distance, so they scale roughly linearly instead of
+    comparing every pair. A zone height close to the join radius works
+    well.
+
     Columns:
         ra: the icrs right ascension of the object in degrees
         dec: the icrs declination of the object in degrees
+        cx, cy, cz: (if UNIT_VECTORS) the components of the object's unit
+            vector, generated from ra and dec
+        zone: (if ZONE_HEIGHT) floor((dec + 90) / ZONE_HEIGHT)
     Indexes:
-        none
+        (if BTREE_INDEX) b-tree index on dec, ra
+        (if ZONE_HEIGHT) b-tree index on zone, ra
     Properties: skycoord: astropy.coordinates.SkyCoord representation of the
     object's coordinate
     """
 
+    # store unit vector columns alongside ra and dec
+    UNIT_VECTORS = False
+
+    # create a b-tree index on (dec, ra) for the bounding box prefilter
+    BTREE_INDEX = False
+
+    # height in degrees of the declination zones used to join tables, or
+    # None to not store zones
+    ZONE_HEIGHT = None
+
     # database-mapped
     ra = sa.Column(psql.DOUBLE_PRECISION)
     dec = sa.Column(psql.DOUBLE_PRECISION)
 
+    @declared_attr
+    def cx(cls):
+        if cls.UNIT_VECTORS:
+            return sa.Column(psql.DOUBLE_PRECISION, sa.Computed(
+                'cos(radians(dec)) * cos(radians(ra))', persisted=True))
+
+    @declared_attr
+    def cy(cls):
+        if cls.UNIT_VECTORS:
+            return sa.Column(psql.DOUBLE_PRECISION, sa.Computed(
+                'cos(radians(dec)) * sin(radians(ra))', persisted=True))
+
+    @declared_attr
+    def cz(cls):
+        if cls.UNIT_VECTORS:
+            return sa.Column(psql.DOUBLE_PRECISION, sa.Computed(
+                'sin(radians(dec))', persisted=True))
+
+    @declared_attr
+    def zone(cls):
+        if cls.ZONE_HEIGHT is not None:
+            height = float(cls.ZONE_HEIGHT)
+            return sa.Column(sa.Integer, sa.Computed(
+                f'CAST(floor((dec + 90) / {height!r}) AS INTEGER)',
+                persisted=True))
+
+    @declared_attr
+    def __table_args__(cls):
+        tn = cls.__tablename__
+        indexes = ()
+        if cls.BTREE_INDEX:
+            indexes += sa.Index(f'{tn}_dec_ra_idx', cls.dec, cls.ra),
+        if cls.ZONE_HEIGHT is not None:
+            indexes += sa.Index(f'{tn}_zone_ra_idx', cls.zone, cls.ra),
+        return indexes
+
     @property
     def skycoord(self):
         return SkyCoord(self.ra, self.dec, unit='deg')
 
+    @classmethod
+    def _cluster_order(cls):
+        """Cluster on the (zone, ra) index if the table has zones, or else
+        on the nested HEALPix index at CLUSTER_ORDER, computed in SQL."""
+        if cls.ZONE_HEIGHT is not None:
+            return f'{cls.__tablename__}_zone_ra_idx', None
+        return None, nested_pixel(sa.column('ra'), sa.column('dec'),
+                                  CLUSTER_ORDER)
+
     @hybrid_method
+    @instrumented('none', 'distance')
     def distance(self, other):
         """Return an SQLalchemy clause element that can be used to calculate
         the angular separation between `self` and `other` in arcsec.
@@ -45,6 +269,11 @@ class UnindexedSpatialBackend(object):
            will generate a clause element that can be used to filter a
            single table.
         """
+        if _unit_vector_mode(self, other):
+            chord = sa.func.sqrt(_chord_squared(self, other))
+            roundoff_safe = sa.func.least(chord / 2, 1)
+            return 2 * sa.func.asin(roundoff_safe) / RADIANS_PER_ARCSEC
+
         ca1 = sa.func.cos((90 - self.dec) * DEG_TO_RAD)
         ca2 = sa.func.cos((90 - other.dec) * DEG_TO_RAD)
         sa1 = sa.func.sin((90 - self.dec) * DEG_TO_RAD)
@@ -55,6 +284,7 @@ class UnindexedSpatialBackend(object):
         return sa.func.acos(roundoff_safe) / RADIANS_PER_ARCSEC
 
     @hybrid_method
+    @instrumented('none', 'radially_within')
     def radially_within(self, other, angular_sep_arcsec):
         """Return an SQLalchemy clause element that can be used as a join or
         filter condition for a radial query.
@@ -74,4 +304,126 @@ class UnindexedSpatialBackend(object):
            distance of one another.
         """
 
-        return self.distance(other) <= angular_sep_arcsec
+        if _unit_vector_mode(self, other):
+            # no trigonometry per pair: compare against a constant
+            max_chord = float(chord_length(angular_sep_arcsec))
+            clause = _chord_squared(self, other) <= max_chord * max_chord
+        else:
+            clause = self.distance(other) <= angular_sep_arcsec
+
+        # add a redundant, index friendly prefilter on the side that is a
+        # table, to avoid evaluating the exact clause on every row
+        if is_instance(self) and is_instance(other):
+            # between two instances there is no table to prefilter
+            prefilter = None
+        elif _zone_mode(self, other):
+            prefilter = _zone_window(self, other, angular_sep_arcsec)
+        elif isinstance(other, UnindexedSpatialBackend):
+            prefilter = _bounding_box(self, other, angular_sep_arcsec)
+        elif isinstance(self, UnindexedSpatialBackend):
+            prefilter = _bounding_box(other, self, angular_sep_arcsec)
+        else:
+            prefilter = _dec_band(self, other.dec, angular_sep_arcsec)
+        if prefilter is None:
+            return clause
+        return sa.and_(prefilter, clause)
+
+    @hybrid_method
+    @instrumented('none', 'within_polygon')
+    def within_polygon(self, vertices):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a polygon. Rows are prefiltered with the
+        RA, dec box around the polygon, then tested with a crossing number
+        test written as plain arithmetic, which uses the unit vector columns
+        if they exist.
+
+        Parameters
+        ----------
+
+        vertices: array-like
+           A sequence of (ra, dec) pairs in degrees. The edges are great
+           circle arcs and the polygon must fit within a hemisphere.
+        """
+        return _within_region(self, Polygon(vertices))
+
+    @hybrid_method
+    @instrumented('none', 'within_box')
+    def within_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a box bounded by lines of constant RA and
+        dec. The clause only compares ra and dec, so the (dec, ra) index
+        can serve it.
+
+        Parameters
+        ----------
+
+        ra_min, ra_max: float
+           The right ascension limits in degrees. If `ra_min` is greater
+           than `ra_max` the box wraps through RA = 0.
+
+        dec_min, dec_max: float
+           The declination limits in degrees.
+        """
+        box = Box(ra_min, ra_max, dec_min, dec_max)
+        return box.clause(self.ra, self.dec)
+
+    @hybrid_method
+    @instrumented('none', 'within_ellipse')
+    def within_ellipse(self, center, a, b, pa):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside an ellipse. Rows are prefiltered with the
+        RA, dec box around the ellipse's major axis circle.
+
+        Parameters
+        ----------
+
+        center: instance of UnindexedSpatialBackend or (ra, dec) pair
+           The center of the ellipse, in degrees.
+
+        a, b: float
+           The semi-major and semi-minor axes in arcseconds.
+
+        pa: float
+           The position angle of the major axis in degrees, east of north.
+        """
+        return _within_region(self, Ellipse(center, a, b, pa))
+
+    @classmethod
+    def radially_within_any(cls, session, ra, dec, angular_sep_arcsec):
+        """Return a query for all objects that lie within any of a set of
+        cones, in a single round trip. The cone centers are sent to postgres
+        as arrays and joined against the table using the great circle
+        distance formula.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to build the query with.
+
+        ra, dec: array-like
+           The icrs coordinates of the cone centers in degrees.
+
+        angular_sep_arcsec: float or array-like
+           The radius, in arcseconds, of every cone or of each cone.
+
+        Returns
+        -------
+
+        query: sqlalchemy.orm.Query
+           A query yielding `(center_index, object)` pairs, where
+           `center_index` is the position of the matching cone in `ra` and
+           `dec`. An object within several cones is returned once per cone.
+        """
+
+        centers = cone_centers(ra, dec, angular_sep_arcsec,
+                               unit_vectors=cls.UNIT_VECTORS)
+        if cls.UNIT_VECTORS:
+            chord = centers.c.chord
+            clause = _chord_squared(cls, centers.c) <= chord * chord
+        else:
+            clause = cls.distance(centers.c) <= centers.c.radius
+        band = _dec_band(cls, centers.c.dec, centers.c.radius)
+        return session.query(centers.c.center_index, cls).select_from(
+            centers
+        ).join(cls, sa.and_(band, clause))
@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import sqlalchemy as sa
+
+from .stream import pairs_statement, pairs_array, PAIR_DTYPE
+
+
+DEGREES_PER_ARCSEC = 1 / 3600.
+
+# widen the zone margins slightly so rounding never drops a match
+PREFILTER_PADDING = 1 + 1e-9
+
+# zones per worker, so that dense zones do not leave the other workers idle
+DEFAULT_ZONES_PER_WORKER = 4
+
+
+def dec_zones(n_zones):
+    """Return the `n_zones + 1` declination boundaries, in degrees, of zones
+    of equal area on the sphere."""
+    return np.degrees(np.arcsin(np.linspace(-1., 1., n_zones + 1)))
+
+
+def _run(session_factory, statement):
+    session = session_factory()
+    try:
+        return pairs_array(session.execute(statement).fetchall())
+    finally:
+        session.close()
+
+
+def parallel_crossmatch(session_factory, a, b, angular_sep_arcsec,
+                        n_workers, n_zones=None):
+    """Find all pairs of a `radially_within` join of two tables by splitting
+    the sky into declination zones and joining the zones concurrently, each
+    on its own connection, so the join uses several database processes.
+
+    Each pair belongs to the zone of its `a` object, and the `b` objects of
+    a zone are read with a margin of `angular_sep_arcsec` on either side, so
+    pairs across zone boundaries are found exactly once and the result is
+    the same as that of the serial join.
+
+    Parameters
+    ----------
+
+    session_factory: callable
+       Returns a new session, e.g. a `sqlalchemy.orm.sessionmaker`. It is
+       called once per zone, from the worker threads, so its engine's pool
+       should hold at least `n_workers` connections.
+
+    a, b: mapped classes or aliases using the same spatial backend
+       The tables to join. If `b` is `a`, the table is joined to itself.
+
+    angular_sep_arcsec: float
+       The radius, in arcseconds, of the join.
+
+    n_workers: int
+       The number of zones joined at a time.
+
+    n_zones: int, optional
+       The number of declination zones, of equal area. By default, four per
+       worker.
+
+    Returns
+    -------
+
+    pairs: numpy.ndarray
+       A record array with fields `id_a`, `id_b` (the primary keys of the
+       objects) and `separation` (in arcseconds), sorted by `id_a` then
+       `id_b`.
+    """
+
+    if n_workers < 1:
+        raise ValueError('`n_workers` must be positive.')
+    if n_zones is None:
+        n_zones = DEFAULT_ZONES_PER_WORKER * n_workers
+    if n_zones < 1:
+        raise ValueError('`n_zones` must be positive.')
+
+    statement, a, b = pairs_statement(a, b, angular_sep_arcsec)
+    margin = angular_sep_arcsec * DEGREES_PER_ARCSEC * PREFILTER_PADDING
+    bounds = dec_zones(n_zones)
+
+    statements = []
+    for i, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+        # the first and last zones are open-ended so that no object is
+        # lost to rounding at the poles
+        owned = []
+        if i > 0:
+            owned.append(a.dec >= lo)
+        if i < n_zones - 1:
+            owned.append(a.dec < hi)
+        statements.append(statement.where(sa.and_(
+            *owned, b.dec.between(lo - margin, hi + margin)
+        )))
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        zones = list(executor.map(lambda s: _run(session_factory, s),
+                                  statements))
+
+    pairs = np.concatenate(zones) if zones else np.zeros(0, PAIR_DTYPE)
+    return pairs[np.lexsort((pairs['id_b'], pairs['id_a']))]
@@ -0,0 +1,287 @@
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as psql
+from sqlalchemy.sql.expression import Grouping
+
+from .match import unit_vectors
+
+
+DEG_TO_RAD = np.pi / 180.
+RADIANS_PER_ARCSEC = DEG_TO_RAD / 3600.
+
+# the finest HEALPix order whose nested indices fit in a BIGINT
+MAX_ORDER = 29
+
+# ring and phase offsets of the 12 base pixels (faces)
+JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+
+# NumPy implementation of the nested HEALPix scheme (Gorski et al. 2005)
+
+
+def _spread_bits(v):
+    """Move bit i of each value to bit 2i."""
+    v = v.astype(np.uint64)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)]:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def _compact_bits(v):
+    """Move bit 2i of each value to bit i, discarding the odd bits."""
+    v = v.astype(np.uint64) & np.uint64(0x5555555555555555)
+    for shift, mask in [(1, 0x3333333333333333), (2, 0x0F0F0F0F0F0F0F0F),
+                        (4, 0x00FF00FF00FF00FF), (8, 0x0000FFFF0000FFFF),
+                        (16, 0x00000000FFFFFFFF)]:
+        v = (v | (v >> np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def ang2pix(ra, dec, order=MAX_ORDER):
+    """Return the nested HEALPix indices at `order` of the icrs positions
+    `ra`, `dec` (degrees)."""
+
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    nside = 1 << order
+
+    z = np.sin(dec * DEG_TO_RAD)
+    za = np.abs(z)
+    tt = np.mod(ra, 360.) / 90.  # in [0, 4)
+    tt = np.where(tt >= 4, 0., tt)
+
+    # equatorial region
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp = jp >> order
+    ifm = jm >> order
+    face_eq = np.where(ifp == ifm, ifp | 4,
+                       np.where(ifp < ifm, ifp, ifm + 8))
+    ix_eq = jm & (nside - 1)
+    iy_eq = nside - (jp & (nside - 1)) - 1
+
+    # polar caps; use cos(dec) rather than sqrt(1 - |z|) for precision
+    ntt = np.minimum(tt.astype(np.int64), 3)
+    tp = tt - ntt
+    tmp = nside * np.cos(dec * DEG_TO_RAD) * np.sqrt(3. / (1. + za))
+    jp_pol = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm_pol = np.minimum(((1. - tp) * tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+    face_pol = np.where(north, ntt, ntt + 8)
+    ix_pol = np.where(north, nside - jm_pol - 1, jp_pol)
+    iy_pol = np.where(north, nside - jp_pol - 1, jm_pol)
+
+    equatorial = za <= 2. / 3.
+    face = np.where(equatorial, face_eq, face_pol).astype(np.uint64)
+    ix = np.where(equatorial, ix_eq, ix_pol)
+    iy = np.where(equatorial, iy_eq, iy_pol)
+
+    ipix = (face << np.uint64(2 * order)) | _spread_bits(ix) | \
+        (_spread_bits(iy) << np.uint64(1))
+    return ipix.astype(np.int64)
+
+
+def spatial_order(ra, dec):
+    """Return the permutation that sorts positions along the nested HEALPix
+    curve, so that objects close on the sky end up close together."""
+    return np.argsort(ang2pix(ra, dec), kind='stable')
+
+
+def pix2face(ipix, order):
+    """Return the base pixel (face) and the pixel coordinates ix, iy within
+    it of nested HEALPix pixels `ipix` at `order`."""
+
+    ipix = np.asarray(ipix, dtype=np.int64)
+    face = ipix >> (2 * order)
+    ipf = (ipix & ((1 << (2 * order)) - 1)).astype(np.uint64)
+    ix = _compact_bits(ipf).astype(np.int64)
+    iy = _compact_bits(ipf >> np.uint64(1)).astype(np.int64)
+    return face, ix, iy
+
+
+def pix2vec(ipix, order):
+    """Return the (N, 3) unit vectors of the centers of nested HEALPix
+    pixels `ipix` at `order`."""
+
+    nside = 1 << order
+    face, ix, iy = pix2face(ipix, order)
+
+    jr = JRLL[face] * nside - ix - iy - 1
+    nr = np.where(jr < nside, jr,
+                  np.where(jr > 3 * nside, 4 * nside - jr, nside))
+    kshift = np.where((jr < nside) | (jr > 3 * nside), 0, (jr - nside) & 1)
+
+    nr_f = nr.astype(float)
+    fact = 1. / (3. * nside * nside)
+    z = np.where(jr < nside, 1. - nr_f * nr_f * fact,
+                 np.where(jr > 3 * nside, nr_f * nr_f * fact - 1.,
+                          (2 * nside - jr) * 2. / (3. * nside)))
+    # sin(theta), computed without cancellation near the poles
+    polar = (jr < nside) | (jr > 3 * nside)
+    one_minus_za = nr_f * nr_f * fact
+    sth = np.where(polar, np.sqrt(one_minus_za * (2. - one_minus_za)),
+                   np.sqrt(np.clip((1. - z) * (1. + z), 0, None)))
+
+    jp = (JPLL[face] * nr + ix - iy + 1 + kshift) // 2
+    jp = np.where(jp > 4 * nside, jp - 4 * nside, jp)
+    jp = np.where(jp < 1, jp + 4 * nside, jp)
+    phi = (jp - (kshift + 1) * 0.5) * (np.pi / 2 / nr_f)
+
+    return np.stack([sth * np.cos(phi), sth * np.sin(phi), z], axis=-1)
+
+
+def max_pixrad(order):
+    """Return the maximum angular distance (radians) between the center of a
+    HEALPix pixel at `order` and any of its corners."""
+
+    nside = 1 << order
+    za, phia = 2. / 3., np.pi / (4 * nside)
+    t1 = (1. - 1. / nside) ** 2
+    zb, phib = 1. - t1 / 3., 0.
+    va = np.array([np.sqrt(1 - za * za) * np.cos(phia),
+                   np.sqrt(1 - za * za) * np.sin(phia), za])
+    vb = np.array([np.sqrt(1 - zb * zb) * np.cos(phib),
+                   np.sqrt(1 - zb * zb) * np.sin(phib), zb])
+    return 2 * np.arcsin(np.linalg.norm(va - vb) / 2)
+
+
+def _angdist(vecs, vec):
+    chord = np.linalg.norm(vecs - vec, axis=-1)
+    return 2 * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def merge_ranges(lo, hi):
+    """Sort inclusive [lo, hi] index ranges and merge those that overlap or
+    touch."""
+
+    lo = np.asarray(lo, dtype=np.int64)
+    hi = np.asarray(hi, dtype=np.int64)
+    if len(lo) == 0:
+        return lo, hi
+    order = np.argsort(lo, kind='mergesort')
+    lo, hi = lo[order], hi[order]
+    reach = np.maximum.accumulate(hi)
+    start = np.concatenate([[True], lo[1:] > reach[:-1] + 1])
+    groups = np.cumsum(start) - 1
+    merged_hi = np.zeros(groups[-1] + 1, dtype=np.int64)
+    np.maximum.at(merged_hi, groups, hi)
+    return lo[start], merged_hi
+
+
+def cone_ranges(ra, dec, angular_sep_arcsec, order=MAX_ORDER):
+    """Return the inclusive ranges of nested HEALPix indices at `order` of
+    the pixels that may overlap the cone of radius `angular_sep_arcsec`
+    around `ra`, `dec` (degrees). The ranges cover the cone completely but
+    also some area around it, so they must be followed by an exact distance
+    cut.
+
+    Returns
+    -------
+
+    lo, hi: numpy.ndarray
+       The first and last index of each range, sorted and merged.
+    """
+
+    center = unit_vectors(ra, dec)
+    radius = angular_sep_arcsec * RADIANS_PER_ARCSEC
+
+    # refine until the pixels are a few times smaller than the cone, so the
+    # ranges hug its boundary without producing too many of them
+    depth = 0
+    while depth < order and max_pixrad(depth) > radius / 4:
+        depth += 1
+
+    lo, hi = [], []
+    candidates = np.arange(12, dtype=np.int64)
+    for d in range(depth + 1):
+        pixrad = max_pixrad(d) * (1 + 1e-9)
+        dist = _angdist(pix2vec(candidates, d), center)
+        candidates = candidates[dist <= radius + pixrad]
+        dist = dist[dist <= radius + pixrad]
+
+        if d < depth:
+            # pixels entirely inside the cone need no further refinement
+            inside = dist + pixrad <= radius
+            final = candidates[inside]
+            candidates = candidates[~inside]
+            candidates = (candidates[:, None] * 4 +
+                          np.arange(4, dtype=np.int64)).ravel()
+        else:
+            final = candidates
+
+        shift = 2 * (order - d)
+        lo.append(final << shift)
+        hi.append(((final + 1) << shift) - 1)
+
+    return merge_ranges(np.concatenate(lo), np.concatenate(hi))
+
+
+# The same scheme in SQL, for tables that do not store a HEALPix index
+
+
+def _bigint_floor(value):
+    return sa.cast(sa.func.floor(value), sa.BigInteger)
+
+
+def face_pixels(ra, dec, order):
+    """Return SQL expressions for the base pixel (face) of the positions
+    `ra`, `dec` (degrees) and for their pixel coordinates ix, iy on it at
+    `order`, computed with the same floating point operations as `ang2pix`
+    so that the two agree exactly. The nested index itself is not built, as
+    interleaving the bits of ix and iy is awkward in SQL; a cell of a
+    coarser order is a box of ix and iy instead (see `nested_pixel` for
+    coarse orders)."""
+
+    nside = 1 << order
+    z = sa.func.sin(sa.func.radians(dec))
+    za = sa.func.abs(z)
+    tt = (ra - 360. * sa.func.floor(ra / 360.)) / 90.  # in [0, 4)
+
+    # equatorial region
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = _bigint_floor(temp1 - temp2)
+    jm = _bigint_floor(temp1 + temp2)
+    ifp = jp.op('>>')(order)
+    ifm = jm.op('>>')(order)
+    face_eq = sa.case([(ifp == ifm, ifp.op('|')(4)), (ifp < ifm, ifp)],
+                      else_=ifm + 8)
+    ix_eq = jm.op('&')(nside - 1)
+    iy_eq = nside - jp.op('&')(nside - 1) - 1
+
+    # polar caps; use cos(dec) rather than sqrt(1 - |z|) for precision
+    ntt = sa.func.least(_bigint_floor(tt), 3)
+    tp = tt - ntt
+    # parenthesized, so that it is rounded as in `ang2pix`
+    tmp = Grouping(nside * sa.func.cos(sa.func.radians(dec)) *
+                   sa.func.sqrt(3. / (1. + za)))
+    jp_pol = sa.func.least(_bigint_floor(tp * tmp), nside - 1)
+    jm_pol = sa.func.least(_bigint_floor((1. - tp) * tmp), nside - 1)
+    north = z >= 0
+    face_pol = sa.case([(north, ntt)], else_=ntt + 8)
+    ix_pol = sa.case([(north, nside - jm_pol - 1)], else_=jp_pol)
+    iy_pol = sa.case([(north, nside - jp_pol - 1)], else_=jm_pol)
+
+    equatorial = za <= 2. / 3.
+    face = sa.case([(equatorial, face_eq)], else_=face_pol)
+    ix = sa.case([(equatorial, ix_eq)], else_=ix_pol)
+    iy = sa.case([(equatorial, iy_eq)], else_=iy_pol)
+    return face, ix, iy
+
+
+def nested_pixel(ra, dec, order):
+    """Return an SQL expression for the nested HEALPix index at `order` of
+    the positions `ra`, `dec` (degrees), equal to `ang2pix`. The bits of ix
+    and iy are interleaved by looking them up in an array literal of
+    2**order spread values, so this is only meant for coarse orders."""
+
+    face, ix, iy = face_pixels(ra, dec, order)
+    spread = psql.array([int(v) for v in
+                         _spread_bits(np.arange(1 << order, dtype=np.int64))])
+    # postgres arrays are indexed from 1
+    return face * (1 << (2 * order)) + spread[ix + 1] + 2 * spread[iy + 1]
@@ -0,0 +1,157 @@
+import json
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+
+
+# suffixes of the names of the indexes the spatial backends create in
+# `__table_args__`
+SPATIAL_INDEX_SUFFIXES = ('_q3c_ang2ipix_idx', '_postgis_radec_index',
+                          '_postgis_xyz_idx', '_hpx_idx', '_dec_ra_idx',
+                          '_zone_ra_idx')
+
+
+class IndexNotUsedError(RuntimeError):
+    """Raised when a query that should scan a spatial index does not."""
+
+
+def _walk(node):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from _walk(child)
+
+
+class PlanReport(object):
+    """A summary of the plan postgres executed for a query.
+
+    Attributes
+    ----------
+
+    plan: dict
+       The root node of the JSON plan.
+
+    planning_ms, execution_ms: float
+       The planning and execution times reported by postgres. The
+       execution time is None unless the query was explained with ANALYZE.
+
+    indexes: set of str
+       The names of all indexes scanned.
+
+    spatial_indexes: set of str
+       The names of the spatial backends' indexes scanned.
+
+    seq_scans: set of str
+       The names of the tables read with a sequential scan.
+
+    rows_returned: int
+       The number of rows the query returned.
+
+    rows_scanned: int
+       The number of rows read from tables, including those discarded by
+       filters and index rechecks.
+
+    shared_hit_blocks, shared_read_blocks: int
+       The number of shared buffer blocks found in the cache and read from
+       disk.
+    """
+
+    def __init__(self, explained):
+        top = explained[0]
+        self.plan = top['Plan']
+        self.planning_ms = top.get('Planning Time')
+        self.execution_ms = top.get('Execution Time')
+
+        nodes = list(_walk(self.plan))
+        self.indexes = set(n['Index Name'] for n in nodes
+                           if 'Index Name' in n)
+        self.spatial_indexes = set(name for name in self.indexes
+                                   if name.endswith(SPATIAL_INDEX_SUFFIXES))
+        self.seq_scans = set(n['Relation Name'] for n in nodes
+                             if n['Node Type'] == 'Seq Scan')
+
+        def rows(node, *keys):
+            loops = node.get('Actual Loops', 1)
+            return sum(node.get(k, 0) for k in keys) * loops
+
+        self.rows_returned = rows(self.plan, 'Actual Rows')
+        self.rows_scanned = sum(
+            rows(n, 'Actual Rows', 'Rows Removed by Filter',
+                 'Rows Removed by Index Recheck')
+            for n in nodes if 'Relation Name' in n
+        )
+        self.shared_hit_blocks = self.plan.get('Shared Hit Blocks')
+        self.shared_read_blocks = self.plan.get('Shared Read Blocks')
+
+    @property
+    def uses_spatial_index(self):
+        return len(self.spatial_indexes) > 0
+
+    def __repr__(self):
+        return (f'<PlanReport spatial_indexes={sorted(self.spatial_indexes)} '
+                f'seq_scans={sorted(self.seq_scans)} '
+                f'rows_scanned={self.rows_scanned} '
+                f'rows_returned={self.rows_returned} '
+                f'execution_ms={self.execution_ms}>')
+
+
+@contextmanager
+def _explaining(connection, options):
+    """Run the statements executed on `connection` under EXPLAIN."""
+
+    def prepend(conn, cursor, statement, parameters, context, executemany):
+        return f'EXPLAIN ({options}) {statement}', parameters
+
+    sa.event.listen(connection, 'before_cursor_execute', prepend,
+                    retval=True)
+    try:
+        yield
+    finally:
+        sa.event.remove(connection, 'before_cursor_execute', prepend)
+
+
+def explain(session, query, analyze=True, require_index=False):
+    """Explain a query and report whether it scanned a spatial index.
+
+    The statement is compiled and its parameters processed exactly as they
+    would be to run it, and executed on the session's connection with
+    `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` prepended.
+
+    Parameters
+    ----------
+
+    session: sqlalchemy.orm.Session
+       The session to explain the query with.
+
+    query: sqlalchemy.orm.Query or selectable
+       The query to explain. It must be a SELECT, since with `analyze` it
+       is executed.
+
+    analyze: bool
+       Whether to execute the query to collect timings, row counts and
+       buffer usage, or only plan it.
+
+    require_index: bool
+       If True, raise IndexNotUsedError unless one of the spatial backends'
+       indexes is scanned.
+
+    Returns
+    -------
+
+    report: PlanReport
+       The summary of the plan.
+    """
+
+    statement = getattr(query, 'statement', query)
+    options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+    connection = session.connection()
+    with _explaining(connection, options):
+        explained = connection.execute(statement).fetchall()[0][0]
+    if isinstance(explained, str):
+        explained = json.loads(explained)
+
+    report = PlanReport(explained)
+    if require_index and not report.uses_spatial_index:
+        raise IndexNotUsedError(
+            f'The query did not scan a spatial index: {report!r}'
+        )
+    return report
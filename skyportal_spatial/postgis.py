@@ -4,10 +4,18 @@ from astropy.coordinates import SkyCoord
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 import binascii
+import struct
 from sqlalchemy.sql import expression
 from sqlalchemy.types import UserDefinedType
 from sqlalchemy import func
 
+from .bulk import ewkb_points
+from .util import cone_centers
+from .regions import Polygon, Box, Ellipse
+from .instrument import instrumented
+from .propermotion import ProperMotionMixin
+from .backend import SpatialBackendMixin
+
 
 RADIANS_PER_ARCSEC = np.pi / 180. / 3600.
 
@@ -18,6 +26,8 @@ RADIANS_PER_ARCSEC = np.pi / 180. / 3600.
 class GisElement(object):
     """Represents a geometry value."""
 
+    __slots__ = ()
+
     def __str__(self):
         return self.desc
 
@@ -57,6 +67,101 @@ class TextualGisElement(GisElement, expression.Function):
         )
 
 
+class GeographyPoint(GisElement):
+    """Represents a Geography point value held in python as two floats.
+    Either coordinate may be None while the point is being built up one
+    coordinate at a time."""
+
+    __slots__ = ('lon', 'lat')
+
+    # little-endian WKB point: byte order, geometry type, x, y
+    WKB_FORMAT = '<BIdd'
+
+    def __init__(self, lon, lat):
+        self.lon = lon
+        self.lat = lat
+
+    @classmethod
+    def from_wkb(cls, data):
+        fmt = '<dd' if data[0] == 1 else '>dd'
+        lon, lat = struct.unpack_from(fmt, data, 5)
+        if lon != lon or lat != lat:  # POINT EMPTY is encoded as NaN
+            return cls(None, None)
+        return cls(lon, lat)
+
+    @classmethod
+    def from_wkt(cls, wkt):
+        coords = [None if c == 'NULL' else float(c)
+                  for c in wkt.strip()[6:-1].split()]
+        return cls(*coords)
+
+    @property
+    def complete(self):
+        return self.lon is not None and self.lat is not None
+
+    @property
+    def desc(self):
+        lon = 'NULL' if self.lon is None else repr(float(self.lon))
+        lat = 'NULL' if self.lat is None else repr(float(self.lat))
+        return f'POINT({lon} {lat})'
+
+    @property
+    def wkb(self):
+        return struct.pack(self.WKB_FORMAT, 1, 1, self.lon, self.lat)
+
+    def __eq__(self, other):
+        if not isinstance(other, GeographyPoint):
+            return NotImplemented
+        return self.lon == other.lon and self.lat == other.lat
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        return hash((self.lon, self.lat))
+
+
+def _as_geography(radec):
+    """Return a SQL expression for the `radec` attribute of a
+    PostGISSpatialBackend class or instance."""
+
+    if isinstance(radec, GeographyPoint):
+        if not radec.complete:
+            return sa.null()
+        return func.ST_GeogFromText(radec.desc, type_=Geography(2))
+    return radec
+
+
+def point_geography(ra, dec):
+    """Return a SQL expression for the geography point of SQL expressions
+    for ra and dec in degrees, with the same RA shift as the stored
+    points."""
+    return sa.cast(func.ST_MakePoint(ra - 180., dec),
+                   Geography(2, coerce_="binary"))
+
+
+def _polygon_geography(polygon):
+    """Return a SQL expression for a regions.Polygon as a geography, with
+    the same RA shift as the stored points."""
+
+    ring = [(ra - 180, dec) for ra, dec in zip(polygon.ra, polygon.dec)]
+    ring.append(ring[0])
+    coords = ', '.join(f'{repr(float(lon))} {repr(float(lat))}'
+                       for lon, lat in ring)
+    return func.ST_GeogFromText(f'POLYGON(({coords}))', type_=Geography(2))
+
+
+def _within_cap(table, cap):
+    """Return an index friendly clause selecting the rows of `table` inside
+    a regions.Cap."""
+
+    center = _as_geography(GeographyPoint(cap.ra - 180, cap.dec))
+    eqdist = table.RADIUS * cap.radius * RADIANS_PER_ARCSEC
+    return sa.func.ST_DWithin(_as_geography(table.radec), center, eqdist,
+                              False)
+
+
 # SQL datatypes.
 
 
@@ -106,8 +211,16 @@ class Geography(UserDefinedType):
             assert False
 
     def bind_processor(self, dialect):
+        binary = self.coerce == "binary"
+
         def process(value):
-            if isinstance(value, GisElement):
+            if binary and isinstance(value, str):
+                value = GeographyPoint.from_wkt(value)
+            if isinstance(value, GeographyPoint):
+                if not value.complete:
+                    return None
+                return value.wkb if binary else value.desc
+            elif isinstance(value, GisElement):
                 return value.desc
             else:
                 return value
@@ -118,7 +231,9 @@ class Geography(UserDefinedType):
         if self.coerce == "text":
             fac = TextualGisElement
         elif self.coerce == "binary":
-            fac = BinaryGisElement
+            # decode the WKB straight into floats rather than keeping a
+            # SQL expression object around for every row
+            fac = GeographyPoint.from_wkb
         else:
             assert False
 
@@ -136,7 +251,7 @@ class Geography(UserDefinedType):
         )
 
 
-class PostGISSpatialBackend(object):
+class PostGISSpatialBackend(SpatialBackendMixin, ProperMotionMixin):
     """A mixin indicating to the database that an object has sky coordinates.
     Classes that mix this class get a PostGIS spatial index on ra and dec.
 
@@ -156,36 +271,32 @@ class PostGISSpatialBackend(object):
 
     # standard spherical geometry WGS 84
     RADIUS = 6370986. * 1.00000357  # meters, for converting angles to distances
-    DEFAULT = 'POINT(NULL NULL)'
 
-    # how RA/DEC is stored
-    radec = sa.Column(Geography(2))
+    # how RA/DEC is stored. Points are sent and received as WKB and held in
+    # python as a GeographyPoint, so reading ra and dec does not parse text
+    radec = sa.Column(Geography(2, coerce_="binary"))
 
-    def _splstr(self):
-        return str(self.radec)[6:-1].split()
-
-    def _complete(self):
-        if self.radec is None:
-            return False
-        else:
-            for key in self._splstr():
-                if key == 'NULL':
-                    return False
-        return True
+    def _point(self):
+        radec = self.radec
+        if radec is None or isinstance(radec, GeographyPoint):
+            return radec
+        return GeographyPoint.from_wkt(str(radec))
 
     @hybrid_property
     def ra(self):
-        if not self._complete():
+        point = self._point()
+        if point is None or not point.complete:
             return None
         else:
-            return float(self._splstr()[0]) + 180
+            return point.lon + 180
 
     @hybrid_property
     def dec(self):
-        if not self._complete():
+        point = self._point()
+        if point is None or not point.complete:
             return None
         else:
-            return float(self._splstr()[1])
+            return point.lat
 
     @ra.expression
     def ra(self):
@@ -197,15 +308,16 @@ class PostGISSpatialBackend(object):
 
     @ra.setter
     def ra(self, value):
-        if self.radec is None:
-            self.radec = self.DEFAULT
-        self.radec = f'POINT({value - 180} {self.dec})'
+        point = self._point()
+        lat = None if point is None else point.lat
+        lon = None if value is None else value - 180
+        self.radec = GeographyPoint(lon, lat)
 
     @dec.setter
     def dec(self, value):
-        if self.radec is None:
-            self.radec = self.DEFAULT
-        self.radec = f'POINT({self.ra} {value})'
+        point = self._point()
+        lon = None if point is None else point.lon
+        self.radec = GeographyPoint(lon, value)
 
     @property
     def skycoord(self):
@@ -222,7 +334,20 @@ class PostGISSpatialBackend(object):
         return sa.Index(f'{tn}_postgis_radec_index', cls.radec,
                         postgresql_using='spgist'),
 
+    @classmethod
+    def _cluster_order(cls):
+        """Cluster on the geohash of the points, a Z-order curve, as the
+        SP-GiST index cannot be clustered on."""
+        return None, 'ST_GeoHash(CAST(radec AS geometry))'
+
+    @classmethod
+    def _copy_columns(cls, ra, dec):
+        """Encode the geography column as binary EWKB for `bulk_load`, so
+        no WKT is formatted or parsed."""
+        return {'radec': ewkb_points(ra - 180, dec)}
+
     @hybrid_method
+    @instrumented('postgis', 'distance')
     def distance(self, other):
         """Return an SQLalchemy clause element that can be used to calculate
         the angular separation between `self` and `other` in arcsec.
@@ -237,10 +362,12 @@ class PostGISSpatialBackend(object):
            single table.
         """
 
-        dist_m = sa.func.ST_Distance(self.radec, other.radec, False)
+        dist_m = sa.func.ST_Distance(_as_geography(self.radec),
+                                     _as_geography(other.radec), False)
         return dist_m / self.RADIUS / RADIANS_PER_ARCSEC
 
     @hybrid_method
+    @instrumented('postgis', 'radially_within')
     def radially_within(self, other, angular_sep_arcsec):
         """Return an SQLalchemy clause element that can be used as a join or
         filter condition for a radial query.
@@ -266,4 +393,116 @@ class PostGISSpatialBackend(object):
 
         # spatial information from this class
         # this is the filter / join clause
-        return sa.func.ST_DWithin(self.radec, other.radec, eqdist, False)
+        return sa.func.ST_DWithin(_as_geography(self.radec),
+                                  _as_geography(other.radec), eqdist, False)
+
+    @hybrid_method
+    @instrumented('postgis', 'within_polygon')
+    def within_polygon(self, vertices):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a polygon, using `ST_Covers` on a geography
+        polygon so the spatial index is scanned.
+
+        Parameters
+        ----------
+
+        vertices: array-like
+           A sequence of (ra, dec) pairs in degrees. The edges are great
+           circle arcs and the polygon must fit within a hemisphere.
+        """
+
+        polygon = Polygon(vertices)
+        return sa.func.ST_Covers(_polygon_geography(polygon),
+                                 _as_geography(self.radec))
+
+    @hybrid_method
+    @instrumented('postgis', 'within_box')
+    def within_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a box bounded by lines of constant RA and
+        dec. The spatial index is scanned for the cone circumscribing the
+        box, and the rows found are cut on the box itself.
+
+        Parameters
+        ----------
+
+        ra_min, ra_max: float
+           The right ascension limits in degrees. If `ra_min` is greater
+           than `ra_max` the box wraps through RA = 0.
+
+        dec_min, dec_max: float
+           The declination limits in degrees.
+        """
+
+        box = Box(ra_min, ra_max, dec_min, dec_max)
+        return sa.and_(_within_cap(self, box.cap),
+                       box.clause(self.ra, self.dec))
+
+    @hybrid_method
+    @instrumented('postgis', 'within_ellipse')
+    def within_ellipse(self, center, a, b, pa):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside an ellipse. The spatial index is scanned
+        for the circle of the major axis, and the rows found are cut on the
+        ellipse itself.
+
+        Parameters
+        ----------
+
+        center: instance of PostGISSpatialBackend or (ra, dec) pair
+           The center of the ellipse, in degrees.
+
+        a, b: float
+           The semi-major and semi-minor axes in arcseconds.
+
+        pa: float
+           The position angle of the major axis in degrees, east of north.
+        """
+
+        ellipse = Ellipse(center, a, b, pa)
+        return sa.and_(_within_cap(self, ellipse.cap),
+                       ellipse.clause(self.ra, self.dec))
+
+    @classmethod
+    def radially_within_any(cls, session, ra, dec, angular_sep_arcsec):
+        """Return a query for all objects that lie within any of a set of
+        cones, in a single round trip. The cone centers are sent to postgres
+        as arrays and joined against the table using `ST_DWithin`, so each
+        cone is an index scan.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to build the query with.
+
+        ra, dec: array-like
+           The icrs coordinates of the cone centers in degrees.
+
+        angular_sep_arcsec: float or array-like
+           The radius, in arcseconds, of every cone or of each cone.
+
+        Returns
+        -------
+
+        query: sqlalchemy.orm.Query
+           A query yielding `(center_index, object)` pairs, where
+           `center_index` is the position of the matching cone in `ra` and
+           `dec`. An object within several cones is returned once per cone.
+        """
+
+        centers = cone_centers(ra, dec, angular_sep_arcsec)
+        center = sa.cast(sa.func.ST_SetSRID(sa.func.ST_MakePoint(
+            centers.c.ra - 180., centers.c.dec
+        ), 4326), Geography(2))
+        eqdist = cls.RADIUS * centers.c.radius * RADIANS_PER_ARCSEC
+        clause = sa.func.ST_DWithin(center, cls.radec, eqdist, False)
+        return session.query(centers.c.center_index, cls).select_from(
+            centers
+        ).join(cls, clause)
+
+    @staticmethod
+    def _nearest_order(target, other):
+        """Order by the geography `<->` distance operator, which the SP-GiST
+        index serves as a k-nearest-neighbour scan."""
+        return target.radec.op('<->')(_as_geography(other.radec))
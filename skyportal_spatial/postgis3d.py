@@ -0,0 +1,258 @@
+import sqlalchemy as sa
+from astropy.coordinates import SkyCoord
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.ext.hybrid import hybrid_method
+from sqlalchemy.dialects import postgresql as psql
+from sqlalchemy.types import UserDefinedType
+
+from .util import cone_centers, is_instance
+from .match import unit_vectors, chord_length
+from .regions import Polygon, Box, Ellipse
+from .instrument import instrumented
+from .propermotion import ProperMotionMixin
+from .backend import SpatialBackendMixin
+
+
+class PointZ(UserDefinedType):
+    """A PostGIS 3D cartesian geometry point, without an SRID."""
+
+    def get_col_spec(self):
+        return 'GEOMETRY(POINTZ)'
+
+
+def _xyz(obj):
+    """Return the stored unit vector point of a class, alias or selectable,
+    or the unit vector point of an instance from its ra and dec."""
+    if is_instance(obj):
+        x, y, z = (float(c) for c in unit_vectors(obj.ra, obj.dec))
+        return sa.func.ST_MakePoint(x, y, z, type_=PointZ)
+    return obj.xyz
+
+
+def _chord_to_arcsec(chord):
+    """SQL expression converting the distance between two unit vectors to
+    an angular separation in arcsec. 2 asin(chord / 2) is exact, unlike
+    the arccos of a dot product, which loses precision at small
+    separations."""
+    return sa.func.degrees(
+        2 * sa.func.asin(sa.func.least(chord / 2, 1))
+    ) * 3600.
+
+
+def _within_cap(table, cap):
+    """Return an index friendly clause selecting the rows of `table` inside
+    a regions.Cap."""
+    x, y, z = (float(c) for c in unit_vectors(cap.ra, cap.dec))
+    center = sa.func.ST_MakePoint(x, y, z, type_=PointZ)
+    return sa.func.ST_3DDWithin(table.xyz, center,
+                                float(chord_length(cap.radius)))
+
+
+def _within_region(table, region):
+    xyz = tuple(f(table.xyz) for f in (sa.func.ST_X, sa.func.ST_Y,
+                                       sa.func.ST_Z))
+    return sa.and_(_within_cap(table, region.cap),
+                   region.clause(table.ra, table.dec, xyz=xyz))
+
+
+class PostGIS3DSpatialBackend(SpatialBackendMixin, ProperMotionMixin):
+    """A mixin indicating to the database that an object has sky coordinates.
+    Classes that mix this class store each position as its unit vector on
+    the celestial sphere in a 3D cartesian PostGIS geometry, with an
+    n-dimensional GiST index on it.
+
+    Unlike PostGISSpatialBackend, which stores geography points on a
+    scaled Earth and so runs geodesic math on every comparison, radial
+    queries compare the straight-line (chord) distances between unit
+    vectors, which is planar math, and RA is stored as is. The geometry is
+    a generated column computed from ra and dec (requires PostgreSQL 12).
+
+    Columns:
+        ra: the icrs right ascension of the object in degrees
+        dec: the icrs declination of the object in degrees
+        xyz: the object's unit vector as a POINTZ geometry (deferred)
+    Indexes:
+        n-dimensional GiST index on xyz
+    Properties: skycoord: astropy.coordinates.SkyCoord representation of the
+    object's coordinate
+    """
+
+    # database-mapped
+    ra = sa.Column(psql.DOUBLE_PRECISION)
+    dec = sa.Column(psql.DOUBLE_PRECISION)
+
+    @declared_attr
+    def xyz(cls):
+        return sa.orm.deferred(sa.Column(PointZ, sa.Computed(
+            'ST_MakePoint(cos(radians(dec)) * cos(radians(ra)), '
+            'cos(radians(dec)) * sin(radians(ra)), sin(radians(dec)))',
+            persisted=True)))
+
+    @property
+    def skycoord(self):
+        return SkyCoord(self.ra, self.dec, unit='deg')
+
+    @declared_attr
+    def __table_args__(cls):
+        tn = cls.__tablename__
+        return sa.Index(f'{tn}_postgis_xyz_idx', 'xyz',
+                        postgresql_using='gist',
+                        postgresql_ops={'xyz': 'gist_geometry_ops_nd'}),
+
+    @classmethod
+    def _cluster_order(cls):
+        """Cluster on the GiST index of the unit vectors."""
+        return f'{cls.__tablename__}_postgis_xyz_idx', None
+
+    @hybrid_method
+    @instrumented('postgis3d', 'distance')
+    def distance(self, other):
+        """Return an SQLalchemy clause element that can be used to calculate
+        the angular separation between `self` and `other` in arcsec, from
+        the chord between their unit vectors.
+
+        Parameters
+        ----------
+
+        other: subclass of PostGIS3DSpatialBackend or instance of PostGIS3DSpatialBackend
+           The class or object to query against. If a class, will generate
+           a clause element that can be used to join two tables, otherwise
+           will generate a clause element that can be used to filter a
+           single table.
+        """
+
+        return _chord_to_arcsec(sa.func.ST_3DDistance(_xyz(self),
+                                                      _xyz(other)))
+
+    @hybrid_method
+    @instrumented('postgis3d', 'radially_within')
+    def radially_within(self, other, angular_sep_arcsec):
+        """Return an SQLalchemy clause element that can be used as a join or
+        filter condition for a radial query, using `ST_3DDWithin` on the
+        chord length of the radius so the index is scanned.
+
+        Parameters
+        ----------
+
+        other: subclass of PostGIS3DSpatialBackend or instance of PostGIS3DSpatialBackend
+           The class or object to query against. If a class, will generate
+           a clause element that can be used to join two tables, otherwise
+           will generate a clause element that can be used to filter a
+           single table.
+
+        angular_sep_arcsec:
+           The radius, in arcseconds, to use for the radial query. The
+           query will return true if two objects are within this angular
+           distance of one another.
+        """
+
+        chord = float(chord_length(angular_sep_arcsec))
+        return sa.func.ST_3DDWithin(_xyz(self), _xyz(other), chord)
+
+    @hybrid_method
+    @instrumented('postgis3d', 'within_polygon')
+    def within_polygon(self, vertices):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a polygon. The index is scanned for the
+        cone circumscribing the polygon, and the rows found are cut on the
+        polygon itself.
+
+        Parameters
+        ----------
+
+        vertices: array-like
+           A sequence of (ra, dec) pairs in degrees. The edges are great
+           circle arcs and the polygon must fit within a hemisphere.
+        """
+
+        return _within_region(self, Polygon(vertices))
+
+    @hybrid_method
+    @instrumented('postgis3d', 'within_box')
+    def within_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a box bounded by lines of constant RA and
+        dec. The index is scanned for the cone circumscribing the box, and
+        the rows found are cut on the box itself.
+
+        Parameters
+        ----------
+
+        ra_min, ra_max: float
+           The right ascension limits in degrees. If `ra_min` is greater
+           than `ra_max` the box wraps through RA = 0.
+
+        dec_min, dec_max: float
+           The declination limits in degrees.
+        """
+
+        return _within_region(self, Box(ra_min, ra_max, dec_min, dec_max))
+
+    @hybrid_method
+    @instrumented('postgis3d', 'within_ellipse')
+    def within_ellipse(self, center, a, b, pa):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside an ellipse. The index is scanned for the
+        circle of the major axis, and the rows found are cut on the ellipse
+        itself.
+
+        Parameters
+        ----------
+
+        center: instance of PostGIS3DSpatialBackend or (ra, dec) pair
+           The center of the ellipse, in degrees.
+
+        a, b: float
+           The semi-major and semi-minor axes in arcseconds.
+
+        pa: float
+           The position angle of the major axis in degrees, east of north.
+        """
+
+        return _within_region(self, Ellipse(center, a, b, pa))
+
+    @classmethod
+    def radially_within_any(cls, session, ra, dec, angular_sep_arcsec):
+        """Return a query for all objects that lie within any of a set of
+        cones, in a single round trip. The cone centers are sent to postgres
+        as arrays, with their unit vectors and chord lengths, and joined
+        against the table using `ST_3DDWithin`, so each cone is an index
+        scan.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to build the query with.
+
+        ra, dec: array-like
+           The icrs coordinates of the cone centers in degrees.
+
+        angular_sep_arcsec: float or array-like
+           The radius, in arcseconds, of every cone or of each cone.
+
+        Returns
+        -------
+
+        query: sqlalchemy.orm.Query
+           A query yielding `(center_index, object)` pairs, where
+           `center_index` is the position of the matching cone in `ra` and
+           `dec`. An object within several cones is returned once per cone.
+        """
+
+        centers = cone_centers(ra, dec, angular_sep_arcsec,
+                               unit_vectors=True)
+        center = sa.func.ST_MakePoint(centers.c.cx, centers.c.cy,
+                                      centers.c.cz, type_=PointZ)
+        clause = sa.func.ST_3DDWithin(center, cls.xyz, centers.c.chord)
+        return session.query(centers.c.center_index, cls).select_from(
+            centers
+        ).join(cls, clause)
+
+    @staticmethod
+    def _nearest_order(target, other):
+        """Order by the n-dimensional `<<->>` distance operator, which the
+        GiST index serves as a k-nearest-neighbour scan. The chord between
+        unit vectors grows with the angle between them, so the order is
+        that of angular separation."""
+        return target.xyz.op('<<->>')(_xyz(other))
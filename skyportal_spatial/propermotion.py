@@ -0,0 +1,181 @@
+from functools import reduce
+import operator
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.ext.hybrid import hybrid_method
+from sqlalchemy.dialects import postgresql as psql
+
+from .match import unit_vectors, RADIANS_PER_ARCSEC
+from .regions import sql_unit_vector
+from .util import is_instance
+
+
+RADIANS_PER_MAS = np.pi / 180. / 3.6e6
+
+
+def _tangent_basis(cosdec, sindec, cosra, sinra):
+    """Return the unit vector of a position and the unit vectors pointing
+    east and north from it, from the sines and cosines of its ra and dec."""
+    position = (cosdec * cosra, cosdec * sinra, sindec)
+    east = (-sinra, cosra, 0.)
+    north = (-sindec * cosra, -sindec * sinra, cosdec)
+    return position, east, north
+
+
+def _moved(position, east, north, mu_east, mu_north, sqrt):
+    """Return the unit vector of `position` moved by `mu_east` and
+    `mu_north` radians in the tangent plane."""
+    norm = sqrt(1 + mu_east * mu_east + mu_north * mu_north)
+    return tuple((p + mu_east * e + mu_north * n) / norm
+                 for p, e, n in zip(position, east, north))
+
+
+def _dot(u, v):
+    """Return the dot product of two vectors of SQL expressions or floats,
+    leaving out the terms of zero components."""
+    return reduce(operator.add, [a * b for a, b in zip(u, v)
+                                 if not (isinstance(a, float) and a == 0)])
+
+
+def propagate(ra, dec, pmra, pmdec, years):
+    """Move positions by their proper motions, linearly in the tangent
+    plane, as `radially_within_at_epoch` does in SQL.
+
+    Parameters
+    ----------
+
+    ra, dec: array-like
+       The icrs coordinates in degrees.
+
+    pmra, pmdec: array-like
+       The proper motions in mas/yr, with `pmra` including the factor of
+       cos(dec).
+
+    years: float or array-like
+       The time to move the positions by, in years.
+
+    Returns
+    -------
+
+    ra, dec: numpy.ndarray
+       The moved coordinates in degrees.
+    """
+
+    ra, dec = np.radians(ra), np.radians(dec)
+    basis = _tangent_basis(np.cos(dec), np.sin(dec), np.cos(ra), np.sin(ra))
+    scale = np.asarray(years, dtype=float) * RADIANS_PER_MAS
+    x, y, z = _moved(*basis, np.asarray(pmra) * scale,
+                     np.asarray(pmdec) * scale, np.sqrt)
+    return (np.degrees(np.arctan2(y, x)) % 360,
+            np.degrees(np.arcsin(np.clip(z, -1, 1))))
+
+
+class ProperMotionMixin(object):
+    """Optional proper motion columns and epoch-aware radial queries,
+    shared by the spatial backends.
+
+    Set `PROPER_MOTIONS = True` on the mapped class to map the columns
+
+        pmra: the proper motion in right ascension, times cos(dec), in
+            mas/yr
+        pmdec: the proper motion in declination in mas/yr
+        epoch: the epoch of ra and dec as a Julian year; if null, the
+            class's `REFERENCE_EPOCH`
+
+    and search the table with `radially_within_at_epoch`. Its index
+    prefilter is widened by `MAX_PROPER_MOTION` (mas/yr) over the largest
+    time between the search epoch and the epochs of the rows, which lie in
+    `EPOCH_RANGE` (by default, all at `REFERENCE_EPOCH`). The default
+    maximum motion is just above that of Barnard's star, the largest
+    known.
+    """
+
+    PROPER_MOTIONS = False
+    MAX_PROPER_MOTION = 10500.
+    REFERENCE_EPOCH = 2016.
+    EPOCH_RANGE = None
+
+    @declared_attr
+    def pmra(cls):
+        if cls.PROPER_MOTIONS:
+            return sa.Column(psql.DOUBLE_PRECISION)
+
+    @declared_attr
+    def pmdec(cls):
+        if cls.PROPER_MOTIONS:
+            return sa.Column(psql.DOUBLE_PRECISION)
+
+    @declared_attr
+    def epoch(cls):
+        if cls.PROPER_MOTIONS:
+            return sa.Column(psql.DOUBLE_PRECISION)
+
+    @classmethod
+    def epoch_padding(cls, epoch):
+        """Return the furthest, in arcsec, that an object can move between
+        its epoch and `epoch`."""
+        first, last = cls.EPOCH_RANGE or (cls.REFERENCE_EPOCH,
+                                          cls.REFERENCE_EPOCH)
+        years = max(abs(epoch - first), abs(epoch - last))
+        return cls.MAX_PROPER_MOTION * years / 1000.
+
+    @hybrid_method
+    def radially_within_at_epoch(self, other, angular_sep_arcsec, epoch):
+        """Return an SQLalchemy clause element that can be used as a join or
+        filter condition for a radial query against the positions of the
+        objects moved to `epoch`.
+
+        The rows are prefiltered with the backend's `radially_within`, which
+        scans its index, on a cone widened by `epoch_padding`, and then cut
+        on the distance from their positions propagated in SQL.
+
+        Parameters
+        ----------
+
+        other: instance, subclass or alias of a spatial backend
+           The position(s) at `epoch` to query against, whose own proper
+           motions, if any, are ignored.
+
+        angular_sep_arcsec: float
+           The radius, in arcseconds, of the radial query.
+
+        epoch: float
+           The epoch of `other`, as a Julian year.
+        """
+
+        if not self.PROPER_MOTIONS:
+            raise ValueError('Set `PROPER_MOTIONS = True` on the class to '
+                             'query by epoch.')
+
+        padding = self.epoch_padding(epoch)
+        prefilter = self.radially_within(other,
+                                         angular_sep_arcsec + padding)
+
+        if is_instance(other):
+            target = tuple(float(c) for c in unit_vectors(other.ra,
+                                                          other.dec))
+        else:
+            target = sql_unit_vector(other.ra, other.dec)
+
+        ra, dec = sa.func.radians(self.ra), sa.func.radians(self.dec)
+        position, east, north = (
+            _dot(v, target) for v in _tangent_basis(
+                sa.func.cos(dec), sa.func.sin(dec), sa.func.cos(ra),
+                sa.func.sin(ra)
+            )
+        )
+        scale = (epoch - sa.func.coalesce(self.epoch, self.REFERENCE_EPOCH)
+                 ) * RADIANS_PER_MAS
+        mu_east = sa.func.coalesce(self.pmra, 0.) * scale
+        mu_north = sa.func.coalesce(self.pmdec, 0.) * scale
+
+        # the moved position is p + mu_east e + mu_north n, normalized; it is
+        # within the radius of the target t if its dot product with t is at
+        # least the cosine of the radius, so compare the unnormalized dot
+        # product with the cosine times the norm
+        dot = position + mu_east * east + mu_north * north
+        norm = sa.func.sqrt(1 + mu_east * mu_east + mu_north * mu_north)
+        cos_radius = float(np.cos(angular_sep_arcsec * RADIANS_PER_ARCSEC))
+        return sa.and_(prefilter, dot >= cos_radius * norm)
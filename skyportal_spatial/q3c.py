@@ -1,14 +1,21 @@
+import numpy as np
 import sqlalchemy as sa
 from astropy.coordinates import SkyCoord
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_method
 from sqlalchemy.dialects import postgresql as psql
 
+from .util import cone_centers, array_param
+from .regions import Polygon, Box, Ellipse
+from .instrument import instrumented
+from .propermotion import ProperMotionMixin
+from .backend import SpatialBackendMixin
+
 
 DEGREES_PER_ARCSEC = 1 / 3600.
 
 
-class Q3CSpatialBackend(object):
+class Q3CSpatialBackend(SpatialBackendMixin, ProperMotionMixin):
     """A mixin indicating to the database that an object has sky coordinates.
     Classes that mix this class get a q3c spatial index on ra and dec.
     Columns:
@@ -34,7 +41,13 @@ class Q3CSpatialBackend(object):
         return sa.Index(f'{tn}_q3c_ang2ipix_idx', sa.func.q3c_ang2ipix(
             cls.ra, cls.dec)),
 
+    @classmethod
+    def _cluster_order(cls):
+        """Cluster on the q3c index, along the q3c cube curve."""
+        return f'{cls.__tablename__}_q3c_ang2ipix_idx', None
+
     @hybrid_method
+    @instrumented('q3c', 'distance')
     def distance(self, other):
         """Return an SQLalchemy clause element that can be used to calculate
         the angular separation between `self` and `other` in arcsec.
@@ -52,6 +65,7 @@ class Q3CSpatialBackend(object):
         return sa.func.q3c_dist(self.ra, self.dec, other.ra, other.dec) * 3600.
 
     @hybrid_method
+    @instrumented('q3c', 'radially_within')
     def radially_within(self, other, angular_sep_arcsec):
         """Return an SQLalchemy clause element that can be used as a join or
         filter condition for a radial query.
@@ -71,16 +85,127 @@ class Q3CSpatialBackend(object):
            distance of one another.
         """
 
+        radius = angular_sep_arcsec * DEGREES_PER_ARCSEC
         if isinstance(other, Q3CSpatialBackend):
-            func = sa.func.q3c_radial_query
+            # q3c only uses its index for the first pair of coordinates
+            return sa.func.q3c_radial_query(self.ra, self.dec, other.ra,
+                                            other.dec, radius)
         elif issubclass(other, Q3CSpatialBackend):
-            func = sa.func.q3c_join
+            # ...and for the second pair of a join
+            return sa.func.q3c_join(other.ra, other.dec, self.ra, self.dec,
+                                    radius)
         else:
             raise ValueError('Input to `raidally_within` must be an instance '
                              'of PostGISSpatialBackend or a subclass of '
                              'PostGISSpatialBackend.')
 
-        return func(
-            other.ra, other.dec, self.ra, self.dec,
-            angular_sep_arcsec * DEGREES_PER_ARCSEC
+    @hybrid_method
+    @instrumented('q3c', 'within_polygon')
+    def within_polygon(self, vertices):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a polygon, using `q3c_poly_query` so the
+        q3c index is scanned.
+
+        Parameters
+        ----------
+
+        vertices: array-like
+           A sequence of (ra, dec) pairs in degrees. The edges are great
+           circle arcs and the polygon must fit within a hemisphere.
+        """
+
+        polygon = Polygon(vertices)
+        flat = np.stack([polygon.ra, polygon.dec], axis=-1).ravel()
+        return sa.func.q3c_poly_query(self.ra, self.dec, array_param(
+            flat, psql.DOUBLE_PRECISION
+        ))
+
+    @hybrid_method
+    @instrumented('q3c', 'within_box')
+    def within_box(self, ra_min, ra_max, dec_min, dec_max):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside a box bounded by lines of constant RA and
+        dec. The q3c index is scanned for the cone circumscribing the box,
+        and the rows found are cut on the box itself.
+
+        Parameters
+        ----------
+
+        ra_min, ra_max: float
+           The right ascension limits in degrees. If `ra_min` is greater
+           than `ra_max` the box wraps through RA = 0.
+
+        dec_min, dec_max: float
+           The declination limits in degrees.
+        """
+
+        box = Box(ra_min, ra_max, dec_min, dec_max)
+        cap = box.cap
+        return sa.and_(
+            sa.func.q3c_radial_query(self.ra, self.dec, cap.ra, cap.dec,
+                                     cap.radius * DEGREES_PER_ARCSEC),
+            box.clause(self.ra, self.dec)
+        )
+
+    @hybrid_method
+    @instrumented('q3c', 'within_ellipse')
+    def within_ellipse(self, center, a, b, pa):
+        """Return an SQLalchemy clause element that can be used to filter a
+        table for objects inside an ellipse, using `q3c_ellipse_query` so
+        the q3c index is scanned.
+
+        Parameters
+        ----------
+
+        center: instance of Q3CSpatialBackend or (ra, dec) pair
+           The center of the ellipse, in degrees.
+
+        a, b: float
+           The semi-major and semi-minor axes in arcseconds.
+
+        pa: float
+           The position angle of the major axis in degrees, east of north.
+        """
+
+        ellipse = Ellipse(center, a, b, pa)
+        return sa.func.q3c_ellipse_query(
+            self.ra, self.dec, ellipse.ra, ellipse.dec,
+            ellipse.a * DEGREES_PER_ARCSEC, ellipse.b / ellipse.a, ellipse.pa
+        )
+
+    @classmethod
+    def radially_within_any(cls, session, ra, dec, angular_sep_arcsec):
+        """Return a query for all objects that lie within any of a set of
+        cones, in a single round trip. The cone centers are sent to postgres
+        as arrays and joined against the table using `q3c_join`, so each cone
+        is an index scan.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+           The session to build the query with.
+
+        ra, dec: array-like
+           The icrs coordinates of the cone centers in degrees.
+
+        angular_sep_arcsec: float or array-like
+           The radius, in arcseconds, of every cone or of each cone.
+
+        Returns
+        -------
+
+        query: sqlalchemy.orm.Query
+           A query yielding `(center_index, object)` pairs, where
+           `center_index` is the position of the matching cone in `ra` and
+           `dec`. An object within several cones is returned once per cone.
+        """
+
+        centers = cone_centers(ra, dec, angular_sep_arcsec)
+        clause = sa.func.q3c_join(
+            centers.c.ra, centers.c.dec, cls.ra, cls.dec,
+            centers.c.radius * DEGREES_PER_ARCSEC
         )
+        return session.query(centers.c.center_index, cls).select_from(
+            centers
+        ).join(cls, clause)
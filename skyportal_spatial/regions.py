@@ -0,0 +1,312 @@
+from collections import namedtuple
+from functools import reduce
+import operator
+
+import numpy as np
+import sqlalchemy as sa
+
+from .bulk import check_coordinates
+from .util import WHOLE_SKY_ARCSEC
+from .match import unit_vectors, chord_to_arcsec, DEG_TO_RAD, \
+    RADIANS_PER_ARCSEC
+
+
+# widen bounding caps slightly so rounding never drops a match
+CAP_PADDING = 1 + 1e-9
+
+HEMISPHERE_ARCSEC = 90 * 3600.
+
+
+# a circle on the sky, with the center in degrees and the radius in arcsec,
+# that contains a region and can be searched with a spatial index
+Cap = namedtuple('Cap', ['ra', 'dec', 'radius'])
+
+
+def center_coordinates(center):
+    """Return the ra and dec in degrees of `center`, which can be a spatial
+    backend instance or an (ra, dec) pair."""
+
+    if hasattr(center, 'ra') and hasattr(center, 'dec'):
+        ra, dec = center.ra, center.dec
+    else:
+        ra, dec = center
+    if ra is None or dec is None:
+        raise ValueError('The center of a region must have coordinates.')
+    ra, dec = check_coordinates(ra, dec)
+    return float(ra[0]), float(dec[0])
+
+
+def _basis(center):
+    """Return unit vectors pointing east and north at the unit vector
+    `center`, which together with `center` form a right-handed basis."""
+    east = np.cross([0., 0., 1.], center)
+    norm = np.linalg.norm(east)
+    if norm < 1e-15:
+        # at a pole every direction is south or north; pick RA = 90
+        east = np.array([0., 1., 0.])
+    else:
+        east = east / norm
+    return east, np.cross(center, east)
+
+
+def _dot(vector, xyz):
+    """SQL expression for the dot product of a constant vector with the
+    unit vector expressions `xyz`."""
+    return reduce(operator.add, [float(v) * c for v, c in zip(vector, xyz)])
+
+
+def sql_unit_vector(ra, dec):
+    """Return SQL expressions for the unit vector of `ra` and `dec`."""
+    cosdec = sa.func.cos(sa.func.radians(dec))
+    return (cosdec * sa.func.cos(sa.func.radians(ra)),
+            cosdec * sa.func.sin(sa.func.radians(ra)),
+            sa.func.sin(sa.func.radians(dec)))
+
+
+class Polygon(object):
+    """A polygon on the sky whose edges are great circle arcs.
+
+    The polygon may be convex or not, its vertices may be given in either
+    order, and it must fit within a hemisphere. Membership is decided in the
+    gnomonic projection about the polygon's center, where great circles are
+    straight lines, with the crossing number test.
+
+    Parameters
+    ----------
+
+    vertices: array-like
+       A sequence of (ra, dec) pairs in degrees. The first vertex may be
+       repeated at the end to close the polygon.
+    """
+
+    def __init__(self, vertices):
+        vertices = np.asarray(vertices, dtype=float)
+        if vertices.ndim != 2 or vertices.shape[1] != 2:
+            raise ValueError('`vertices` must be a sequence of (ra, dec) '
+                             'pairs.')
+        ra, dec = check_coordinates(vertices[:, 0], vertices[:, 1])
+        ra = ra % 360
+        if len(ra) > 1 and ra[0] == ra[-1] and dec[0] == dec[-1]:
+            ra, dec = ra[:-1], dec[:-1]
+        if len(ra) < 3:
+            raise ValueError('A polygon needs at least three vertices.')
+        self.ra, self.dec = ra, dec
+
+        xyz = unit_vectors(ra, dec)
+        center = xyz.sum(axis=0)
+        norm = np.linalg.norm(center)
+        radius = 0.
+        if norm > 1e-12:
+            center = center / norm
+            radius = chord_to_arcsec(
+                np.linalg.norm(xyz - center, axis=-1)
+            ).max() * CAP_PADDING
+        if norm <= 1e-12 or radius >= HEMISPHERE_ARCSEC:
+            raise ValueError('Polygons must fit within a hemisphere.')
+
+        cra, cdec = np.degrees(np.arctan2(center[1], center[0])) % 360, \
+            np.degrees(np.arcsin(np.clip(center[2], -1, 1)))
+        self.cap = Cap(float(cra), float(cdec), float(radius))
+
+        self._center = center
+        self._east, self._north = _basis(center)
+        w = xyz @ center
+        x = xyz @ self._east / w
+        y = xyz @ self._north / w
+
+        # each edge that is not parallel to the x axis, as the y interval it
+        # spans and the line x = intercept + slope * y it lies on
+        self._edges = []
+        for i in range(len(x)):
+            j = (i + 1) % len(x)
+            if y[i] == y[j]:
+                continue
+            slope = (x[j] - x[i]) / (y[j] - y[i])
+            self._edges.append((min(y[i], y[j]), max(y[i], y[j]),
+                                x[i] - slope * y[i], slope))
+
+    def contains(self, ra, dec):
+        """Return a boolean array telling which of the positions `ra`,
+        `dec` (degrees) lie within the polygon."""
+        p = unit_vectors(ra, dec)
+        w, x, y = p @ self._center, p @ self._east, p @ self._north
+        crossings = np.zeros(np.shape(w), dtype=int)
+        for lo, hi, intercept, slope in self._edges:
+            crossings += (lo * w <= y) & (y < hi * w) & \
+                (x < intercept * w + slope * y)
+        return (w > 0) & (crossings % 2 == 1)
+
+    def clause(self, ra, dec, xyz=None):
+        """Return an SQLalchemy clause element that is true for positions
+        within the polygon.
+
+        Parameters
+        ----------
+
+        ra, dec: SQL expressions
+           The right ascension and declination in degrees.
+
+        xyz: tuple of SQL expressions, optional
+           The unit vector of the position, if it is stored.
+        """
+
+        if xyz is None:
+            xyz = sql_unit_vector(ra, dec)
+        w = _dot(self._center, xyz)
+        x = _dot(self._east, xyz)
+        y = _dot(self._north, xyz)
+
+        # the projection is homogeneous: compare x * w and y * w rather
+        # than dividing by w on every row
+        crossings = [
+            sa.case([(sa.and_(float(lo) * w <= y, y < float(hi) * w,
+                              x < float(intercept) * w + float(slope) * y),
+                      1)], else_=0)
+            for lo, hi, intercept, slope in self._edges
+        ]
+        return sa.and_(w > 0, reduce(operator.add, crossings) % 2 == 1)
+
+
+class Box(object):
+    """A region bounded by lines of constant right ascension and
+    declination.
+
+    Parameters
+    ----------
+
+    ra_min, ra_max: float
+       The right ascension limits in degrees. If `ra_min` is greater than
+       `ra_max` the box wraps through RA = 0.
+
+    dec_min, dec_max: float
+       The declination limits in degrees.
+    """
+
+    def __init__(self, ra_min, ra_max, dec_min, dec_max):
+        values = np.array([ra_min, ra_max, dec_min, dec_max], dtype=float)
+        if not np.isfinite(values).all():
+            raise ValueError('The limits of a box must be finite.')
+        if not -90 <= dec_min <= dec_max <= 90:
+            raise ValueError('The declination limits of a box must satisfy '
+                             '-90 <= dec_min <= dec_max <= 90.')
+
+        self.full_circle = ra_max - ra_min >= 360
+        self.ra_min, self.ra_max = float(ra_min) % 360, float(ra_max) % 360
+        self.dec_min, self.dec_max = float(dec_min), float(dec_max)
+        self.wraps = not self.full_circle and self.ra_min > self.ra_max
+
+        width = 360. if self.full_circle else \
+            (self.ra_max - self.ra_min) % 360
+        cra = (self.ra_min + width / 2) % 360
+        cdec = (self.dec_min + self.dec_max) / 2
+        if width >= 180:
+            radius = WHOLE_SKY_ARCSEC
+        else:
+            # the corners are the points of the boundary furthest from the
+            # center as long as the box is less than 180 degrees wide
+            corners = unit_vectors(
+                [self.ra_min, self.ra_min, self.ra_max, self.ra_max],
+                [self.dec_min, self.dec_max, self.dec_min, self.dec_max]
+            )
+            center = unit_vectors(cra, cdec)
+            radius = chord_to_arcsec(
+                np.linalg.norm(corners - center, axis=-1)
+            ).max() * CAP_PADDING
+        self.cap = Cap(float(cra), float(cdec), float(radius))
+
+    def contains(self, ra, dec):
+        """Return a boolean array telling which of the positions `ra`,
+        `dec` (degrees) lie within the box."""
+        ra = np.asarray(ra, dtype=float) % 360
+        dec = np.asarray(dec, dtype=float)
+        inside = (dec >= self.dec_min) & (dec <= self.dec_max)
+        if self.full_circle:
+            return inside
+        elif self.wraps:
+            return inside & ((ra >= self.ra_min) | (ra <= self.ra_max))
+        return inside & (ra >= self.ra_min) & (ra <= self.ra_max)
+
+    def clause(self, ra, dec, xyz=None):
+        """Return an SQLalchemy clause element that is true for positions
+        within the box. The clause only compares `ra` and `dec`, so a b-tree
+        index on them can serve it; `xyz` is accepted for symmetry with the
+        other regions and ignored."""
+
+        band = dec.between(self.dec_min, self.dec_max)
+        if self.full_circle:
+            return band
+        elif self.wraps:
+            return sa.and_(band, sa.or_(ra >= self.ra_min,
+                                        ra <= self.ra_max))
+        return sa.and_(band, ra.between(self.ra_min, self.ra_max))
+
+
+class Ellipse(object):
+    """An ellipse on the sky.
+
+    A position is inside if, with `u` and `v` the components of its unit
+    vector along the major and minor axes at the center, `(u / sin a)**2 +
+    (v / sin b)**2 <= 1` and it is in the same hemisphere as the center, so
+    the boundary passes through the points `a` away from the center along
+    the major axis and `b` away along the minor axis.
+
+    Parameters
+    ----------
+
+    center: spatial backend instance or (ra, dec) pair
+       The center of the ellipse, in degrees.
+
+    a, b: float
+       The semi-major and semi-minor axes in arcseconds.
+
+    pa: float
+       The position angle of the major axis in degrees, east of north.
+    """
+
+    def __init__(self, center, a, b, pa):
+        ra, dec = center_coordinates(center)
+        a, b, pa = float(a), float(b), float(pa)
+        if not 0 < b <= a < HEMISPHERE_ARCSEC:
+            raise ValueError('The semi-axes of an ellipse must satisfy '
+                             '0 < b <= a < 90 degrees.')
+        self.ra, self.dec, self.a, self.b, self.pa = ra, dec, a, b, pa
+        self.cap = Cap(ra, dec, a * CAP_PADDING)
+
+        self._center = unit_vectors(ra, dec)
+        east, north = _basis(self._center)
+        sinpa, cospa = np.sin(pa * DEG_TO_RAD), np.cos(pa * DEG_TO_RAD)
+        self._major = sinpa * east + cospa * north
+        self._minor = cospa * east - sinpa * north
+        self._inv_sin2_a = 1 / np.sin(a * RADIANS_PER_ARCSEC) ** 2
+        self._inv_sin2_b = 1 / np.sin(b * RADIANS_PER_ARCSEC) ** 2
+
+    def contains(self, ra, dec):
+        """Return a boolean array telling which of the positions `ra`,
+        `dec` (degrees) lie within the ellipse."""
+        p = unit_vectors(ra, dec)
+        u, v = p @ self._major, p @ self._minor
+        return (p @ self._center > 0) & \
+            (u * u * self._inv_sin2_a + v * v * self._inv_sin2_b <= 1)
+
+    def clause(self, ra, dec, xyz=None):
+        """Return an SQLalchemy clause element that is true for positions
+        within the ellipse.
+
+        Parameters
+        ----------
+
+        ra, dec: SQL expressions
+           The right ascension and declination in degrees.
+
+        xyz: tuple of SQL expressions, optional
+           The unit vector of the position, if it is stored.
+        """
+
+        if xyz is None:
+            xyz = sql_unit_vector(ra, dec)
+        u = sa.func.power(_dot(self._major, xyz), 2)
+        v = sa.func.power(_dot(self._minor, xyz), 2)
+        return sa.and_(
+            _dot(self._center, xyz) > 0,
+            u * float(self._inv_sin2_a) + v * float(self._inv_sin2_b) <= 1
+        )
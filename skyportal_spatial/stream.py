@@ -0,0 +1,106 @@
+import numpy as np
+import sqlalchemy as sa
+
+
+# the record type of the chunks yielded by `stream_within`
+PAIR_DTYPE = np.dtype([('id_a', 'i8'), ('id_b', 'i8'), ('separation', 'f8')])
+
+DEFAULT_STREAM_CHUNK = 10000
+
+
+def id_column(entity):
+    """Return the primary key attribute of a mapped class or alias, which
+    must have a single primary key column."""
+
+    insp = sa.inspect(entity)
+    primary_key = insp.mapper.primary_key
+    if len(primary_key) != 1:
+        raise ValueError(f'{insp.mapper.class_.__name__} must have a single '
+                         'primary key column.')
+    prop = insp.mapper.get_property_by_column(primary_key[0])
+    return getattr(entity, prop.key)
+
+
+def pairs_statement(a, b, angular_sep_arcsec):
+    """Return a select of the (id_a, id_b, separation) rows of a
+    `radially_within` join of `a` and `b`, along with the entities it
+    joins; if `b` is `a`, the second is an alias of it."""
+
+    if b is a:
+        b = sa.orm.aliased(a)
+    statement = sa.select([
+        id_column(a).label('id_a'),
+        id_column(b).label('id_b'),
+        a.distance(b).label('separation'),
+    ]).select_from(
+        sa.orm.join(a, b, a.radially_within(b, angular_sep_arcsec))
+    )
+    return statement, a, b
+
+
+def pairs_array(rows):
+    """Convert (id_a, id_b, separation) rows to a PAIR_DTYPE record array."""
+    return np.array([tuple(row) for row in rows], dtype=PAIR_DTYPE)
+
+
+def stream_rows(session, statement, chunk_size):
+    """Execute `statement` with a server side cursor and yield lists of at
+    most `chunk_size` rows, so that only one chunk is held in memory at a
+    time. The cursor is closed when the generator is closed or exhausted."""
+
+    connection = session.connection().execution_options(
+        stream_results=True, max_row_buffer=chunk_size
+    )
+    result = connection.execute(statement)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        result.close()
+
+
+def stream_within(session, a, b, angular_sep_arcsec,
+                  chunk_size=DEFAULT_STREAM_CHUNK):
+    """Stream the pairs of objects from a `radially_within` join.
+
+    The join is executed with a server side cursor, so memory stays bounded
+    however many pairs match and the first chunk is available before the
+    query finishes.
+
+    Parameters
+    ----------
+
+    session: sqlalchemy.orm.Session
+       The session to query with. The cursor lives in its current
+       transaction.
+
+    a, b: mapped classes or aliases using the same spatial backend
+       The tables to join. If `b` is `a`, the table is joined to itself,
+       and each object is paired with itself.
+
+    angular_sep_arcsec: float
+       The radius, in arcseconds, of the join.
+
+    chunk_size: int
+       The number of pairs per chunk.
+
+    Returns
+    -------
+
+    chunks: generator of numpy.ndarray
+       Record arrays with fields `id_a`, `id_b` (the primary keys of the
+       objects) and `separation` (in arcseconds), of `chunk_size` pairs
+       each except the last.
+    """
+
+    if chunk_size < 1:
+        raise ValueError('`chunk_size` must be positive.')
+
+    # a generator expression rather than a generator function, so that bad
+    # arguments raise at the call rather than at the first chunk
+    statement, _, _ = pairs_statement(a, b, angular_sep_arcsec)
+    return (pairs_array(rows)
+            for rows in stream_rows(session, statement, chunk_size))
@@ -0,0 +1,27 @@
+"""Pytest helpers for applications that use the spatial backends.
+
+Import the fixture into a `conftest.py` to use it:
+
+    from skyportal_spatial.testing import spatial_explain  # noqa: F401
+"""
+
+import pytest
+
+from .plans import explain
+
+
+@pytest.fixture
+def spatial_explain():
+    """A function that explains a query and, by default, raises
+    IndexNotUsedError unless it scanned a spatial index:
+
+        def test_cone(spatial_explain):
+            report = spatial_explain(session, query)
+            assert report.rows_scanned < 10 * report.rows_returned
+    """
+
+    def check(session, query, require_index=True, analyze=True):
+        return explain(session, query, analyze=analyze,
+                       require_index=require_index)
+
+    return check
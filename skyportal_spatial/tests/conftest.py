@@ -10,6 +10,9 @@ import textwrap
 import os
 import yaml
 
+from skyportal_spatial.testing import spatial_explain  # noqa: F401
+
+
 @contextmanager
 def status(message):
     print(f'[·] {message}', end='')
@@ -1,8 +1,19 @@
+import asyncio
 import os
 import numpy as np
 import yaml
 from skyportal_spatial import (PostGISSpatialBackend, Q3CSpatialBackend,
-                               UnindexedSpatialBackend)
+                               UnindexedSpatialBackend, HealpixSpatialBackend,
+                               PostGIS3DSpatialBackend)
+from skyportal_spatial.postgis import GeographyPoint
+from skyportal_spatial.regions import Polygon, Box, Ellipse
+from skyportal_spatial.moc import moc_contains
+from skyportal_spatial.pixels import spatial_order
+from skyportal_spatial.propermotion import propagate
+from skyportal_spatial import (crossmatch, best_match, stream_within,
+                               parallel_crossmatch, IndexNotUsedError,
+                               instrument, migrate_backend, finish_migration,
+                               ConeCache, SpatialMirror, aio)
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -17,6 +28,19 @@ basedir = os.path.dirname(__file__)
 confpath = os.path.join(basedir, 'config.yaml')
 conf = yaml.load(open(confpath, 'r'), Loader=yaml.FullLoader)
 
+
+def database_url():
+    c = conf['database']
+    user = c.get('username')
+    password = c.get('password')
+    host = c.get('host', None)
+    port = c.get('port', None)
+    database = c.get('database', None)
+
+    url = 'postgresql://{}:{}@{}:{}/{}'
+    return url.format(user, password or '', host or '', port or '', database)
+
+
 def check_differences(res, jm1, jm2):
     resids = set((r[0].id - 1, r[1].id - 1) for r in res)
     jmids = set(zip(jm1, jm2))
@@ -31,6 +55,9 @@ class _TestBase(object):
 
     radius = 3600  # arcsec
 
+    # whether the backend creates a spatial index
+    indexed = True
+
     @pytest.fixture(scope='class')
     def rng(self):
         return np.random.RandomState(seed=SEED)
@@ -38,17 +65,7 @@ class _TestBase(object):
     @pytest.fixture(scope='class')
     def DBSession(self):
 
-        c = conf['database']
-        user = c.get('username')
-        password = c.get('password')
-        host = c.get('host', None)
-        port = c.get('port', None)
-        database = c.get('database', None)
-
-        url = 'postgresql://{}:{}@{}:{}/{}'
-        url = url.format(user, password or '', host or '', port or '', database)
-
-        conn = sa.create_engine(url, client_encoding='utf8')
+        conn = sa.create_engine(database_url(), client_encoding='utf8')
 
         sess = scoped_session(sessionmaker())
         sess.configure(bind=conn)
@@ -56,6 +73,63 @@ class _TestBase(object):
 
         return sess
 
+    @pytest.fixture
+    def table(self, DBSession):
+        DBSession().execute(f'DROP TABLE IF EXISTS {self.Object.__tablename__}')
+        DBSession().commit()
+        self.Base.metadata.create_all()
+        yield self.Object.__table__
+        DBSession().rollback()
+        DBSession().execute(f'DROP TABLE {self.Object.__tablename__}')
+        DBSession().commit()
+
+    @pytest.fixture
+    def other(self, table, DBSession):
+        """A second table with the same backend and options as `Object`."""
+        Base = declarative_base()
+        attrs = {'__tablename__': f'{self.Object.__tablename__}_other',
+                 'id': sa.Column(sa.Integer, primary_key=True)}
+        for option in ('UNIT_VECTORS', 'BTREE_INDEX', 'ZONE_HEIGHT'):
+            if hasattr(self.Object, option):
+                attrs[option] = getattr(self.Object, option)
+        Other = type('Other', (self.mixin, Base), attrs)
+        bind = DBSession().get_bind()
+        Base.metadata.drop_all(bind=bind)
+        Base.metadata.create_all(bind=bind)
+        yield Other
+        DBSession().rollback()
+        Base.metadata.drop_all(bind=bind)
+
+    @pytest.fixture
+    def moving(self, table, DBSession):
+        """A table with the same backend as `Object` and proper motions."""
+        Base = declarative_base()
+        attrs = {'__tablename__': f'{self.Object.__tablename__}_moving',
+                 'id': sa.Column(sa.Integer, primary_key=True),
+                 'PROPER_MOTIONS': True, 'MAX_PROPER_MOTION': 1500.}
+        for option in ('UNIT_VECTORS', 'BTREE_INDEX', 'ZONE_HEIGHT'):
+            if hasattr(self.Object, option):
+                attrs[option] = getattr(self.Object, option)
+        Moving = type('Moving', (self.mixin, Base), attrs)
+        bind = DBSession().get_bind()
+        Base.metadata.drop_all(bind=bind)
+        Base.metadata.create_all(bind=bind)
+        yield Moving
+        DBSession().rollback()
+        Base.metadata.drop_all(bind=bind)
+
+    @pytest.fixture
+    def load(self, table, DBSession, rng):
+        """Bulk load `nr` random points into `Object` with ids 1 to `nr`,
+        commit them and return their coordinates."""
+        def load(nr):
+            ra, dec = self.points(nr, rng)
+            self.Object.bulk_load(DBSession(), ra, dec,
+                                  extra_columns={'id': np.arange(1, nr + 1)})
+            DBSession().commit()
+            return ra, dec
+        return load
+
     def points(self, nr, rng):
         ra = rng.uniform(low=0, high=360, size=nr)
         dec = rng.uniform(low=-90, high=90, size=nr)
@@ -122,25 +196,629 @@ class _TestBase(object):
         DBSession().execute(f'DROP TABLE {self.Object.__tablename__}')
         DBSession().commit()
 
+    def test_radially_within_instances(self, DBSession):
+        a = self.Object(ra=10., dec=20.)
+        b = self.Object(ra=10., dec=20.5)
+        assert DBSession().query(a.radially_within(b, self.radius)).scalar()
+        assert not DBSession().query(a.radially_within(b, 1000)).scalar()
+
+    def test_bulk_load(self, table, DBSession, rng):
+
+        nr = 10000
+        ra, dec = self.points(nr, rng)
+        ids = np.arange(1, nr + 1)
+        truth = SkyCoord(ra, dec, unit='deg')
+        matches = truth[truth.separation(truth[0]) <= self.radius * u.arcsec]
+
+        start = time.time()
+        n = self.Object.bulk_load(DBSession(), ra, dec,
+                                  extra_columns={'id': ids})
+        DBSession().commit()
+        stop = time.time()
+        print(f'{nr} rows: {stop - start:.2e} sec to bulk load DB ({self.itype} index)')
+        assert n == nr
+
+        res = DBSession().query(self.Object.ra, self.Object.dec).order_by(
+            self.Object.id
+        ).all()
+        np.testing.assert_allclose([r[0] for r in res], ra, atol=1e-8)
+        np.testing.assert_allclose([r[1] for r in res], dec, atol=1e-8)
+
+        center = DBSession().query(self.Object).get(1)
+        q = DBSession().query(self.Object).filter(
+            self.Object.radially_within(center, self.radius)
+        )
+        assert q.count() == len(matches)
+
+        # the loaded ids advance the sequence of the primary key
+        obj = self.Object(ra=10., dec=20.)
+        DBSession().add(obj)
+        DBSession().commit()
+        assert obj.id == nr + 1
+
+        with pytest.raises(ValueError):
+            self.Object.bulk_load(DBSession(), [np.nan], [0.])
+        with pytest.raises(ValueError):
+            self.Object.bulk_load(DBSession(), [0.], [0.],
+                                  extra_columns={'id': [2 ** 31]})
+
+    def test_radially_within_any(self, DBSession, rng, load):
+
+        nr = 10000
+        ra, dec = load(nr)
+
+        cra, cdec = self.points(50, rng)
+        radii = rng.uniform(low=60, high=self.radius, size=50)
+        truth = SkyCoord(ra, dec, unit='deg')
+        centers = SkyCoord(cra, cdec, unit='deg')
+        expected = set()
+        for i, (center, radius) in enumerate(zip(centers, radii)):
+            sep = truth.separation(center).to('arcsec').value
+            expected.update((i, j + 1) for j in np.flatnonzero(sep <= radius))
+
+        start = time.time()
+        q = self.Object.radially_within_any(DBSession(), cra, cdec, radii)
+        res = q.all()
+        stop = time.time()
+        print(f'{nr} rows: {stop - start:.2e} sec to do 50 cone multi-query ({self.itype} index)')
+        assert set((i, o.id) for i, o in res) == expected
+
+    def test_crossmatch(self, DBSession, load):
+
+        nr = 1000
+        ra, dec = load(nr)
+        objs = DBSession().query(self.Object).order_by(self.Object.id).all()
+
+        start = time.time()
+        ia, ib, sep = crossmatch(objs, objs, self.radius)
+        stop = time.time()
+        print(f'{nr} rows: {stop - start:.2e} sec to do kd-tree crossmatch ({self.itype} index)')
+
+        o1 = sa.orm.aliased(self.Object)
+        o2 = sa.orm.aliased(self.Object)
+        res = DBSession().query(o1.id, o2.id, o1.distance(o2)).join(
+            o2, o1.radially_within(o2, self.radius)
+        ).all()
+        assert set(zip(ia + 1, ib + 1)) == set((r[0], r[1]) for r in res)
+
+        dist = {(r[0], r[1]): r[2] for r in res}
+        np.testing.assert_allclose(
+            sep, [dist[(a + 1, b + 1)] for a, b in zip(ia, ib)], atol=1e-6
+        )
+
+    def test_nearest(self, DBSession, load):
+
+        nr, k = 1000, 5
+        ra, dec = load(nr)
+
+        truth = SkyCoord(ra, dec, unit='deg')
+        position = self.Object(ra=ra[0], dec=dec[0])
+        sep = truth.separation(SkyCoord(ra[0], dec[0], unit='deg')).arcsec
+        expected = np.argsort(sep)[:k] + 1
+
+        res = self.Object.nearest(DBSession(), position, k=k).all()
+        assert [r[0].id for r in res] == list(expected)
+        np.testing.assert_allclose([r[1] for r in res],
+                                   sep[expected - 1], atol=1e-6)
+
+        # one neighbour for every object other than itself
+        o1 = sa.orm.aliased(self.Object)
+        res = self.Object.nearest(DBSession(), o1, k=2).all()
+        assert len(res) == 2 * nr
+        _, idx, _ = truth.match_to_catalog_sky(truth, nthneighbor=2)
+        found = {r[0].id: r[1].id for r in res if r[1].id != r[0].id}
+        assert found == dict(zip(range(1, nr + 1), idx + 1))
+
+        # a max_radius that excludes everything but the object itself
+        res = self.Object.nearest(DBSession(), position, k=k,
+                                  max_radius=1e-3).all()
+        assert [r[0].id for r in res] == [1]
+
+    def test_regions(self, DBSession, load):
+
+        nr = 10000
+        ra, dec = load(nr)
+
+        def ids(clause):
+            q = DBSession().query(self.Object.id).filter(clause)
+            return set(r[0] for r in q)
+
+        def expected(mask):
+            return set(np.flatnonzero(mask) + 1)
+
+        # a non-convex footprint, and a quadrilateral straddling RA = 0
+        for vertices in [[(0, 0), (20, 0), (20, 10), (10, 10), (10, 20),
+                          (0, 20)],
+                         [(350, -5), (10, -6), (12, 5), (348, 4)]]:
+            found = ids(self.Object.within_polygon(vertices))
+            assert found == expected(Polygon(vertices).contains(ra, dec))
+
+        for limits in [(10, 30, -10, 20), (350, 20, -5, 5), (0, 360, 80, 90)]:
+            found = ids(self.Object.within_box(*limits))
+            assert found == expected(Box(*limits).contains(ra, dec))
+
+        # backends may draw the boundary of an ellipse slightly differently
+        center, a, b, pa = (50., 30.), 10 * 3600, 4 * 3600, 30
+        found = ids(self.Object.within_ellipse(center, a, b, pa))
+        inner = Ellipse(center, a * 0.999, b * 0.999, pa).contains(ra, dec)
+        outer = Ellipse(center, a * 1.001, b * 1.001, pa).contains(ra, dec)
+        assert expected(inner) <= found <= expected(outer)
+        assert len(found) > 0
+
+    def test_within_moc(self, DBSession, load):
+
+        nr = 10000
+        ra, dec = load(nr)
+
+        # coarse and fine cells, one of them touching the pole
+        moc = {2: [0, 100], '4': [2000, 2001, 2002, 2003, 2500],
+               6: list(range(20000, 20050))}
+        expected = set(np.flatnonzero(moc_contains(moc, ra, dec)) + 1)
+        q = DBSession().query(self.Object.id).filter(
+            self.Object.within_moc(moc)
+        )
+        assert set(r[0] for r in q) == expected
+
+        found = [o.id for o in self.Object.iter_within_moc(
+            DBSession(), moc, batch_size=5, yield_per=10
+        )]
+        assert len(found) == len(set(found))
+        assert set(found) == expected
+
+    def test_index_usage(self, DBSession, load, spatial_explain):
+
+        nr = 10000
+        ra, dec = load(nr)
+        DBSession().execute(f'ANALYZE {self.Object.__tablename__}')
+
+        position = self.Object(ra=ra[0], dec=dec[0])
+        q = DBSession().query(self.Object).filter(
+            self.Object.radially_within(position, self.radius)
+        )
+        if not self.indexed:
+            with pytest.raises(IndexNotUsedError):
+                spatial_explain(DBSession(), q)
+            return
+
+        report = spatial_explain(DBSession(), q)
+        print(f'{nr} rows: {report!r} ({self.itype} index)')
+        assert report.rows_returned == q.count()
+        assert report.rows_scanned < nr
+        assert not report.seq_scans
+
+    def test_instrumentation(self, DBSession, load):
+
+        nr = 1000
+        ra, dec = load(nr)
+
+        position = self.Object(ra=ra[0], dec=dec[0])
+        instrument.reset()
+        instrument.enable()
+        try:
+            found = DBSession().query(self.Object).filter(
+                self.Object.radially_within(position, self.radius)
+            ).all()
+            DBSession().query(self.Object).count()
+        finally:
+            instrument.disable()
+
+        # only the statement with a spatial clause is timed
+        stats = instrument.stats()
+        name, = stats
+        op = stats[name]['radially_within']
+        assert op['count'] == 1
+        assert op['rows'] == len(found)
+        assert sum(n for _, n in op['histogram']) == 1
+
+        # disabled, nothing is tagged
+        DBSession().query(self.Object).filter(
+            self.Object.radially_within(position, self.radius)
+        ).all()
+        assert instrument.stats()[name]['radially_within']['count'] == 1
+
+    def test_coordinate_arrays(self, DBSession, load):
+
+        nr = 1000
+        ra, dec = load(nr)
+
+        q = DBSession().query(self.Object).order_by(self.Object.id)
+        qra, qdec = self.Object.coordinates(q)
+        np.testing.assert_allclose(qra, ra)
+        np.testing.assert_allclose(qdec, dec)
+
+        alias = sa.orm.aliased(self.Object)
+        q_alias = DBSession().query(alias).filter(alias.id <= 10).order_by(
+            alias.id
+        )
+        qra, qdec = self.Object.coordinates(q_alias)
+        np.testing.assert_allclose(qra, ra[:10])
+        np.testing.assert_allclose(qdec, dec[:10])
+
+        objects = q.limit(10).all()
+        coords = self.Object.skycoords(objects)
+        assert coords.shape == (10,)
+        for obj, coord in zip(objects, coords):
+            assert obj.skycoord.separation(coord).arcsec < 1e-6
+
+        empty = self.Object.skycoords(q.filter(sa.false()))
+        assert empty.shape == (0,)
+
+    def test_stream_within(self, DBSession, load):
+
+        nr = 1000
+        ra, dec = load(nr)
+
+        chunks = list(stream_within(DBSession(), self.Object, self.Object,
+                                    self.radius, chunk_size=100))
+        assert all(len(c) == 100 for c in chunks[:-1])
+        assert 0 < len(chunks[-1]) <= 100
+        pairs = np.concatenate(chunks)
+
+        ia, ib, sep = crossmatch((ra, dec), (ra, dec), self.radius)
+        assert len(pairs) == len(ia)
+        order = np.lexsort((pairs['id_b'], pairs['id_a']))
+        np.testing.assert_array_equal(pairs['id_a'][order], ia + 1)
+        np.testing.assert_array_equal(pairs['id_b'][order], ib + 1)
+        np.testing.assert_allclose(pairs['separation'][order], sep,
+                                   atol=1e-6)
+
+        # raised at the call, before any chunk is requested
+        with pytest.raises(ValueError):
+            stream_within(DBSession(), self.Object, self.Object,
+                          self.radius, chunk_size=0)
+
+    def test_cone_cache(self, table, DBSession, load):
+
+        nr = 1000
+        ra, dec = load(nr)
+
+        position = self.Object(ra=ra[0], dec=dec[0])
+        q = DBSession().query(self.Object.id).filter(
+            self.Object.radially_within(position, self.radius)
+        )
+        expected = sorted(r[0] for r in q)
+
+        cache = ConeCache(precision_arcsec=10.)
+        try:
+            for _ in range(2):
+                objects = cache.radially_within(DBSession(), self.Object,
+                                                position, self.radius)
+                assert sorted(o.id for o in objects) == expected
+            stats = cache.stats()
+            assert stats['hits'] == 1
+            assert stats['misses'] == 1
+            assert stats['entries'] == 1
+
+            # a write far away keeps the entry...
+            DBSession().add(self.Object(id=nr + 1, ra=(ra[0] + 180) % 360,
+                                        dec=-dec[0]))
+            DBSession().commit()
+            assert cache.stats()['invalidations'] == 0
+
+            # ...and one inside the cone drops it
+            DBSession().add(self.Object(id=nr + 2, ra=ra[0], dec=dec[0]))
+            DBSession().commit()
+            assert cache.stats()['invalidations'] == 1
+            objects = cache.radially_within(DBSession(), self.Object,
+                                            position, self.radius)
+            assert sorted(o.id for o in objects) == expected + [nr + 2]
+            assert cache.stats()['misses'] == 2
+
+            # a reader caching the committed rows between the flush and the
+            # commit of a write is dropped on the commit
+            reader = sessionmaker(bind=DBSession().get_bind())()
+            DBSession().add(self.Object(id=nr + 3, ra=ra[0], dec=dec[0]))
+            DBSession().flush()
+            cache.radially_within(reader, self.Object, position, self.radius)
+            assert cache.stats()['entries'] == 1
+            DBSession().commit()
+            assert cache.stats()['entries'] == 0
+            objects = cache.radially_within(reader, self.Object, position,
+                                            self.radius)
+            assert nr + 3 in [o.id for o in objects]
+            reader.close()
+
+            # bulk updates drop every entry of the table
+            assert cache.stats()['entries'] == 1
+            DBSession().query(self.Object).filter(
+                self.Object.id == nr + 3
+            ).delete(synchronize_session=False)
+            assert cache.stats()['entries'] == 0
+
+            # nor are the reads of a writer, through its scoped session
+            cache.radially_within(DBSession, self.Object, position,
+                                  self.radius)
+            assert cache.stats()['entries'] == 0
+            DBSession().commit()
+        finally:
+            cache.close()
+
+    def test_async_queries(self, DBSession, load):
+        pytest.importorskip('asyncpg')
+        from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+        nr = 1000
+        ra, dec = load(nr)
+
+        async def run():
+            engine = create_async_engine(
+                database_url().replace('postgresql://',
+                                       'postgresql+asyncpg://'),
+                pool_size=4
+            )
+            Session = sessionmaker(engine, class_=AsyncSession)
+            try:
+                async with Session() as session:
+                    cone = await aio.cone_search(session, self.Object,
+                                                 ra[0], dec[0], self.radius)
+                cones = await aio.cone_search_many(
+                    Session, self.Object, ra[:20], dec[:20], self.radius,
+                    max_concurrency=4
+                )
+                matches = await aio.crossmatch_many(
+                    Session, self.Object, ra[:100], dec[:100], self.radius,
+                    max_concurrency=4, cones_per_query=30
+                )
+            finally:
+                await engine.dispose()
+            return cone, cones, matches
+
+        loop = asyncio.new_event_loop()
+        try:
+            cone, cones, matches = loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+        ia, ib, sep = crossmatch((ra[:100], dec[:100]), (ra, dec),
+                                 self.radius)
+        order = np.lexsort((ib, ia))
+        np.testing.assert_array_equal(matches['center_index'], ia[order])
+        np.testing.assert_array_equal(matches['id'], ib[order] + 1)
+        np.testing.assert_allclose(matches['separation'], sep[order],
+                                   atol=1e-6)
+
+        assert np.all(np.diff(cone['separation']) >= 0)
+        np.testing.assert_array_equal(np.sort(cone['id']), ib[ia == 0] + 1)
+        for i, result in enumerate(cones):
+            np.testing.assert_array_equal(np.sort(result['id']),
+                                          ib[ia == i] + 1)
+
+    def test_spatial_mirror(self, DBSession, load):
+
+        nr = 1000
+        ra, dec = load(nr)
+
+        mirror = SpatialMirror(self.Object, DBSession())
+        assert len(mirror) == nr
+        assert 0 < mirror.nbytes
+
+        position = self.Object(ra=ra[0], dec=dec[0])
+        q = DBSession().query(self.Object.id, self.Object.distance(position))
+        q = q.filter(self.Object.radially_within(position, self.radius))
+        expected = dict(q)
+        found = mirror.radially_within(position, self.radius)
+        assert sorted(expected) == list(found)
+        np.testing.assert_allclose(
+            mirror.distance(position)[found - 1],
+            [expected[i] for i in found], atol=1e-6
+        )
+
+        ids, sep = mirror.nearest(position, k=3)
+        assert ids[0] == 1
+        assert np.all(np.diff(sep) >= 0)
+
+        DBSession().add(self.Object(id=nr + 1, ra=ra[0], dec=dec[0]))
+        DBSession().commit()
+        assert mirror.refresh(DBSession()) == 1
+        assert mirror.refresh(DBSession()) == 0
+        assert nr + 1 in mirror.radially_within(position, self.radius)
+
+        # a row committed after a refresh read past its key
+        late = SpatialMirror(self.Object, DBSession(), overlap=5)
+        DBSession().add(self.Object(id=nr + 4, ra=ra[1], dec=dec[1]))
+        DBSession().commit()
+        late.refresh(DBSession())
+        DBSession().add(self.Object(id=nr + 3, ra=ra[2], dec=dec[2]))
+        DBSession().commit()
+        late.refresh(DBSession())
+        assert late.watermark == nr + 4
+        assert {nr + 3, nr + 4} <= set(late.ids)
+
+        with pytest.raises(ValueError):
+            SpatialMirror(self.Object, DBSession(),
+                          max_bytes=mirror.nbytes - 1)
+
+    def test_radially_within_at_epoch(self, moving, DBSession, rng):
+
+        nr = 1000
+        ra, dec = self.points(nr, rng)
+        pmra = rng.uniform(-1000, 1000, size=nr)
+        pmdec = rng.uniform(-1000, 1000, size=nr)
+        moving.bulk_load(DBSession(), ra, dec, extra_columns={
+            'id': np.arange(1, nr + 1), 'pmra': pmra, 'pmdec': pmdec,
+        })
+        DBSession().commit()
+        # half of the rows have no epoch, so are at the reference epoch
+        DBSession().query(moving).filter(moving.id % 2 == 1).update(
+            {'epoch': 2016.}, synchronize_session=False
+        )
+        DBSession().commit()
+
+        radius = 10.
+        mra, mdec = propagate(ra, dec, pmra, pmdec, 2030. - 2016.)
+        for i in range(0, nr, 100):
+            position = moving(ra=mra[i], dec=mdec[i])
+            q = DBSession().query(moving.id).filter(
+                moving.radially_within_at_epoch(position, radius, 2030.)
+            )
+            ia, ib, sep = crossmatch((mra[i:i + 1], mdec[i:i + 1]),
+                                     (mra, mdec), radius)
+            assert sorted(r[0] for r in q) == list(ib + 1)
+
+            # the catalog position is too far away without the motion
+            if np.hypot(pmra[i], pmdec[i]) * 14 / 1000. > 2 * radius:
+                q = DBSession().query(moving.id).filter(
+                    moving.radially_within(position, radius)
+                )
+                assert i + 1 not in [r[0] for r in q]
+
+    def test_parallel_crossmatch(self, DBSession, load):
+
+        nr = 1000
+        ra, dec = load(nr)
+
+        pairs = parallel_crossmatch(DBSession, self.Object, self.Object,
+                                    self.radius, n_workers=2, n_zones=7)
+
+        ia, ib, sep = crossmatch((ra, dec), (ra, dec), self.radius)
+        np.testing.assert_array_equal(pairs['id_a'], ia + 1)
+        np.testing.assert_array_equal(pairs['id_b'], ib + 1)
+        np.testing.assert_allclose(pairs['separation'], sep, atol=1e-6)
+
+    @pytest.mark.parametrize("symmetric", [False, True])
+    def test_best_match(self, symmetric, table, other, DBSession, rng):
+
+        nr = 1000
+        ra_a, dec_a = self.points(nr, rng)
+        ra_b, dec_b = self.points(nr, rng)
+        self.Object.bulk_load(DBSession(), ra_a, dec_a,
+                              extra_columns={'id': np.arange(1, nr + 1)})
+        other.bulk_load(DBSession(), ra_b, dec_b,
+                        extra_columns={'id': np.arange(1, nr + 1)})
+        DBSession().commit()
+
+        ia, ib, sep = crossmatch((ra_a, dec_a), (ra_b, dec_b), self.radius)
+        order = np.lexsort((ib, sep, ia))
+        first = np.r_[True, np.diff(ia[order]) != 0]
+        expected = set(zip(ia[order][first] + 1, ib[order][first] + 1))
+        if symmetric:
+            order = np.lexsort((ia, sep, ib))
+            first = np.r_[True, np.diff(ib[order]) != 0]
+            expected &= set(zip(ia[order][first] + 1, ib[order][first] + 1))
+
+        rows = best_match(DBSession(), self.Object, other, self.radius,
+                          symmetric=symmetric).all()
+        assert len(rows) == len(expected)
+        assert set((a.id, b.id) for a, b, _ in rows) == expected
+        for a, b, separation in rows:
+            assert separation <= self.radius
+
+    def test_bulk_load_sorted(self, table, DBSession, rng):
+
+        nr = 1000
+        ra, dec = self.points(nr, rng)
+        self.Object.bulk_load(DBSession(), ra, dec, sort=True,
+                              extra_columns={'id': np.arange(1, nr + 1)})
+        DBSession().commit()
+
+        # rows keep their own ids and coordinates...
+        q = DBSession().query(self.Object).order_by(self.Object.id)
+        qra, qdec = self.Object.coordinates(q)
+        np.testing.assert_allclose(qra, ra)
+        np.testing.assert_allclose(qdec, dec)
+
+        # ...but are written along the HEALPix curve
+        stored = [r[0] for r in DBSession().execute(
+            f'SELECT id FROM {self.Object.__tablename__} ORDER BY ctid'
+        )]
+        np.testing.assert_array_equal(stored, spatial_order(ra, dec) + 1)
+
+    def test_cluster_spatially(self, DBSession, load, spatial_explain):
+
+        nr = 10000
+        ra, dec = load(nr)
+        DBSession().execute(f'ANALYZE {self.Object.__tablename__}')
+
+        position = self.Object(ra=ra[0], dec=dec[0])
+        q = DBSession().query(self.Object.id).filter(
+            self.Object.radially_within(position, self.radius)
+        )
+        expected = set(r[0] for r in q)
+        before = spatial_explain(DBSession(), q, require_index=False)
+
+        self.Object.cluster_spatially(DBSession())
+        DBSession().commit()
+
+        assert set(r[0] for r in q) == expected
+        after = spatial_explain(DBSession(), q, require_index=False)
+        blocks = ['shared_hit_blocks', 'shared_read_blocks']
+        assert sum(getattr(after, b) for b in blocks) <= \
+            sum(getattr(before, b) for b in blocks)
+
+    @pytest.mark.parametrize("center", [(0.1, 10.), (359.9, -10.),
+                                        (180., 89.9), (42., -89.95)])
+    def test_radial_wraparound_and_poles(self, center, table, DBSession, rng):
+
+        nr = 10000
+        ra, dec = self.points(nr, rng)
+        self.Object.bulk_load(DBSession(), ra, dec)
+        DBSession().commit()
+
+        radius = 2 * self.radius
+        truth = SkyCoord(ra, dec, unit='deg')
+        coord = SkyCoord(*center, unit='deg')
+        nmatch = (truth.separation(coord) <= radius * u.arcsec).sum()
+
+        position = self.Object(ra=center[0], dec=center[1])
+        q = DBSession().query(self.Object).filter(
+            self.Object.radially_within(position, radius)
+        )
+        assert q.count() == nmatch
+
 
 class TestPostGIS(_TestBase):
 
     itype = 'postgis'
 
+    mixin = PostGISSpatialBackend
+
     Base = declarative_base()
 
-    class Object(PostGISSpatialBackend, Base):
+    class Object(mixin, Base):
         __tablename__ = 'postgis_objects'
         id = sa.Column(sa.Integer, primary_key=True)
 
+    def test_binary_coordinates(self, table, DBSession, rng):
+        ra, dec = self.points(100, rng)
+        DBSession().add_all([self.Object(ra=r, dec=d) for r, d in zip(ra, dec)])
+        DBSession().add_all([self.Object(dec=d, ra=r) for r, d in zip(ra, dec)])
+        DBSession().commit()
+        DBSession().expunge_all()
+
+        objs = DBSession().query(self.Object).order_by(self.Object.id).all()
+        assert all(isinstance(o.radec, GeographyPoint) for o in objs)
+        np.testing.assert_allclose([o.ra for o in objs], np.tile(ra, 2))
+        np.testing.assert_allclose([o.dec for o in objs], np.tile(dec, 2))
+
+        res = DBSession().query(self.Object.ra, self.Object.dec).order_by(
+            self.Object.id
+        ).all()
+        np.testing.assert_allclose([r[0] for r in res], np.tile(ra, 2))
+        np.testing.assert_allclose([r[1] for r in res], np.tile(dec, 2))
+
+
+class TestPostGIS3D(_TestBase):
+
+    itype = 'postgis, 3d'
+
+    mixin = PostGIS3DSpatialBackend
+
+    Base = declarative_base()
+
+    class Object(mixin, Base):
+        __tablename__ = 'postgis3d_objects'
+        id = sa.Column(sa.Integer, primary_key=True)
+
 
 class TestQ3C(_TestBase):
 
     itype = 'q3c'
 
+    mixin = Q3CSpatialBackend
+
     Base = declarative_base()
 
-    class Object(Q3CSpatialBackend, Base):
+    class Object(mixin, Base):
         __tablename__ = 'q3c_objects'
         id = sa.Column(sa.Integer, primary_key=True)
 
@@ -148,9 +826,175 @@ class TestQ3C(_TestBase):
 class TestNone(_TestBase):
 
     itype = 'none'
+    indexed = False
+
+    mixin = UnindexedSpatialBackend
 
     Base = declarative_base()
 
-    class Object(UnindexedSpatialBackend, Base):
+    class Object(mixin, Base):
         __tablename__ = 'none_objects'
         id = sa.Column(sa.Integer, primary_key=True)
+
+
+class TestNoneUnitVectors(_TestBase):
+
+    itype = 'none, unit vectors + btree'
+
+    mixin = UnindexedSpatialBackend
+
+    Base = declarative_base()
+
+    class Object(mixin, Base):
+        __tablename__ = 'none_unit_vector_objects'
+        id = sa.Column(sa.Integer, primary_key=True)
+        UNIT_VECTORS = True
+        BTREE_INDEX = True
+
+
+class TestNoneZones(_TestBase):
+
+    itype = 'none, zones'
+
+    mixin = UnindexedSpatialBackend
+
+    Base = declarative_base()
+
+    class Object(mixin, Base):
+        __tablename__ = 'none_zone_objects'
+        id = sa.Column(sa.Integer, primary_key=True)
+        ZONE_HEIGHT = 0.5
+
+
+class TestHealpix(_TestBase):
+
+    itype = 'healpix'
+
+    mixin = HealpixSpatialBackend
+
+    Base = declarative_base()
+
+    class Object(mixin, Base):
+        __tablename__ = 'healpix_objects'
+        id = sa.Column(sa.Integer, primary_key=True)
+
+    def test_join_index_usage(self, table, DBSession, rng):
+        Base = declarative_base()
+
+        class Other(HealpixSpatialBackend, Base):
+            __tablename__ = 'healpix_objects_other'
+            id = sa.Column(sa.Integer, primary_key=True)
+
+        bind = DBSession().get_bind()
+        Base.metadata.drop_all(bind=bind)
+        Base.metadata.create_all(bind=bind)
+        try:
+            nr, nother = 10000, 20
+            ra, dec = self.points(nr, rng)
+            self.Object.bulk_load(DBSession(), ra, dec,
+                                  extra_columns={'id': np.arange(1, nr + 1)})
+            ora, odec = self.points(nother, rng)
+            Other.bulk_load(DBSession(), ora, odec,
+                            extra_columns={'id': np.arange(1, nother + 1)})
+            DBSession().commit()
+            DBSession().execute(f'ANALYZE {self.Object.__tablename__}')
+            DBSession().execute(f'ANALYZE {Other.__tablename__}')
+
+            q = DBSession().query(Other.id, self.Object.id).join(
+                self.Object, self.Object.radially_within(Other, self.radius)
+            )
+            sql = q.statement.compile(dialect=bind.dialect,
+                                      compile_kwargs={'literal_binds': True})
+            plan = '\n'.join(r[0] for r in DBSession().execute(
+                f'EXPLAIN {sql}'
+            ))
+            print(plan)
+            assert f'{self.Object.__tablename__}_dec_ra_idx' in plan
+
+            expected = set()
+            for i in range(nother):
+                sep = SkyCoord(ora[i], odec[i], unit='deg').separation(
+                    SkyCoord(ra, dec, unit='deg')
+                ).arcsec
+                expected.update((i + 1, j + 1) for j in
+                                np.flatnonzero(sep <= self.radius))
+            assert set(map(tuple, q)) == expected
+        finally:
+            DBSession().rollback()
+            Base.metadata.drop_all(bind=bind)
+
+
+class TestMigration(object):
+
+    radius = 3600  # arcsec
+
+    @pytest.fixture
+    def engine(self):
+        engine = sa.create_engine(database_url(), client_encoding='utf8')
+        engine.execute('DROP TABLE IF EXISTS migrated_objects')
+        yield engine
+        engine.execute('DROP TABLE IF EXISTS migrated_objects')
+        engine.dispose()
+
+    def backend(self, mixin):
+        Base = declarative_base()
+
+        class Object(mixin, Base):
+            __tablename__ = 'migrated_objects'
+            id = sa.Column(sa.Integer, primary_key=True)
+
+        return Object
+
+    def cone(self, engine, cls, ra, dec):
+        session = sessionmaker(bind=engine)()
+        try:
+            return set(o.id for o in session.query(cls).filter(
+                cls.radially_within(cls(ra=ra, dec=dec), self.radius)
+            ))
+        finally:
+            session.close()
+
+    def test_migrate(self, engine):
+
+        nr = 1000
+        rng = np.random.RandomState(seed=SEED)
+        ra = rng.uniform(low=0, high=360, size=nr)
+        dec = rng.uniform(low=-90, high=90, size=nr)
+        sep = SkyCoord(ra, dec, unit='deg').separation(
+            SkyCoord(ra[0], dec[0], unit='deg')
+        ).arcsec
+        expected = set(np.flatnonzero(sep <= self.radius) + 1)
+
+        backends = [UnindexedSpatialBackend, PostGISSpatialBackend,
+                    Q3CSpatialBackend, UnindexedSpatialBackend]
+        source = self.backend(backends[0])
+        source.metadata.create_all(bind=engine)
+        session = sessionmaker(bind=engine)()
+        source.bulk_load(session, ra, dec,
+                         extra_columns={'id': np.arange(1, nr + 1)})
+        session.commit()
+        session.close()
+
+        for mixin in backends[1:]:
+            target = self.backend(mixin)
+            migrate_backend(engine, source, target, batch_size=300)
+
+            # rows written by the old backend are synced by the trigger
+            session = sessionmaker(bind=engine)()
+            session.add(source(id=nr + 1, ra=ra[0], dec=dec[0]))
+            session.commit()
+            session.close()
+            assert self.cone(engine, target, ra[0], dec[0]) == \
+                expected | {nr + 1}
+            engine.execute(f'DELETE FROM migrated_objects '
+                           f'WHERE id = {nr + 1}')
+
+            finish_migration(engine, source, target)
+            columns = set(c['name'] for c in
+                          sa.inspect(engine).get_columns('migrated_objects'))
+            assert columns == set(target.__table__.c.keys())
+            indexes = set(i['name'] for i in
+                          sa.inspect(engine).get_indexes('migrated_objects'))
+            assert indexes == set(i.name for i in target.__table__.indexes)
+            assert self.cone(engine, target, ra[0], dec[0]) == expected
+            source = target
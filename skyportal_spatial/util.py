@@ -0,0 +1,227 @@
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as psql
+from sqlalchemy.orm.state import InstanceState
+
+from .bulk import check_coordinates
+from . import match
+
+
+# the largest possible angular separation
+WHOLE_SKY_ARCSEC = 180 * 3600.
+
+# first radius tried when searching for nearest neighbours without an index
+# that can order by distance
+INITIAL_NEAREST_RADIUS = 60.
+
+
+def array_param(values, type_):
+    """Bind a one dimensional array as a single postgres array parameter."""
+    return sa.literal(np.asarray(values).tolist(), psql.ARRAY(type_))
+
+
+def cone_centers(ra, dec, angular_sep_arcsec, unit_vectors=False):
+    """Return a subquery with one row per cone, built by unnesting arrays
+    that are sent to postgres as parameters of a single statement.
+
+    Parameters
+    ----------
+
+    ra, dec: array-like
+       The icrs coordinates of the cone centers in degrees.
+
+    angular_sep_arcsec: float or array-like
+       The radius of every cone, or of each cone, in arcseconds.
+
+    unit_vectors: bool
+       If True, also compute the unit vector of each center (columns `cx`,
+       `cy` and `cz`) and the chord length of each radius (column `chord`).
+
+    Returns
+    -------
+
+    centers: sqlalchemy.sql.Alias
+       A subquery with columns `center_index` (the position of the cone in
+       the input arrays), `ra`, `dec` and `radius` (in arcseconds).
+    """
+
+    ra, dec = check_coordinates(ra, dec)
+    radius = np.asarray(angular_sep_arcsec, dtype=float)
+    try:
+        radius = np.broadcast_to(radius, ra.shape)
+    except ValueError:
+        raise ValueError('`angular_sep_arcsec` must be a scalar or have the '
+                         'same length as `ra` and `dec`.')
+    index = np.arange(len(ra))
+
+    dbl = psql.DOUBLE_PRECISION
+    columns = [
+        sa.func.unnest(array_param(index, sa.Integer),
+                       type_=sa.Integer).label('center_index'),
+        sa.func.unnest(array_param(ra, dbl), type_=dbl).label('ra'),
+        sa.func.unnest(array_param(dec, dbl), type_=dbl).label('dec'),
+        sa.func.unnest(array_param(radius, dbl), type_=dbl).label('radius'),
+    ]
+    if unit_vectors:
+        xyz = match.unit_vectors(ra, dec)
+        for i, name in enumerate(['cx', 'cy', 'cz']):
+            columns.append(sa.func.unnest(array_param(xyz[:, i], dbl),
+                                          type_=dbl).label(name))
+        chord = match.chord_length(radius)
+        columns.append(sa.func.unnest(array_param(chord, dbl),
+                                      type_=dbl).label('chord'))
+    return sa.select(columns).alias('centers')
+
+
+def _query_entity(query, cls):
+    """Return the entity, `cls` or an alias of it, whose objects `query`
+    selects, so that its columns can be selected instead."""
+    for description in query.column_descriptions:
+        entity = description['entity']
+        if entity is not None and description['expr'] is entity and \
+                issubclass(sa.inspect(entity).mapper.class_, cls):
+            return entity
+    return cls
+
+
+def coordinate_arrays(cls, objects):
+    """Return the coordinates of many objects of `cls` as numpy arrays.
+
+    If `objects` is a query, only the ra and dec expressions of the entity
+    it selects, `cls` or an alias of it, are selected from it, so no objects
+    are loaded into the session. Otherwise it is an iterable of instances of
+    `cls`.
+
+    Returns
+    -------
+
+    ra, dec: numpy.ndarray
+       The coordinates in degrees, in the order of `objects`.
+    """
+
+    if isinstance(objects, sa.orm.Query):
+        entity = _query_entity(objects, cls)
+        rows = objects.with_entities(entity.ra, entity.dec).all()
+    else:
+        rows = [(obj.ra, obj.dec) for obj in objects]
+    radec = np.array(rows, dtype=float).reshape(-1, 2)
+    return radec[:, 0].copy(), radec[:, 1].copy()
+
+
+def cluster_table(session, table, index=None, key=None):
+    """Physically reorder the rows of `table` with CLUSTER, either by the
+    existing index named `index`, or by a temporary b-tree index on `key`,
+    an SQL string or SQLAlchemy expression, and update the planner
+    statistics. CLUSTER holds an exclusive lock on the table while it is
+    rewritten."""
+
+    connection = session.connection()
+    preparer = connection.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    if index is None:
+        index = f'{table.name}_cluster_key_idx'
+        if not isinstance(key, str):
+            key = key.compile(dialect=connection.dialect,
+                              compile_kwargs={'literal_binds': True})
+            key = f'({key})'
+        session.execute(f'CREATE INDEX {preparer.quote(index)} '
+                        f'ON {name} ({key})')
+    # an index lives in the schema of its table
+    qualified = preparer.quote(index)
+    if table.schema is not None:
+        qualified = f'{preparer.quote_schema(table.schema)}.{qualified}'
+    session.execute(f'CLUSTER {name} USING {preparer.quote(index)}')
+    if key is not None:
+        session.execute(f'DROP INDEX {qualified}')
+    session.execute(f'ANALYZE {name}')
+
+
+def is_instance(obj):
+    """Whether `obj` is an instance of a mapped class, as opposed to a mapped
+    class, an alias of one, or a selectable."""
+    state = sa.inspect(obj, raiseerr=False)
+    return isinstance(state, InstanceState)
+
+
+def expanding_radius(count, k, initial_radius, max_radius=None):
+    """Find a search radius containing at least `k` objects by doubling
+    `initial_radius` (arcsec) until `count(radius)` is at least `k`.
+
+    Returns `max_radius` if it is reached first, or None if even the whole
+    sky holds fewer than `k` objects.
+    """
+
+    radius = initial_radius
+    while True:
+        if max_radius is not None and radius >= max_radius:
+            return max_radius
+        if count(radius) >= k:
+            return radius
+        if radius >= WHOLE_SKY_ARCSEC:
+            return None
+        radius *= 2
+
+
+def nearest_query(session, cls, other, k, order_by=None, max_radius=None):
+    """Build the query behind the `nearest` methods of the spatial backends.
+
+    Parameters
+    ----------
+
+    session: sqlalchemy.orm.Session
+       The session to build the query with.
+
+    cls: mapped class
+       The class whose nearest objects are wanted.
+
+    other: instance or class
+       The position(s) to search around.
+
+    k: int
+       The number of neighbours to return per position.
+
+    order_by: callable, optional
+       Called with (target, other), returns the expression to order the
+       candidates by, nearest first, if that is not the distance itself;
+       e.g. an operator an index can serve. Without it, the search radius
+       around an instance is found with `expanding_radius` if `max_radius`
+       is not given.
+
+    max_radius: float, optional
+       Only consider candidates within this many arcseconds.
+
+    Returns
+    -------
+
+    query: sqlalchemy.orm.Query
+       If `other` is an instance, a query of `(object, distance)` rows. If
+       it is a class, a query of `(other_object, object, distance)` rows
+       built with a LATERAL subquery, with up to `k` rows per row of
+       `other`.
+    """
+
+    if is_instance(other):
+        if order_by is None and max_radius is None:
+            def count(radius):
+                return session.query(cls).filter(
+                    cls.radially_within(other, radius)
+                ).limit(k).count()
+            max_radius = expanding_radius(count, k, INITIAL_NEAREST_RADIUS)
+
+        distance = cls.distance(other).label('distance')
+        q = session.query(cls, distance)
+        if max_radius is not None:
+            q = q.filter(cls.radially_within(other, max_radius))
+        key = distance if order_by is None else order_by(cls, other)
+        return q.order_by(key).limit(k)
+
+    target = sa.orm.aliased(cls)
+    distance = target.distance(other).label('distance')
+    inner = session.query(target, distance)
+    if max_radius is not None:
+        inner = inner.filter(target.radially_within(other, max_radius))
+    key = distance if order_by is None else order_by(target, other)
+    inner = inner.order_by(key).limit(k)
+    inner = inner.subquery().lateral('nearest')
+    near = sa.orm.aliased(cls, inner)
+    return session.query(other, near, inner.c.distance).join(inner, sa.true())